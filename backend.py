@@ -1,6 +1,6 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Depends, status, Body
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Depends, status, Body, Query, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
@@ -11,8 +11,12 @@ import shutil
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
+import httpx
 import re
 import hashlib
+import secrets
+import html
 import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta
 try:
@@ -25,14 +29,23 @@ except ImportError:
         except:
             return None
     date_parser = type('obj', (object,), {'parse': date_parser_parse})()
-from groq import Groq
+from groq import Groq, AsyncGroq
 import google.generativeai as genai
 import concurrent.futures
+import itertools
+import types
+import threading
+import heapq
+import bisect
+import math
+import unicodedata
+import collections
+import csv
 from typing import Optional, List, Dict
 import json as json_lib
 import asyncio
 from asyncio import Semaphore
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime
+from sqlalchemy import create_engine, Column, Integer, Float, String, Text, ForeignKey, DateTime, Index, inspect, text, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
 from passlib.context import CryptContext
@@ -48,6 +61,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Job-Id", "X-Job-Secret", "X-Next-Before"],
 )
 
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
@@ -65,13 +79,20 @@ DATA_DIR = "data"
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
 
-# 并发控制：限制同时进行的转录任务数量（防止资源耗尽）
+# 并发控制：任务队列的 worker 数，即并发转录的上限；实际并发由按内存的准入控制决定（见 Admission Control）
 MAX_CONCURRENT_TRANSCRIPTIONS = 4  # 最多4个并发转录（考虑到Groq API限制：30 req/min）
-transcription_semaphore = Semaphore(MAX_CONCURRENT_TRANSCRIPTIONS)
 
-# 活跃转写任务跟踪（用于支持任务取消）
-# 结构: {user_id or ip: {"session_id": str, "cancelled": bool, "start_time": float}}
-active_transcriptions = {}
+# 流式下载：HTTP响应体直接写入 ffmpeg stdin，切片与下载并行，不再落盘整集音频
+# （moov 在文件末尾的 m4a 无法从管道解复用，会自动回退为先下载到 temp_files）
+STREAMING_INGEST = os.environ.get("STREAMING_INGEST", "1") == "1"
+
+# FFmpeg 编码线程数（结合日志中的编码速度倍率调整）
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", "2"))
+
+# 分片边界：目标25分钟，在目标切点前后 SILENCE_SEARCH_WINDOW 秒内找静音处切分，避免切断词句
+SEGMENT_TARGET_SECONDS = 1500
+SILENCE_SEARCH_WINDOW = 90
+SILENCE_AWARE_SPLIT = os.environ.get("SILENCE_AWARE_SPLIT", "1") == "1"
 
 # --- Database Setup (SQLite) ---
 SQLALCHEMY_DATABASE_URL = "sqlite:///./data/users.db"
@@ -95,7 +116,27 @@ class HistoryItem(Base):
     data_json = Column(Text) # Stores the full JSON result
     audio_url = Column(String, nullable=True) # 存储音频URL用于查重
     speaker_transcript = Column(Text, nullable=True) # 存储说话人识别版本的transcript
+    analysis_cache_id = Column(Integer, ForeignKey("analysis_cache.id"), nullable=True) # 指向共享的分析结果
+    # 列表页用的冗余字段，写入 data_json 时同步更新，列表接口不再解析 data_json
+    summary_type = Column(String, nullable=True)  # summary.overview.type
+    duration_seconds = Column(Integer, nullable=True)  # 文稿最后一行的结束时间
+    snippet = Column(String, nullable=True)  # 概览摘要的开头
     owner = relationship("User", back_populates="history_items")
+    __table_args__ = (Index("ix_history_user_created", "user_id", "created_at", "id"),)
+
+class AnalysisCache(Base):
+    """共享分析结果缓存：同一集播客（相同URL或相同音频内容）只完整处理一次"""
+    __tablename__ = "analysis_cache"
+    id = Column(Integer, primary_key=True, index=True)
+    source_url_key = Column(String, index=True, nullable=True)  # 用户提交的URL（规范化后）
+    url_key = Column(String, index=True, nullable=True)  # 解析后的真实音频URL（规范化后）
+    content_hash = Column(String, index=True, nullable=True)  # 音频内容 sha256
+    audio_url = Column(String, nullable=True)  # 原始音频URL（命中时用于播放和历史记录）
+    title = Column(String)
+    data_json = Column(Text)  # 与 HistoryItem.data_json 相同的完整结果
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_hit_at = Column(DateTime, nullable=True)
 
 class Podcaster(Base):
     __tablename__ = "podcasters"
@@ -123,8 +164,108 @@ class PodcastEpisode(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     podcaster = relationship("Podcaster", back_populates="episodes")
 
+class Job(Base):
+    """持久化的分析任务：执行与 SSE 连接解耦，客户端断开后继续运行，服务重启后重新排队"""
+    __tablename__ = "jobs"
+    id = Column(String, primary_key=True, index=True)  # uuid hex，同时作为临时文件前缀（session_id）
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    client_id = Column(String, index=True)  # user_{id} 或 session_{job_id}，同一客户端的新任务会取消旧任务
+    kind = Column(String, default="analyze")
+    lane = Column(String, default="interactive")  # interactive / bulk，见 Fair Scheduling
+    source_type = Column(String)  # url / file
+    url = Column(String, nullable=True)
+    file_path = Column(String, nullable=True)  # 上传文件在 temp_files 中的路径
+    content_hash = Column(String, nullable=True)
+    status = Column(String, index=True, default="queued")  # queued / running / completed / failed / cancelled
+    error = Column(Text, nullable=True)
+    history_id = Column(Integer, nullable=True)
+    failed_chunks = Column(Integer, default=0)  # 完成但有分片转写失败时可重试
+    event_count = Column(Integer, default=0)  # 已写入的事件数，即最后一个事件的 seq
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    queued_at = Column(DateTime, default=datetime.utcnow)  # 最近一次入队时间（重试时更新），用于统计排队等待
+    secret_hash = Column(String, nullable=True)  # 匿名任务访问凭证的 sha256，凭证只在创建时返回一次（X-Job-Secret）
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class JobEvent(Base):
+    """任务的 SSE 进度事件，按 seq 顺序回放"""
+    __tablename__ = "job_events"
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String, ForeignKey("jobs.id"), index=True)
+    seq = Column(Integer)
+    payload = Column(Text)  # 事件 JSON（已包含 job_id 和 seq）
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ChunkCheckpoint(Base):
+    """分片转写检查点：同一音频内容、同一分片边界、同一模型的转写结果只需成功一次"""
+    __tablename__ = "chunk_checkpoints"
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String, index=True)
+    model = Column(String)
+    start_time = Column(Float)  # 分片在原音频中的起止秒数
+    end_time = Column(Float)
+    result_json = Column(Text)  # {"text", "segments": [{start, end, text}]}，时间相对分片起点
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class TranscriptSegment(Base):
+    """文稿分段：每行一条，按 position 顺序分页"""
+    __tablename__ = "transcript_segments"
+    id = Column(Integer, primary_key=True, index=True)
+    history_id = Column(Integer, ForeignKey("history.id"))
+    position = Column(Integer)  # 在文稿中的行序号，分页游标
+    start_time = Column(Float)  # 秒
+    end_time = Column(Float)
+    text = Column(Text)
+    speaker = Column(String, nullable=True)  # 说话人识别后回填
+    __table_args__ = (
+        Index("ix_transcript_segments_history_position", "history_id", "position"),
+        Index("ix_transcript_segments_history_start", "history_id", "start_time"),
+    )
+
+class LLMCacheEntry(Base):
+    """LLM 响应缓存：同一模型、提示词版本、输入和参数的请求直接复用上次通过校验的输出"""
+    __tablename__ = "llm_cache"
+    key = Column(String, primary_key=True)  # sha256(model, prompt_version, messages, 参数)
+    model = Column(String)
+    prompt_version = Column(String, index=True)
+    content = Column(Text)
+    size_bytes = Column(Integer, default=0)
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)  # LRU 淘汰依据
+
 Base.metadata.create_all(bind=engine)
 
+def ensure_sqlite_columns():
+    """create_all 不会给已存在的表加列，这里为旧数据库补齐新增的可空列"""
+    new_columns = {
+        "history": {
+            "analysis_cache_id": "INTEGER REFERENCES analysis_cache(id)",
+            "summary_type": "VARCHAR",
+            "duration_seconds": "INTEGER",
+            "snippet": "VARCHAR",
+        },
+        "jobs": {
+            "failed_chunks": "INTEGER DEFAULT 0",
+            "lane": "VARCHAR DEFAULT 'interactive'",
+            "queued_at": "DATETIME",
+            "secret_hash": "VARCHAR",
+        },
+    }
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table, columns in new_columns.items():
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            for name, ddl in columns.items():
+                if name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+                    print(f"✓ Migrated: added column {table}.{name}")
+        # create_all 同样不会给已存在的表建新索引
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_history_user_created ON history (user_id, created_at, id)"))
+
+ensure_sqlite_columns()
+
 def get_db():
     db = SessionLocal()
     try:
@@ -142,6 +283,10 @@ pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/token")
 # 可选的token scheme（不强制要求，用于支持未登录用户）
 oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="api/auth/token", auto_error=False)
+# 运维/统计接口只对管理员开放：ADMIN_USERNAMES 中的登录用户（逗号分隔），或请求头 X-Admin-Token 等于 ADMIN_TOKEN。
+# 两者都未配置时这些接口一律拒绝
+ADMIN_USERNAMES = {name.strip() for name in os.environ.get("ADMIN_USERNAMES", "").split(",") if name.strip()}
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
 
 # --- Pydantic Models ---
 class UserCreate(BaseModel):
@@ -164,6 +309,7 @@ class HistoryResponse(BaseModel):
 class ChatRequest(BaseModel):
     message: str
     context: Dict # The podcast analysis result to give context to the AI
+    history_id: Optional[int] = None  # 有时从该历史记录的完整文稿中检索相关片段（否则用 context.transcript）
 
 class PodcasterCreate(BaseModel):
     name: str
@@ -231,12 +377,603 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         raise credentials_exception
     return user
 
+def get_optional_user_id(token: Optional[str]) -> Optional[int]:
+    """可选认证：token 有效时返回 user_id，否则返回 None（允许匿名访问）"""
+    if not token:
+        return None
+    db = SessionLocal()
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username:
+            user = db.query(User).filter(User.username == username).first()
+            if user:
+                return user.id
+    except JWTError:
+        pass
+    finally:
+        db.close()
+    return None
+
+def require_admin(token: Optional[str] = Depends(oauth2_scheme_optional), x_admin_token: Optional[str] = Header(None)):
+    """管理员校验（用作依赖）：通过返回 None，否则 401/403"""
+    if ADMIN_TOKEN and x_admin_token and secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        return
+    if token and ADMIN_USERNAMES:
+        db = SessionLocal()
+        try:
+            username = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+            if username in ADMIN_USERNAMES and db.query(User.id).filter(User.username == username).first():
+                return
+        except JWTError:
+            pass
+        finally:
+            db.close()
+    if not token and not x_admin_token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+
+# --- Groq Scheduler ---
+
+# 优先级：数字越小越先拿到令牌（用户正在等待的聊天优先于后台批量转写）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+# 每个模型的限速：(每分钟请求数, 突发容量)，所有会话共享
+GROQ_RATE_LIMITS = {
+    "whisper-large-v3-turbo": (20, 4),
+    "qwen/qwen3-32b": (60, 6),
+    "openai/gpt-oss-120b": (30, 3),
+}
+DEFAULT_GROQ_RATE_LIMIT = (30, 3)
+
+# 所有会话共享的 Groq 工作线程（替代每个会话各自的线程池）
+GROQ_WORKER_THREADS = 6
+groq_executor = concurrent.futures.ThreadPoolExecutor(max_workers=GROQ_WORKER_THREADS, thread_name_prefix="groq")
+
+class TokenBucket:
+    def __init__(self, requests_per_minute: float, capacity: int):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0  # 收到 429 后在此之前不发放令牌
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class GroqScheduler:
+    """进程级 Groq 请求调度：按模型令牌桶限速、按优先级排队、遇到 429 按 Retry-After 退避"""
+
+    def __init__(self, limits: Dict[str, tuple]):
+        self._limits = limits
+        self._condition = threading.Condition()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._waiters: Dict[str, list] = {}  # model -> 堆 [(priority, seq)]
+        self._sequence = itertools.count()
+        self._stats: Dict[str, Dict] = {}
+
+    def _model_state(self, model: str):
+        if model not in self._buckets:
+            rate, capacity = self._limits.get(model, DEFAULT_GROQ_RATE_LIMIT)
+            self._buckets[model] = TokenBucket(rate, capacity)
+            self._waiters[model] = []
+            self._stats[model] = {"granted": 0, "rate_limited": 0, "retries": 0, "max_queue_depth": 0, "total_wait": 0.0}
+        return self._buckets[model], self._waiters[model], self._stats[model]
+
+    def acquire(self, model: str, priority: int = PRIORITY_NORMAL) -> float:
+        """阻塞直到拿到该模型的一个令牌，返回排队等待的秒数。
+        不能在事件循环线程上调用：与 acquire_async 共用排队堆，在循环上阻塞会让排在前面的异步请求永远拿不到令牌"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("GroqScheduler.acquire() called on the event loop thread; use acquire_async() / groq_chat_async() or asyncio.to_thread")
+        with self._condition:
+            bucket, waiters, stats = self._model_state(model)
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(waiters, ticket)
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], len(waiters))
+            started = time.monotonic()
+            granted = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    if waiters[0] == ticket and bucket.tokens >= 1 and now >= bucket.paused_until:
+                        heapq.heappop(waiters)
+                        bucket.tokens -= 1
+                        granted = True
+                        waited = now - started
+                        stats["granted"] += 1
+                        stats["total_wait"] += waited
+                        self._condition.notify_all()
+                        return waited
+                    if waiters[0] == ticket:
+                        timeout = max(bucket.paused_until - now, (1 - bucket.tokens) / bucket.rate, 0.01)
+                    else:
+                        timeout = 1.0  # 前面的请求拿到令牌后会唤醒我们
+                    self._condition.wait(timeout=timeout)
+            finally:
+                if not granted and ticket in waiters:
+                    waiters.remove(ticket)
+                    heapq.heapify(waiters)
+                    self._condition.notify_all()
+
+    async def acquire_async(self, model: str, priority: int = PRIORITY_NORMAL) -> float:
+        """acquire() 的异步版本：排在队首时按令牌恢复时间 sleep，否则短间隔轮询，不占用线程"""
+        with self._condition:
+            _, waiters, stats = self._model_state(model)
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(waiters, ticket)
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], len(waiters))
+        started = time.monotonic()
+        granted = False
+        try:
+            while True:
+                with self._condition:
+                    bucket, waiters, stats = self._model_state(model)
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    if waiters[0] == ticket and bucket.tokens >= 1 and now >= bucket.paused_until:
+                        heapq.heappop(waiters)
+                        bucket.tokens -= 1
+                        granted = True
+                        waited = now - started
+                        stats["granted"] += 1
+                        stats["total_wait"] += waited
+                        self._condition.notify_all()
+                        return waited
+                    if waiters[0] == ticket:
+                        timeout = max(bucket.paused_until - now, (1 - bucket.tokens) / bucket.rate, 0.01)
+                    else:
+                        timeout = 0.05
+                await asyncio.sleep(timeout)
+        finally:
+            if not granted:
+                with self._condition:
+                    waiters = self._waiters[model]
+                    if ticket in waiters:
+                        waiters.remove(ticket)
+                        heapq.heapify(waiters)
+                        self._condition.notify_all()
+
+    def penalize(self, model: str, seconds: float):
+        """收到 429：清空令牌并暂停该模型的发放"""
+        with self._condition:
+            bucket, _, stats = self._model_state(model)
+            bucket.tokens = 0.0
+            bucket.paused_until = max(bucket.paused_until, time.monotonic() + seconds)
+            stats["rate_limited"] += 1
+            self._condition.notify_all()
+
+    def call(self, model: str, fn, priority: int = PRIORITY_NORMAL, max_retries: int = 3):
+        """排队拿令牌后执行 fn()；429 时按 Retry-After 暂停该模型并重试"""
+        for attempt in range(max_retries + 1):
+            self.acquire(model, priority)
+            try:
+                return fn()
+            except Exception as e:
+                retry_after = rate_limit_retry_after(e, attempt)
+                if retry_after is None or attempt == max_retries:
+                    raise
+                print(f"⚠️  Groq 429 on {model}, backing off {retry_after:.1f}s (attempt {attempt + 1}/{max_retries})")
+                self.penalize(model, retry_after)
+                with self._condition:
+                    self._stats[model]["retries"] += 1
+
+    async def acall(self, model: str, fn, priority: int = PRIORITY_NORMAL, max_retries: int = 3):
+        """call() 的异步版本：fn() 返回协程，排队等令牌时不阻塞事件循环也不占用线程"""
+        for attempt in range(max_retries + 1):
+            await self.acquire_async(model, priority)
+            try:
+                return await fn()
+            except Exception as e:
+                retry_after = rate_limit_retry_after(e, attempt)
+                if retry_after is None or attempt == max_retries:
+                    raise
+                print(f"⚠️  Groq 429 on {model}, backing off {retry_after:.1f}s (attempt {attempt + 1}/{max_retries})")
+                self.penalize(model, retry_after)
+                with self._condition:
+                    self._stats[model]["retries"] += 1
+
+    def snapshot(self) -> Dict:
+        """各模型的队列深度、令牌余量和累计统计"""
+        with self._condition:
+            now = time.monotonic()
+            result = {}
+            for model, bucket in self._buckets.items():
+                bucket.refill(now)
+                waiters = self._waiters[model]
+                stats = self._stats[model]
+                result[model] = {
+                    "queue_depth": len(waiters),
+                    "queue_by_priority": {p: sum(1 for w in waiters if w[0] == p) for p in sorted({w[0] for w in waiters})},
+                    "tokens": round(bucket.tokens, 2),
+                    "paused_for": round(max(0.0, bucket.paused_until - now), 1),
+                    "avg_wait": round(stats["total_wait"] / stats["granted"], 3) if stats["granted"] else 0.0,
+                    **stats,
+                }
+            return result
+
+def rate_limit_retry_after(error: Exception, attempt: int) -> Optional[float]:
+    """是 429 错误时返回应等待的秒数（优先使用 Retry-After 头），否则返回 None"""
+    if getattr(error, "status_code", None) != 429:
+        return None
+    response = getattr(error, "response", None)
+    header = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(0.5, float(header))
+    except (TypeError, ValueError):
+        return min(60.0, 2.0 * (2 ** attempt))
+
+groq_scheduler = GroqScheduler(GROQ_RATE_LIMITS)
+
+def groq_transcribe(client, priority: int = PRIORITY_BATCH, **kwargs):
+    """经调度器发起语音转写请求"""
+    return groq_scheduler.call(kwargs["model"], lambda: client.audio.transcriptions.create(**kwargs), priority)
+
+# --- LLM Response Cache ---
+# 标点、说话人识别和总结的请求在低温度下几乎是确定性的，按 (模型, 提示词版本, 输入, 参数) 缓存到数据库。
+# 修改某类提示词或其后处理时递增对应版本号，旧条目不再命中，随 LRU/TTL 淘汰
+LLM_PROMPT_VERSIONS = {
+    "punctuation": "punctuation-v1",
+    "punctuation_numbered": "punctuation-numbered-v1",
+    "punctuation_segment": "punctuation-segment-v1",
+    "speakers": "speakers-v1",
+    "summary": "summary-v1",
+    "summary_section": "summary-section-v1",
+    "summary_map": "summary-map-v1",
+    "summary_reduce": "summary-reduce-v1",
+}
+LLM_CACHE_MAX_MB = float(os.environ.get("LLM_CACHE_MAX_MB", "200"))
+LLM_CACHE_TTL_DAYS = int(os.environ.get("LLM_CACHE_TTL_DAYS", "30"))
+LLM_CACHE_UNKEYED_PARAMS = ("timeout", "stream")  # 不影响输出内容的参数
+LLM_CACHE_PRUNE_EVERY = int(os.environ.get("LLM_CACHE_PRUNE_EVERY", "200"))  # 未超限时每写入多少次做一次完整清理（删过期条目、校准总大小）
+
+class LLMCache:
+    """数据库中的 LLM 输出缓存：超过 LLM_CACHE_MAX_MB 时按最近使用时间淘汰，超过 TTL 的条目视为未命中。
+    调用方校验输出失败时调用 discard_last()，避免把坏结果固定下来（重试会得到同一份输出）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()  # 当前线程最近一次写入的 key
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "discarded": 0, "expired": 0, "evicted": 0, "bytes_served": 0}
+        self.by_version: Dict[str, Dict[str, int]] = {}
+        self._size_bytes: Optional[int] = None  # 表内总大小的运行估计，prune() 时按实际值校准
+        self._writes_since_prune = 0
+
+    @staticmethod
+    def key(version: str, kwargs: Dict) -> str:
+        params = {k: v for k, v in kwargs.items() if k not in LLM_CACHE_UNKEYED_PARAMS}
+        return hashlib.sha256(json.dumps([version, params], ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _count(self, version: str, outcome: str, size: int = 0):
+        with self._lock:
+            self.stats[outcome] += 1
+            if outcome == "hits":
+                self.stats["bytes_served"] += size
+            counters = self.by_version.setdefault(version, {"hits": 0, "misses": 0})
+            if outcome in counters:
+                counters[outcome] += 1
+
+    def get(self, version: str, kwargs: Dict) -> Optional[str]:
+        key = self.key(version, kwargs)
+        db = SessionLocal()
+        try:
+            entry = db.query(LLMCacheEntry).filter(LLMCacheEntry.key == key).first()
+            if entry and entry.created_at < datetime.utcnow() - timedelta(days=LLM_CACHE_TTL_DAYS):
+                db.delete(entry)
+                db.commit()
+                self._count(version, "expired")
+                entry = None
+            self._local.last_key = key if entry else None
+            if entry is None:
+                self._count(version, "misses")
+                return None
+            entry.hit_count = (entry.hit_count or 0) + 1
+            entry.last_used_at = datetime.utcnow()
+            db.commit()
+            self._count(version, "hits", entry.size_bytes or 0)
+            return entry.content
+        except Exception as e:
+            print(f"⚠️  LLM cache lookup failed: {e}")
+            db.rollback()
+            return None
+        finally:
+            db.close()
+
+    def put(self, version: str, kwargs: Dict, content: str):
+        if not content:
+            return
+        key = self.key(version, kwargs)
+        self._local.last_key = key
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            size = len(content.encode("utf-8"))
+            db.merge(LLMCacheEntry(
+                key=key, model=kwargs.get("model"), prompt_version=version, content=content,
+                size_bytes=size, hit_count=0, created_at=now, last_used_at=now
+            ))
+            db.commit()
+            self._count(version, "stores")
+        except Exception as e:
+            print(f"⚠️  LLM cache store failed: {e}")
+            db.rollback()
+            return
+        finally:
+            db.close()
+        # 每次写入都全表求和太贵：累加运行总量，只在总量未知、超限或每 LLM_CACHE_PRUNE_EVERY 次写入时清理
+        with self._lock:
+            self._writes_since_prune += 1
+            if self._size_bytes is not None:
+                self._size_bytes += size
+            due = (self._size_bytes is None or self._size_bytes > LLM_CACHE_MAX_MB * 1024 * 1024
+                   or self._writes_since_prune >= LLM_CACHE_PRUNE_EVERY)
+        if due:
+            self.prune()
+
+    def discard_last(self):
+        """删除当前线程最近一次命中或写入的条目（调用方认定该输出无效时）"""
+        key = getattr(self._local, "last_key", None)
+        if not key:
+            return
+        self._local.last_key = None
+        db = SessionLocal()
+        try:
+            if db.query(LLMCacheEntry).filter(LLMCacheEntry.key == key).delete():
+                with self._lock:
+                    self.stats["discarded"] += 1
+            db.commit()
+        finally:
+            db.close()
+
+    def prune(self):
+        """删除过期条目；总大小超过上限时从最久未使用的开始删除，直到降到上限的 90%"""
+        db = SessionLocal()
+        try:
+            cutoff = datetime.utcnow() - timedelta(days=LLM_CACHE_TTL_DAYS)
+            expired = db.query(LLMCacheEntry).filter(LLMCacheEntry.created_at < cutoff).delete(synchronize_session=False)
+            total = db.query(func.coalesce(func.sum(LLMCacheEntry.size_bytes), 0)).scalar() or 0
+            limit = LLM_CACHE_MAX_MB * 1024 * 1024
+            evicted = []
+            if total > limit:
+                for key, size in db.query(LLMCacheEntry.key, LLMCacheEntry.size_bytes).order_by(LLMCacheEntry.last_used_at).all():
+                    if total <= limit * 0.9:
+                        break
+                    evicted.append(key)
+                    total -= size or 0
+                db.query(LLMCacheEntry).filter(LLMCacheEntry.key.in_(evicted)).delete(synchronize_session=False)
+            db.commit()
+            with self._lock:
+                self._size_bytes = total
+                self._writes_since_prune = 0
+                self.stats["expired"] += expired
+                self.stats["evicted"] += len(evicted)
+            if expired or evicted:
+                print(f"✓ LLM cache pruned: {expired} expired, {len(evicted)} evicted ({total / 1024 / 1024:.1f} MB left)")
+        except Exception as e:
+            print(f"⚠️  LLM cache prune failed: {e}")
+            db.rollback()
+        finally:
+            db.close()
+
+    def snapshot(self) -> Dict:
+        db = SessionLocal()
+        try:
+            rows = db.query(LLMCacheEntry.prompt_version, LLMCacheEntry.size_bytes).all()
+        finally:
+            db.close()
+        entries: Dict[str, Dict[str, int]] = {}
+        for version, size in rows:
+            info = entries.setdefault(version, {"entries": 0, "bytes": 0})
+            info["entries"] += 1
+            info["bytes"] += size or 0
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": len(rows),
+                "size_mb": round(sum(info["bytes"] for info in entries.values()) / 1024 / 1024, 2),
+                "max_mb": LLM_CACHE_MAX_MB,
+                "ttl_days": LLM_CACHE_TTL_DAYS,
+                "versions": {
+                    version: {**entries.get(version, {"entries": 0, "bytes": 0}), **self.by_version.get(version, {"hits": 0, "misses": 0})}
+                    for version in sorted(set(entries) | set(self.by_version))
+                },
+            }
+
+llm_cache = LLMCache()
+
+def cached_chat_response(content: str):
+    """把缓存的文本包装成与 chat.completions 响应相同的访问形式"""
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content), finish_reason="stop")])
+
+def groq_chat(client, priority: int = PRIORITY_NORMAL, cache_version: Optional[str] = None, cache_refresh: bool = False, **kwargs):
+    """经调度器发起 chat.completions 请求；指定 cache_version 时先查 LLM 缓存（cache_refresh 跳过读取但仍写入）"""
+    if cache_version and not kwargs.get("stream"):
+        cached = None if cache_refresh else llm_cache.get(cache_version, kwargs)
+        if cached is not None:
+            return cached_chat_response(cached)
+        response = groq_scheduler.call(kwargs["model"], lambda: client.chat.completions.create(**kwargs), priority)
+        if response and response.choices:
+            llm_cache.put(cache_version, kwargs, response.choices[0].message.content or "")
+        return response
+    return groq_scheduler.call(kwargs["model"], lambda: client.chat.completions.create(**kwargs), priority)
+
+async def groq_chat_async(client, priority: int = PRIORITY_NORMAL, **kwargs):
+    """用 AsyncGroq 客户端经调度器发起 chat.completions 请求（stream=True 时返回 AsyncStream）"""
+    return await groq_scheduler.acall(kwargs["model"], lambda: client.chat.completions.create(**kwargs), priority)
+
+# --- Client Registry ---
+# 进程内共享的 Groq（同步/异步）和 HTTP 客户端，启动时创建、关闭时释放；连接池保持长连接，
+# 避免每个请求/分片/标点批次都重新建立 TLS 连接
+GROQ_POOL_CONNECTIONS = int(os.environ.get("GROQ_POOL_CONNECTIONS", "0"))  # 0 表示按各处并发上限自动计算
+GROQ_KEEPALIVE_SECONDS = 60
+HTTP_POOL_HOSTS = 10  # requests 会话按主机分池
+HTTP_POOL_SIZE = 8
+
+def groq_pool_size() -> int:
+    """同时可能在途的 Groq 请求数：转写线程 + 标点批次 + 总结分段 + 说话人分段"""
+    if GROQ_POOL_CONNECTIONS > 0:
+        return GROQ_POOL_CONNECTIONS
+    return GROQ_WORKER_THREADS + PUNCTUATION_CONCURRENCY + SUMMARY_MAP_CONCURRENCY + SPEAKER_CHUNK_CONCURRENCY
+
+class ConnectionStats:
+    """经 httpcore 的 trace 扩展统计请求数和新建连接数，二者之差即复用的连接"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "new_connections": 0, "tls_handshakes": 0, "failed_connects": 0}
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def trace(self, event: str, info: Dict):
+        if event == "connection.connect_tcp.complete":
+            self.count("new_connections")
+        elif event == "connection.start_tls.complete":
+            self.count("tls_handshakes")
+        elif event == "connection.connect_tcp.failed":
+            self.count("failed_connects")
+
+    async def atrace(self, event: str, info: Dict):
+        self.trace(event, info)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = dict(self.counters)
+        reused = max(0, counters["requests"] - counters["new_connections"])
+        return {**counters, "reused": reused, "reuse_rate": round(reused / counters["requests"], 4) if counters["requests"] else 0.0}
+
+class TracingTransport(httpx.HTTPTransport):
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def handle_request(self, request):
+        self.stats.count("requests")
+        request.extensions = {**request.extensions, "trace": self.stats.trace}
+        return super().handle_request(request)
+
+class TracingAsyncTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request):
+        self.stats.count("requests")
+        request.extensions = {**request.extensions, "trace": self.stats.atrace}
+        return await super().handle_async_request(request)
+
+class ClientRegistry:
+    """共享客户端：groq / async_groq 用带连接池的 httpx 客户端，http 是 requests.Session（抓取页面和下载音频）。
+    首次访问时自动创建，脚本或测试里没有触发 startup 事件也能用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groq = None
+        self._async_groq = None
+        self._http = None
+        self.pool_size = 0
+        self.groq_stats = ConnectionStats()
+        self.async_groq_stats = ConnectionStats()
+        self.started_at = None
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size, keepalive_expiry=GROQ_KEEPALIVE_SECONDS)
+
+    def start(self):
+        with self._lock:
+            if self._groq is not None:
+                return
+            self.pool_size = groq_pool_size()
+            # max_retries=0：SDK 自带的 429 重试会绕过 GroqScheduler（不拿令牌、不按 Retry-After 暂停），重试只由 call()/acall() 负责
+            self._groq = Groq(api_key=GROQ_API_KEY, max_retries=0, http_client=httpx.Client(
+                transport=TracingTransport(self.groq_stats, limits=self._limits()), follow_redirects=True
+            ))
+            self._async_groq = AsyncGroq(api_key=GROQ_API_KEY, max_retries=0, http_client=httpx.AsyncClient(
+                transport=TracingAsyncTransport(self.async_groq_stats, limits=self._limits()), follow_redirects=True
+            ))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._http = session
+            self.started_at = datetime.utcnow()
+            print(f"✓ Client registry started (Groq pool: {self.pool_size} connections)")
+
+    @property
+    def groq(self) -> Groq:
+        if self._groq is None:
+            self.start()
+        return self._groq
+
+    @property
+    def async_groq(self) -> AsyncGroq:
+        if self._async_groq is None:
+            self.start()
+        return self._async_groq
+
+    @property
+    def http(self) -> requests.Session:
+        if self._http is None:
+            self.start()
+        return self._http
+
+    async def aclose(self):
+        with self._lock:
+            groq_client, async_groq_client, http_session = self._groq, self._async_groq, self._http
+            self._groq = self._async_groq = self._http = None
+        if groq_client is not None:
+            groq_client.close()
+        if async_groq_client is not None:
+            await async_groq_client.close()
+        if http_session is not None:
+            http_session.close()
+        print("✓ Client registry closed")
+
+    def http_stats(self) -> Dict:
+        """urllib3 各主机连接池的请求数与新建连接数"""
+        counters = {"hosts": 0, "requests": 0, "new_connections": 0}
+        adapter = self._http.get_adapter("https://") if self._http is not None else None
+        if adapter is None:
+            return counters
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            counters["hosts"] += 1
+            counters["requests"] += pool.num_requests
+            counters["new_connections"] += pool.num_connections
+        reused = max(0, counters["requests"] - counters["new_connections"])
+        counters["reuse_rate"] = round(reused / counters["requests"], 4) if counters["requests"] else 0.0
+        return counters
+
+    def snapshot(self) -> Dict:
+        return {
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "groq_pool_size": self.pool_size,
+            "groq": self.groq_stats.snapshot(),
+            "async_groq": self.async_groq_stats.snapshot(),
+            "http": self.http_stats(),
+        }
+
+clients = ClientRegistry()
+
 # --- Helpers ---
 
 def get_real_audio_url(url):
     headers = {"User-Agent": "Mozilla/5.0"}
     try:
-        response = requests.get(url, headers=headers, timeout=10, stream=True)
+        response = clients.http.get(url, headers=headers, timeout=10, stream=True)
         content_type = response.headers.get('Content-Type', '')
         if 'audio' in content_type or url.endswith(('.m4a', '.mp3')):
             return url
@@ -246,6 +983,172 @@ def get_real_audio_url(url):
     except:
         return None
 
+def mp4_requires_seek(head: bytes) -> bool:
+    """根据文件开头判断 MP4/M4A 是否必须随机访问才能解复用（moov 在 mdat 之后或无法确定）"""
+    if len(head) < 8 or head[4:8] != b"ftyp":
+        return False  # 非 MP4 容器（如 mp3），可以直接从管道读取
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b"moov":
+            return False
+        if box_type == b"mdat":
+            return True
+        if size == 1 and offset + 16 <= len(head):
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            return True
+        offset += size
+    return True  # 开头数据中看不到 moov，保守处理
+
+async def iterate_in_thread(iterator):
+    """在线程池中逐块读取同步迭代器（如 requests 的 iter_content），避免阻塞事件循环"""
+    sentinel = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, sentinel)
+        if item is sentinel:
+            return
+        yield item
+
+async def feed_process_stdin(process, chunks, state, should_stop):
+    """把下载数据写入 asyncio 子进程的 stdin，同时计算内容哈希；state["fed_all"] 表示是否完整写入"""
+    state["fed_all"] = False
+    try:
+        async for chunk in iterate_in_thread(chunks):
+            if should_stop():
+                return
+            state["digest"].update(chunk)
+            process.stdin.write(chunk)
+            await process.stdin.drain()
+        state["fed_all"] = True
+    except (BrokenPipeError, ConnectionResetError, OSError) as e:
+        print(f"⚠️  ffmpeg stdin closed early: {e}")
+    except Exception as e:
+        print(f"⚠️  Streaming download interrupted: {e}")
+    finally:
+        try:
+            process.stdin.close()
+        except Exception:
+            pass
+
+async def read_ffmpeg_progress(stream, info: Dict):
+    """解析 ffmpeg -progress 输出（key=value 行），更新 out_time（秒）/ speed（倍率）/ state"""
+    async for raw_line in stream:
+        key, _, value = raw_line.decode(errors="ignore").strip().partition("=")
+        if key in ("out_time_us", "out_time_ms") and value.isdigit():
+            # 两个字段的单位实际上都是微秒
+            info["out_time"] = int(value) / 1_000_000
+        elif key == "speed":
+            try:
+                info["speed"] = float(value.rstrip("x"))
+            except ValueError:
+                pass  # 开始阶段为 N/A
+        elif key == "progress":
+            info["state"] = value
+
+def read_segment_list(list_path: str) -> List[Dict]:
+    """读取 ffmpeg -segment_list_type csv 的输出（每写完一个分片追加一行：文件名,开始秒,结束秒）"""
+    if not os.path.exists(list_path):
+        return []
+    with open(list_path, newline="", encoding="utf-8") as f:
+        content = f.read()
+    # 忽略尚未写完整的最后一行
+    content = content[:content.rfind("\n") + 1]
+    base_dir = os.path.dirname(list_path)
+    entries = []
+    for row in csv.reader(content.splitlines()):
+        if len(row) < 3:
+            continue
+        name = row[0]
+        path = name if os.path.isabs(name) else os.path.join(base_dir, os.path.basename(name))
+        entries.append({"path": path, "start": float(row[1]), "end": float(row[2])})
+    return entries
+
+async def detect_silences(source: str, start: float, length: float) -> List[tuple]:
+    """对 [start, start+length] 区间运行 ffmpeg silencedetect，返回静音区间 [(开始秒, 结束秒)]（绝对时间）"""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-nostats",
+        "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", source,
+        "-af", "silencedetect=noise=-35dB:d=0.4", "-f", "null", "-",
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=60)
+    except asyncio.TimeoutError:
+        await terminate_process(process)
+        return []
+    silences = []
+    silence_start = None
+    # 输入端 -ss 会把时间戳重置为从0开始，这里加回区间起点
+    for line in stderr.decode(errors="ignore").splitlines():
+        match = re.search(r"silence_start: (-?[\d.]+)", line)
+        if match:
+            silence_start = float(match.group(1))
+            continue
+        match = re.search(r"silence_end: (-?[\d.]+)", line)
+        if match and silence_start is not None:
+            silences.append((start + max(0.0, silence_start), start + float(match.group(1))))
+            silence_start = None
+    return silences
+
+async def plan_chunk_boundaries(source: str, duration: float) -> List[float]:
+    """在每个25分钟目标切点附近找最近的静音中点作为切点；找不到静音时退回目标切点"""
+    if duration <= SEGMENT_TARGET_SECONDS + SILENCE_SEARCH_WINDOW:
+        return []
+    targets = []
+    k = 1
+    # 末尾不足一个搜索窗口的尾巴并入上一片，避免产生极短分片
+    while k * SEGMENT_TARGET_SECONDS < duration - SILENCE_SEARCH_WINDOW:
+        targets.append(k * SEGMENT_TARGET_SECONDS)
+        k += 1
+
+    async def pick_cut(target):
+        try:
+            silences = await detect_silences(source, target - SILENCE_SEARCH_WINDOW, 2 * SILENCE_SEARCH_WINDOW)
+        except Exception as e:
+            print(f"⚠️  Silence detection failed near {format_time(target)}: {e}")
+            return float(target)
+        best_cut, best_distance = float(target), None
+        for silence_start, silence_end in silences:
+            midpoint = (silence_start + silence_end) / 2
+            distance = abs(midpoint - target)
+            if distance <= SILENCE_SEARCH_WINDOW and (best_distance is None or distance < best_distance):
+                best_cut, best_distance = midpoint, distance
+        return round(best_cut, 3)
+
+    cuts = await asyncio.gather(*(pick_cut(t) for t in targets))
+    print(f"✓ Planned chunk boundaries: {[format_time(c) for c in cuts]} (targets {[format_time(t) for t in targets]})")
+    return sorted(cuts)
+
+def lookup_episode_duration(*audio_urls) -> int:
+    """从已抓取的小宇宙单集中查找音频时长（秒），找不到返回0"""
+    urls = [u for u in audio_urls if u]
+    if not urls:
+        return 0
+    db = SessionLocal()
+    try:
+        episode = db.query(PodcastEpisode).filter(
+            PodcastEpisode.audio_url.in_(urls),
+            PodcastEpisode.duration > 0
+        ).first()
+        return episode.duration if episode else 0
+    finally:
+        db.close()
+
+async def terminate_process(process, timeout: float = 5):
+    """终止 asyncio 子进程：先 SIGTERM，超时后 SIGKILL"""
+    if process is None or process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+    except ProcessLookupError:
+        pass
+
 # --- 小宇宙爬虫函数 ---
 def extract_xiaoyuzhou_id(url_or_id: str) -> str:
     """从小宇宙URL中提取ID，或直接返回ID"""
@@ -270,7 +1173,7 @@ def fetch_xiaoyuzhou_podcaster_info(podcaster_id: str) -> Dict:
     for domain in domains:
         try:
             page_url = f"{domain}/podcast/{podcaster_id}"
-            response = requests.get(page_url, headers=headers, timeout=15)
+            response = clients.http.get(page_url, headers=headers, timeout=15)
             if response.status_code == 200:
                 html = response.text
                 
@@ -487,7 +1390,7 @@ def get_episode_audio_url(episode_url: str) -> str:
     """获取单集的音频URL"""
     try:
         headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-        response = requests.get(episode_url, headers=headers, timeout=10)
+        response = clients.http.get(episode_url, headers=headers, timeout=10)
         if response.status_code == 200:
             html = response.text
             # 方法1: 从页面JSON数据中提取（最可靠）
@@ -543,7 +1446,7 @@ def get_episode_audio_url(episode_url: str) -> str:
 def fetch_from_rss(rss_url: str, podcaster_id: str) -> Dict:
     """从RSS feed获取播客信息"""
     try:
-        response = requests.get(rss_url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10)
+        response = clients.http.get(rss_url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10)
         if response.status_code == 200:
             root = ET.fromstring(response.text)
             # 解析RSS
@@ -621,7 +1524,9 @@ def add_punctuation_to_segment(client, text):
         return text
     
     try:
-        response = client.chat.completions.create(
+        response = groq_chat(
+            client, PRIORITY_BATCH,
+            cache_version=LLM_PROMPT_VERSIONS["punctuation_segment"],
             model="qwen/qwen3-32b",
             messages=[
                 {"role": "system", "content": "你是标点助手。只输出添加标点后的文本，不要有任何其他内容。"},
@@ -652,19 +1557,23 @@ def add_punctuation_to_segment(client, text):
         if 0.7 * len(text) <= len(result) <= 1.3 * len(text):
             return result
         
+        llm_cache.discard_last()  # 不把被拒的输出留在缓存里，下次重新请求
         return text  # 长度异常，返回原文
     except Exception as e:
         print(f"⚠️ Segment punctuation failed: {e}")
         return text
 
+TRANSCRIBE_MODEL = "whisper-large-v3-turbo"
+
 def transcribe_chunk(client, chunk_file):
-    """转写音频文件，返回带时间戳的转写结果"""
+    """转写音频文件，返回带时间戳的转写结果；重试3次仍失败时返回 None"""
     for _ in range(3):
         try:
             with open(chunk_file, "rb") as file:
-                return client.audio.transcriptions.create(
+                return groq_transcribe(
+                    client,
                     file=(chunk_file, file.read()),
-                    model="whisper-large-v3-turbo",
+                    model=TRANSCRIBE_MODEL,
                     language="zh",
                     response_format="verbose_json",
                     # 注意：Whisper API 已经会自动添加标点符号
@@ -675,8 +1584,8 @@ def transcribe_chunk(client, chunk_file):
             time.sleep(1)
     return None
 
-def add_punctuation_numbered(client, text, expected_lines):
-    """为带编号的文本添加标点符号（格式：【行1】文本）"""
+def add_punctuation_numbered(client, text, expected_lines, require_all=True):
+    """为带编号的文本添加标点符号（格式：【行1】文本）；require_all=False 时缺行也返回结果，由调用方逐行回退"""
     if not text or len(text.strip()) < 10:
         return text
     
@@ -693,7 +1602,9 @@ def add_punctuation_numbered(client, text, expected_lines):
 
 {text}"""
 
-        response = client.chat.completions.create(
+        response = groq_chat(
+            client, PRIORITY_BATCH,
+            cache_version=LLM_PROMPT_VERSIONS["punctuation_numbered"],
             model="qwen/qwen3-32b",
             messages=[
                 {"role": "system", "content": "你是标点符号助手。用户给你带编号的文本（【行N】格式），你添加标点后按原格式输出。禁止输出<think>标签、禁止输出思考过程。必须保留所有【行N】标记。只输出文本本身。"},
@@ -718,9 +1629,11 @@ def add_punctuation_numbered(client, text, expected_lines):
             result = result[first_line_pos:]
         
         # 验证是否包含所有编号
-        for i in range(1, expected_lines + 1):
-            if f"【行{i}】" not in result:
-                print(f"⚠️ Missing line {i} in punctuated result")
+        missing = [i for i in range(1, expected_lines + 1) if f"【行{i}】" not in result]
+        if missing:
+            print(f"⚠️ Missing line(s) {', '.join(map(str, missing[:5]))} in punctuated result")
+            llm_cache.discard_last()  # 缺行的输出不缓存，否则重跑时这些行永远补不上标点
+            if require_all:
                 return text  # 缺少行号，使用原文
         
         return result
@@ -728,6 +1641,61 @@ def add_punctuation_numbered(client, text, expected_lines):
         print(f"⚠️ Failed to add punctuation (numbered): {e}")
         return text
 
+# 分批补标点：按字数预算打包 segment，批次之间并发，进程内所有会话共享并发上限
+PUNCTUATION_BATCH_CHARS = 2000
+PUNCTUATION_BATCH_MAX_LINES = 40
+PUNCTUATION_CONCURRENCY = 4
+punctuation_semaphore = Semaphore(PUNCTUATION_CONCURRENCY)
+
+def punctuate_segment_batch(client, texts: List[str]) -> List[str]:
+    """一次请求为一批 segment 补标点，按【行N】编号映射回去；缺失或长度异常的行保留原文"""
+    numbered = "\n".join(f"【行{i + 1}】{t}" for i, t in enumerate(texts))
+    result = add_punctuation_numbered(client, numbered, len(texts), require_all=False)
+    pieces = {}
+    for match in re.finditer(r'【行(\d+)】(.*?)(?=【行\d+】|\Z)', result, flags=re.DOTALL):
+        pieces[int(match.group(1))] = match.group(2).strip()
+    output = []
+    rejected = 0
+    for i, original in enumerate(texts, 1):
+        candidate = pieces.get(i, "")
+        # 验证长度合理（考虑标点会增加字符）
+        if candidate and 0.7 * len(original) <= len(candidate) <= 1.3 * len(original) + 3:
+            output.append(candidate)
+        else:
+            output.append(original)
+            rejected += 1
+    if rejected and result != numbered:
+        llm_cache.discard_last()  # 有行被拒时整批重新请求，而不是重放同一份输出
+    return output
+
+async def punctuate_segments(client, texts: List[str]) -> List[str]:
+    """把 segment 按字数预算分批并发补标点，返回与输入一一对应的文本"""
+    batches = []
+    current, current_chars = [], 0
+    for idx, segment_text in enumerate(texts):
+        if current and (current_chars + len(segment_text) > PUNCTUATION_BATCH_CHARS or len(current) >= PUNCTUATION_BATCH_MAX_LINES):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(idx)
+        current_chars += len(segment_text)
+    if current:
+        batches.append(current)
+
+    results = list(texts)
+
+    async def run_batch(indices):
+        try:
+            async with punctuation_semaphore:
+                punctuated = await asyncio.to_thread(punctuate_segment_batch, client, [texts[i] for i in indices])
+            for i, punctuated_text in zip(indices, punctuated):
+                results[i] = punctuated_text
+        except Exception as e:
+            print(f"⚠️ Punctuation batch failed ({len(indices)} segments), keeping original: {e}")
+
+    await asyncio.gather(*(run_batch(batch) for batch in batches))
+    print(f"  Punctuation: {len(texts)} segments in {len(batches)} batches")
+    return results
+
 def add_punctuation(client, text):
     """为没有标点符号的文本添加标点符号（优化版：批量处理）"""
     if not text or len(text.strip()) < 10:
@@ -742,7 +1710,9 @@ def add_punctuation(client, text):
 
 {text_to_process}"""
 
-        response = client.chat.completions.create(
+        response = groq_chat(
+            client,
+            cache_version=LLM_PROMPT_VERSIONS["punctuation"],
             model="qwen/qwen3-32b",
             messages=[
                 {"role": "system", "content": "你是标点符号助手。用户给你文本，你直接输出添加标点后的文本。禁止输出<think>标签、禁止输出思考过程、禁止输出任何解释说明。必须保留原文中的所有换行符和 ===LINE=== 分隔符。只输出文本本身，一个字都不要多。"},
@@ -837,16 +1807,19 @@ def add_punctuation(client, text):
         # 检查结果是否合理
         if not result or len(result) < 10:
             print(f"⚠️  Punctuation result too short: {len(result)} chars, using original")
+            llm_cache.discard_last()
             return text
         
         # 检查长度是否合理（考虑标点符号会增加字符）
         if len(result) < len(text) * 0.8 or len(result) > len(text) * 1.3:
             print(f"⚠️  Punctuation result length unusual: {len(result)} vs {len(text)}, using original")
+            llm_cache.discard_last()
             return text
         
         # 检查是否还有明显的垃圾内容
         if '<think>' in result.lower() or '</think>' in result.lower():
             print(f"⚠️  Result still contains <think> tags, using original")
+            llm_cache.discard_last()
             return text
         
         print(f"✓ Punctuation added successfully: {len(text)} → {len(result)} chars")
@@ -855,8 +1828,45 @@ def add_punctuation(client, text):
         print(f"⚠️ Failed to add punctuation: {e}")
         return text  # 失败时返回原文
 
-def format_transcript_with_speakers(client, raw_transcript):
-    """使用AI识别说话人并重新格式化transcript（优化版：分段处理）"""
+# 长文稿说话人识别：首段先跑出角色表，其余分段带着角色表和上一段结尾并发识别，最后按时间戳拼回
+SPEAKER_CHUNK_CHARS = 12000  # qwen3-32b 优化：更大的chunk保持更好的上下文
+SPEAKER_CHUNK_CONCURRENCY = int(os.environ.get("SPEAKER_CHUNK_CONCURRENCY", "4"))  # 实际速率仍由 groq_scheduler 控制
+SPEAKER_CONTEXT_LINES = 6  # 传给下一段的重叠行数
+SPEAKER_LABEL_RE = re.compile(r'^\[[^\]]+\]\s*([^:\[\]]{1,15}):')
+
+def speaker_line_start(line: str) -> Optional[float]:
+    """取 "[mm:ss - mm:ss] ..." 行的起始秒数，没有时间戳时返回 None"""
+    match = re.match(r'^\[(\d{1,2}:\d{2}(?::\d{2})?)\s*-', line.strip())
+    return timestamp_to_seconds(match.group(1)) if match else None
+
+def speaker_roster(labeled_text: str) -> List[str]:
+    """按首次出现顺序收集已标注的角色标签"""
+    roster = []
+    for line in labeled_text.split('\n'):
+        match = SPEAKER_LABEL_RE.match(line.strip())
+        if match and match.group(1).strip() not in roster:
+            roster.append(match.group(1).strip())
+    return roster
+
+def speaker_chunk_context(roster: List[str], previous_tail: List[str]) -> str:
+    parts = ["【上下文（仅供参考，不要输出这些内容）】"]
+    if roster:
+        parts.append(f"前文已识别的说话人：{'、'.join(roster)}。同一个人必须沿用相同的角色标签，只有出现新的说话人时才使用新标签。")
+    if previous_tail:
+        parts.append("上一段的结尾：\n" + '\n'.join(previous_tail))
+    return '\n'.join(parts)
+
+def reassemble_speaker_chunk(processed: str, raw_chunk: str) -> str:
+    """去掉模型回显的上下文行（早于本段起点），再按时间戳稳定排序"""
+    chunk_start = next((t for t in (speaker_line_start(l) for l in raw_chunk.split('\n')) if t is not None), None)
+    lines = [l for l in processed.split('\n') if l.strip()]
+    if chunk_start is not None:
+        lines = [l for l in lines if (speaker_line_start(l) or chunk_start) >= chunk_start]
+    lines.sort(key=lambda l: speaker_line_start(l) or 0.0)
+    return '\n'.join(lines)
+
+def format_transcript_with_speakers(client, raw_transcript, on_progress=None):
+    """使用AI识别说话人并重新格式化transcript（优化版：分段并发处理）；on_progress(已完成分段数, 总分段数)"""
     
     if not raw_transcript or len(raw_transcript.strip()) == 0:
         return raw_transcript
@@ -864,7 +1874,10 @@ def format_transcript_with_speakers(client, raw_transcript):
     # 如果文本较短（<10000字符），直接处理
     if len(raw_transcript) < 10000:
         print(f"Short transcript ({len(raw_transcript)} chars), processing directly...")
-        return _identify_speakers_single(client, raw_transcript)
+        result = _identify_speakers_single(client, raw_transcript)
+        if on_progress:
+            on_progress(1, 1)
+        return result
     
     # 对于长文本，采用分段策略
     print(f"Long transcript detected ({len(raw_transcript)} chars), using chunked processing...")
@@ -874,12 +1887,11 @@ def format_transcript_with_speakers(client, raw_transcript):
     chunks = []
     current_chunk = []
     current_length = 0
-    chunk_size = 12000  # qwen3-32b 优化：更大的chunk保持更好的上下文
     
     for line in lines:
         line_length = len(line)
         # 确保不在时间戳行中间分割
-        if current_length + line_length > chunk_size and current_chunk:
+        if current_length + line_length > SPEAKER_CHUNK_CHARS and current_chunk:
             chunks.append('\n'.join(current_chunk))
             current_chunk = [line]
             current_length = line_length
@@ -892,34 +1904,54 @@ def format_transcript_with_speakers(client, raw_transcript):
     
     print(f"Split into {len(chunks)} chunks (avg {sum(len(c) for c in chunks)//len(chunks)} chars/chunk)")
     
-    # 处理每个块
-    processed_chunks = []
+    processed_chunks: List[Optional[str]] = [None] * len(chunks)
     failed_chunks = 0
-    
-    for i, chunk in enumerate(chunks):
+
+    def process(i, context=None):
+        chunk = chunks[i]
         try:
             print(f"Processing chunk {i+1}/{len(chunks)} ({len(chunk)} chars)...")
-            processed = _identify_speakers_single(client, chunk, timeout=45)  # 增加超时时间
+            processed = _identify_speakers_single(client, chunk, timeout=45, context=context)  # 增加超时时间
             
             # 验证输出格式是否正确
             if '[' in processed and ':' in processed:
-                processed_chunks.append(processed)
                 print(f"✓ Chunk {i+1} completed successfully")
-            else:
-                print(f"⚠ Chunk {i+1} output format invalid, using original")
-                processed_chunks.append(chunk)
-                failed_chunks += 1
-                
+                return reassemble_speaker_chunk(processed, chunk), True
+            print(f"⚠ Chunk {i+1} output format invalid, using original")
+            llm_cache.discard_last()
         except Exception as e:
             error_msg = str(e)
             if '401' in error_msg or 'Invalid API Key' in error_msg or 'invalid_api_key' in error_msg:
                 print(f"✗ Chunk {i+1} failed: API Key invalid!")
                 raise Exception("Groq API Key is invalid or expired. Please check your API key configuration.")
             print(f"✗ Chunk {i+1} failed: {e}, using original")
-            processed_chunks.append(chunk)
-            failed_chunks += 1
+        return chunk, False
+
+    # 第一段单独处理，得到角色表后再并发处理其余分段
+    processed_chunks[0], ok = process(0)
+    failed_chunks += 0 if ok else 1
+    if on_progress:
+        on_progress(1, len(chunks))
+    roster = speaker_roster(processed_chunks[0]) if ok else []
+    if roster:
+        print(f"Speaker roster from chunk 1: {', '.join(roster)}")
+
+    def context_for(i):
+        # 第二段直接用第一段已标注的结尾，其余用上一段原文结尾
+        previous = processed_chunks[0] if i == 1 else chunks[i - 1]
+        tail = [l for l in previous.split('\n') if l.strip()][-SPEAKER_CONTEXT_LINES:]
+        return speaker_chunk_context(roster, tail)
+
+    if len(chunks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SPEAKER_CHUNK_CONCURRENCY) as executor:
+            futures = {executor.submit(process, i, context_for(i)): i for i in range(1, len(chunks))}
+            for future in concurrent.futures.as_completed(futures):
+                processed_chunks[futures[future]], ok = future.result()
+                failed_chunks += 0 if ok else 1
+                if on_progress:
+                    on_progress(len(chunks) - sum(1 for c in processed_chunks if c is None), len(chunks))
     
-    result = '\n\n'.join(processed_chunks)  # 用双换行分隔块
+    result = '\n\n'.join(processed_chunks)  # 用双换行分隔块（分段本身即按时间顺序）
     print(f"Completed: {len(chunks)-failed_chunks}/{len(chunks)} chunks successful")
     
     # 如果所有块都失败了，抛出错误
@@ -934,8 +1966,8 @@ def format_transcript_with_speakers(client, raw_transcript):
     
     return result
 
-def _identify_speakers_single(client, transcript_text, timeout=35):
-    """单次说话人识别（带超时）- 使用qwen3-32b模型"""
+def _identify_speakers_single(client, transcript_text, timeout=35, context=None):
+    """单次说话人识别（带超时）- 使用qwen3-32b模型；context 为分段处理时附带的角色表和上文"""
     
     # 限制输入长度
     max_input = 10000
@@ -1084,11 +2116,13 @@ def _identify_speakers_single(client, transcript_text, timeout=35):
 直接输出结果，不要输出思考过程、不要使用<think>标签、不要添加任何解释。严格按[时间] 角色: 内容格式输出。"""
     
     try:
-        response = client.chat.completions.create(
+        response = groq_chat(
+            client,
+            cache_version=LLM_PROMPT_VERSIONS["speakers"],
             model="qwen/qwen3-32b",
             messages=[
                 {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt.format(transcript=input_text)}
+                {"role": "user", "content": (f"{context}\n\n" if context else "") + prompt.format(transcript=input_text)}
             ],
             temperature=0.2,
             max_tokens=12000,
@@ -1155,9 +2189,642 @@ def _identify_speakers_single(client, transcript_text, timeout=35):
         
     except Exception as e:
         print(f"✗ Identification failed: {str(e)[:100]}")
+        llm_cache.discard_last()
         raise Exception(f"Speaker identification error: {str(e)}")
 
-def generate_summary_json(client, transcript):
+# 长文稿分层总结（map-reduce）：超过阈值时按时间戳对齐的话题边界切段，各段并发总结后再合并为同一结构
+SUMMARY_MAP_REDUCE_CHARS = int(os.environ.get("SUMMARY_MAP_REDUCE_CHARS", "40000"))  # 约 2 小时以上的节目
+SUMMARY_SECTION_CHARS = int(os.environ.get("SUMMARY_SECTION_CHARS", "15000"))  # 每段目标长度
+SUMMARY_MAP_CONCURRENCY = 4
+# 出现在段首时通常意味着换话题
+TOPIC_SHIFT_MARKERS = ('接下来', '下一个', '下一个问题', '我们聊聊', '我们来聊', '换个话题', '另外一个', '另一个话题', '回到', '说到', '最后', '那我们', '好，', '好的，', 'OK')
+TRANSCRIPT_LINE_RE = re.compile(r'^\[(\d{1,2}:\d{2}(?::\d{2})?) - (\d{1,2}:\d{2}(?::\d{2})?)\]\s*(.*)$')
+
+def timestamp_to_seconds(value: str) -> float:
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def split_transcript_sections(transcript: str, target_chars: int) -> List[Dict]:
+    """按段落行切分文稿，每段约 target_chars 字；在目标位置前后 25% 范围内挑最像话题转换的行首切开
+    （段首有转场用语、与上一段之间停顿较长）。返回 [{"text", "scope"}]"""
+    lines = [line for line in transcript.split("\n") if line.strip()]
+    parsed = []
+    for line in lines:
+        match = TRANSCRIPT_LINE_RE.match(line)
+        if match:
+            parsed.append((timestamp_to_seconds(match.group(1)), timestamp_to_seconds(match.group(2)), match.group(3), line))
+        else:
+            parsed.append((None, None, line, line))
+
+    def boundary_score(i):
+        start, _, body, _ = parsed[i]
+        previous_end = parsed[i - 1][1]
+        gap = start - previous_end if start is not None and previous_end is not None else 0.0
+        return (2.0 if body.startswith(TOPIC_SHIFT_MARKERS) else 0.0) + min(gap, 10.0) / 5.0
+
+    sections = []
+    section_start = 0
+    while section_start < len(parsed):
+        size = 0
+        window = []
+        i = section_start
+        while i < len(parsed) and size < target_chars * 1.25:
+            size += len(parsed[i][3]) + 1
+            i += 1
+            if size >= target_chars * 0.75 and i < len(parsed):
+                window.append(i)
+        if i >= len(parsed) and size < target_chars * 1.25:
+            cut = len(parsed)
+        else:
+            # 分数相同时选离目标长度最近的
+            cut = max(window, key=lambda j: (boundary_score(j), -abs(sum(len(p[3]) + 1 for p in parsed[section_start:j]) - target_chars))) if window else i
+        chunk = parsed[section_start:cut]
+        starts = [p[0] for p in chunk if p[0] is not None]
+        ends = [p[1] for p in chunk if p[1] is not None]
+        sections.append({
+            "text": "\n".join(p[3] for p in chunk),
+            "scope": f"[{format_time(min(starts))} - {format_time(max(ends))}]" if starts and ends else "",
+        })
+        section_start = cut
+    return sections
+
+def clean_json_response(raw_content: str) -> str:
+    """去掉 markdown 代码块标记、BOM，以及第一个 { 之前和最后一个 } 之后的内容"""
+    raw_content = raw_content.strip()
+    if raw_content.startswith("```json"):
+        raw_content = raw_content[7:]
+    elif raw_content.startswith("```"):
+        raw_content = raw_content[3:]
+    if raw_content.endswith("```"):
+        raw_content = raw_content[:-3]
+    raw_content = raw_content.strip().lstrip('\ufeff')
+    first_brace = raw_content.find('{')
+    last_brace = raw_content.rfind('}')
+    if first_brace == -1 or last_brace <= first_brace:
+        raise ValueError(f"模型输出不是完整的JSON，内容前200字符: {raw_content[:200]}")
+    return raw_content[first_brace:last_brace + 1]
+
+def summarize_section(client, section: Dict, index: int, total: int, refresh: bool = False) -> Dict:
+    """map：总结文稿的一段，输出与最终结构相同的部分字段（时间范围为原文中的绝对时间）"""
+    prompt = f"""以下是一期播客文字稿的第 {index + 1}/{total} 部分（时间范围 {section['scope']}）。请只针对这一部分做深度精读笔记，输出纯JSON，不要任何其他文字或markdown标记。
+
+【规则】
+1. 所有时间使用文字稿中的原始时间，格式 [mm:ss - mm:ss]，覆盖该内容从开始讨论到结束讨论的完整时间段。
+2. 禁止脑补，只写这一部分实际讨论的内容，使用简体中文。
+3. cases 中每个案例要完整叙述背景、经过、细节、结果或启示（150-300字），这一部分出现的案例全部列出。
+4. 字符串中的引号必须转义（\\"）。
+
+【输出结构】
+{{
+    "sectionSummary": "这一部分讨论了什么（150-300字）",
+    "participants": "这一部分中出现的 Host/Guest 身份信息，没有则为空字符串",
+    "coreConclusions": [{{"role": "Guest观点 / Host总结 / 双方共识 / 争议未决", "point": "核心结论", "basis": "依据与理由（详实）", "source": "[mm:ss - mm:ss]"}}],
+    "topicBlocks": [{{"title": "主题模块标题", "scope": "[mm:ss - mm:ss]", "coreView": "核心观点总结（2-4句深度解析，含金句或原话摘录）"}}],
+    "concepts": [{{"term": "关键概念", "definition": "通俗定义", "source": "Host/Guest", "context": "支撑哪条结论", "timestamp": "[mm:ss - mm:ss]"}}],
+    "cases": [{{"story": "完整案例叙述", "provesPoint": "用来证明哪个观点", "source": "[mm:ss - mm:ss]"}}]
+}}
+
+---
+文字稿（第 {index + 1}/{total} 部分）：
+{section['text']}"""
+    last_error = None
+    for attempt in range(2):
+        try:
+            response = groq_chat(
+                client,
+                cache_version=LLM_PROMPT_VERSIONS["summary_map"],
+                cache_refresh=refresh,
+                model="openai/gpt-oss-120b",
+                messages=[
+                    {"role": "system", "content": "你是一个只输出 JSON 的 API，为播客文字稿的一部分生成详尽的精读笔记。所有时间范围使用[mm:ss - mm:ss]格式。"},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.4,
+                max_tokens=6144
+            )
+            if not response or not response.choices:
+                raise Exception("Groq返回空响应")
+            result = json.loads(clean_json_response(response.choices[0].message.content or ""))
+            print(f"✓ Section {index + 1}/{total} summarized {section['scope']}: {len(result.get('coreConclusions', []))} conclusions, {len(result.get('cases', []))} cases")
+            return result
+        except Exception as e:
+            last_error = e
+            llm_cache.discard_last()
+            print(f"⚠️  Section {index + 1}/{total} summary attempt {attempt + 1} failed: {e}")
+    raise Exception(f"第 {index + 1} 部分总结失败: {last_error}")
+
+def merge_section_lists(section_results: List[Dict], field: str, key: str) -> List[Dict]:
+    """按 key 去重合并各段的列表（保留先出现的条目，顺序即时间顺序）"""
+    merged, seen = [], set()
+    for result in section_results:
+        for item in result.get(field) or []:
+            if not isinstance(item, dict):
+                continue
+            marker = str(item.get(key, "")).strip()[:40]
+            if marker and marker in seen:
+                continue
+            seen.add(marker)
+            merged.append(item)
+    return merged
+
+def reduce_section_summaries(client, sections: List[Dict], section_results: List[Dict], refresh: bool = False, on_event=None) -> Dict:
+    """reduce：根据各段笔记生成全局字段（标题、概览、核心结论、主题模块、建议、批判性审视）；
+    传入 on_event 时流式生成，字段/数组元素完整时回调"""
+    notes = [
+        {
+            "scope": section["scope"],
+            "sectionSummary": result.get("sectionSummary", ""),
+            "participants": result.get("participants", ""),
+            "coreConclusions": result.get("coreConclusions", []),
+            "topicBlocks": result.get("topicBlocks", []),
+        }
+        for section, result in zip(sections, section_results) if result
+    ]
+    prompt = f"""以下是一期长播客按时间顺序分段整理的精读笔记（JSON）。请把它们合并成全局的深度学习笔记，输出纯JSON，不要任何其他文字或markdown标记。
+
+【规则】
+1. 覆盖所有部分，不要偏重开头，后半部分的重要观点同样要保留。
+2. 合并重复或相近的结论和主题，保留原有的时间范围（跨段的主题可合并为更大的时间范围）。
+3. 禁止引入笔记中没有的信息，使用简体中文，字符串中的引号必须转义（\\"）。
+
+【输出结构】
+{{
+    "title": "播客标题 (精准概括)",
+    "overview": {{
+        "type": "访谈/圆桌/独白",
+        "participants": "Host与Guest身份背景",
+        "coreIssue": "核心议题与冲突 (2-3句)",
+        "summary": "一页纸概览：包含核心议题、适合人群、对话类型。请写成一段通顺的深度摘要 (300字以上)。"
+    }},
+    "coreConclusions": [{{"role": "...", "point": "...", "basis": "...", "source": "[mm:ss - mm:ss]"}}],
+    "topicBlocks": [{{"title": "...", "scope": "[mm:ss - mm:ss]", "coreView": "..."}}],
+    "actionableAdvice": ["可落地行动建议"],
+    "criticalReview": "谬误/局限性检查：以批判性思维审视全期内容。"
+}}
+
+---
+分段笔记：
+{json.dumps(notes, ensure_ascii=False)}"""
+    request = dict(
+        cache_version=LLM_PROMPT_VERSIONS["summary_reduce"],
+        cache_refresh=refresh,
+        model="openai/gpt-oss-120b",
+        messages=[
+            {"role": "system", "content": "你是一个只输出 JSON 的 API，负责把分段笔记合并为完整、详尽的全局笔记。所有时间范围使用[mm:ss - mm:ss]格式。"},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        max_tokens=8192
+    )
+    if on_event is not None:
+        content = stream_chat_content(client, on_event, **request)
+    else:
+        response = groq_chat(client, **request)
+        if not response or not response.choices:
+            raise Exception("Groq返回空响应")
+        content = response.choices[0].message.content or ""
+    try:
+        return json.loads(clean_json_response(content))
+    except ValueError:
+        llm_cache.discard_last()
+        raise
+
+def emit_summary_fields(on_event, data: Dict, keys):
+    """把不是流式生成的字段按流式事件的形式回调：数组逐个元素，其余整字段"""
+    if on_event is None:
+        return
+    for key in keys:
+        value = data.get(key)
+        if isinstance(value, list):
+            for index, item in enumerate(value):
+                on_event(("item", key, index, item))
+        elif value is not None:
+            on_event(("field", key, value))
+
+def map_section_summaries(client, sections: List[Dict], refresh: bool = False) -> List[Optional[Dict]]:
+    """map：并发总结各段，失败的段为 None"""
+    section_results: List[Optional[Dict]] = [None] * len(sections)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SUMMARY_MAP_CONCURRENCY) as executor:
+        futures = {executor.submit(summarize_section, client, section, i, len(sections), refresh): i for i, section in enumerate(sections)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                section_results[futures[future]] = future.result()
+            except Exception as e:
+                print(f"✗ {e}")
+    return section_results
+
+def add_failed_section_blocks(result: Dict, failed_scopes: List[str]):
+    """为总结失败的分段在主题模块末尾补上提示条目"""
+    for scope in failed_scopes:
+        result.setdefault("topicBlocks", []).append({
+            "title": "⚠️ 该部分总结失败",
+            "scope": scope,
+            "coreView": "这一时间段的分段总结多次失败，未纳入本笔记，可点击'重新生成总结'重试。",
+        })
+
+def generate_summary_map_reduce(client, transcript: str, refresh: bool = False, on_event=None) -> Optional[Dict]:
+    """长文稿的分层总结；切分后只有一段时返回 None，由调用方走单次总结。refresh 时不读 LLM 缓存。
+    传入 on_event 时 reduce 步骤流式生成，合并得到的概念/案例在最后一并回调"""
+    sections = split_transcript_sections(transcript, SUMMARY_SECTION_CHARS)
+    if len(sections) < 2:
+        return None
+    started = time.time()
+    print(f"🎯 Map-reduce summary: {len(transcript)} chars in {len(sections)} sections ({', '.join(s['scope'] for s in sections)})")
+
+    section_results = map_section_summaries(client, sections, refresh)
+    failed = [sections[i]["scope"] for i, result in enumerate(section_results) if result is None]
+    succeeded = [result for result in section_results if result]
+    if not succeeded:
+        raise Exception("所有分段总结均失败")
+
+    try:
+        result = reduce_section_summaries(client, sections, section_results, refresh, on_event=on_event)
+    except Exception as e:
+        # reduce 失败时直接拼接分段笔记，仍然返回完整结构而不是错误占位
+        print(f"⚠️  Reduce step failed ({e}), assembling summary from section notes")
+        result = {
+            "title": (succeeded[0].get("topicBlocks") or [{}])[0].get("title", "播客精读笔记"),
+            "overview": {
+                "type": "无法确定",
+                "participants": next((r.get("participants") for r in succeeded if r.get("participants")), "无法确定"),
+                "coreIssue": "无法确定",
+                "summary": "\n\n".join(f"{s['scope']} {r.get('sectionSummary', '')}" for s, r in zip(sections, section_results) if r),
+            },
+            "coreConclusions": merge_section_lists(succeeded, "coreConclusions", "point"),
+            "topicBlocks": merge_section_lists(succeeded, "topicBlocks", "title"),
+            "actionableAdvice": [],
+            "criticalReview": "无法确定",
+        }
+        emit_summary_fields(on_event, result, list(result))
+
+    # 概念和案例直接合并各段结果，避免 reduce 输出过长被截断，也避免案例被二次压缩
+    result["concepts"] = merge_section_lists(succeeded, "concepts", "term")
+    result["cases"] = merge_section_lists(succeeded, "cases", "story")
+    emit_summary_fields(on_event, result, ("concepts", "cases"))
+    add_failed_section_blocks(result, failed)
+    print(f"✓ Map-reduce summary done in {time.time() - started:.1f}s ({len(succeeded)}/{len(sections)} sections, {len(result['cases'])} cases)")
+    return result
+
+# 分部分并行生成总结：每个部分单独请求、单独校验、失败单独重试，一个部分的JSON错误不再导致整份总结作废
+SUMMARY_PARALLEL_SECTIONS = os.environ.get("SUMMARY_PARALLEL_SECTIONS", "0") == "1"  # 每个部分都要发送全文，输入token约为单次调用的7倍
+SUMMARY_SECTION_RETRIES = 2
+
+SUMMARY_COMMON_RULES = """【硬性规则】
+1. 只输出纯JSON对象，不要包含```json等markdown标记或任何解释。
+2. 所有时间使用完整时间范围格式 [mm:ss - mm:ss]，覆盖该内容从开始讨论到结束讨论（转到下一个话题之前）的完整时间段，不要只标注某一句话的时间点。
+3. 禁止脑补，未提及内容标注"无法确定"。内容要详实、有深度，不要流水账。使用简体中文。
+4. 字符串中的引号必须转义（\\"）。"""
+
+# 部分名 -> 输出结构示例、要求、max_tokens、校验规则（顶层字段 -> 类型 / 列表元素必需的键）
+SUMMARY_SECTION_SPECS = {
+    "overview": {
+        "shape": '{"title": "播客标题 (精准概括)", "overview": {"type": "访谈/圆桌/独白", "participants": "Host与Guest身份背景 (带出处)", "coreIssue": "核心议题与冲突 (2-3句)", "summary": "一页纸概览：包含核心议题、适合人群、对话类型，写成一段通顺的深度摘要 (300字以上)"}}',
+        "instructions": "基于全文（不要遗漏后半部分）写出标题和概览。",
+        "max_tokens": 2048,
+        "schema": {"title": str, "overview": ("type", "participants", "coreIssue", "summary")},
+    },
+    "coreConclusions": {
+        "shape": '{"coreConclusions": [{"role": "Guest观点 / Host总结 / 双方共识 / 争议未决", "point": "核心结论", "basis": "依据与理由 (来自文字稿，详实)", "source": "[mm:ss - mm:ss]"}]}',
+        "instructions": "提取全文的核心结论，每条都要有充分的论据。",
+        "max_tokens": 4096,
+        "schema": {"coreConclusions": ["point", "basis", "source"]},
+    },
+    "topicBlocks": {
+        "shape": '{"topicBlocks": [{"title": "主题模块标题", "scope": "[mm:ss - mm:ss]", "coreView": "核心观点总结 (2-4句深度解析，包含精彩金句或原话摘录)"}]}',
+        "instructions": "按时间顺序划分主题模块，覆盖全文。",
+        "max_tokens": 4096,
+        "schema": {"topicBlocks": ["title", "scope", "coreView"]},
+    },
+    "concepts": {
+        "shape": '{"concepts": [{"term": "关键概念/行业黑话", "definition": "通俗定义 (结合语境解释)", "source": "Host/Guest", "context": "解决了什么解释任务/支撑哪条结论", "timestamp": "[mm:ss - mm:ss]"}]}',
+        "instructions": "提取节目中解释过的关键概念和行业术语。",
+        "max_tokens": 3072,
+        "schema": {"concepts": ["term", "definition"]},
+    },
+    "cases": {
+        "shape": '{"cases": [{"story": "案例/故事/比喻的完整叙述", "provesPoint": "用来证明哪个观点", "source": "[mm:ss - mm:ss]"}]}',
+        "instructions": "提取所有案例、故事、例子和比喻，每个单独列出不要合并。每个案例必须完整叙述背景、具体经过、关键人物/事件细节、转折点、最终结果或启示，至少150-300字。没有明确案例时数组可以为空。",
+        "max_tokens": 6144,
+        "schema": {"cases": ["story", "provesPoint", "source"]},
+    },
+    "actionableAdvice": {
+        "shape": '{"actionableAdvice": ["可落地行动建议 (迁移到工作/生活，具体详细)"]}',
+        "instructions": "给出可落地的行动建议。",
+        "max_tokens": 1536,
+        "schema": {"actionableAdvice": [str]},
+    },
+    "criticalReview": {
+        "shape": '{"criticalReview": "谬误/局限性检查"}',
+        "instructions": "以批判性思维审视：是否存在幸存者偏差、特定背景限制或逻辑跳跃？无情指出同意与反对之处。",
+        "max_tokens": 1536,
+        "schema": {"criticalReview": str},
+    },
+}
+
+def validate_summary_section(name: str, data) -> Dict:
+    """按 SUMMARY_SECTION_SPECS 校验一个部分的输出，返回该部分的字段；不合格时抛出 ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("输出不是JSON对象")
+    fields = {}
+    for field, rule in SUMMARY_SECTION_SPECS[name]["schema"].items():
+        value = data.get(field)
+        if rule is str:
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError(f"{field} 应为非空字符串")
+        elif isinstance(rule, tuple):
+            if not isinstance(value, dict) or any(not isinstance(value.get(key), str) for key in rule):
+                raise ValueError(f"{field} 应包含字符串字段 {', '.join(rule)}")
+        elif rule == [str]:
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ValueError(f"{field} 应为字符串数组")
+        else:
+            if not isinstance(value, list):
+                raise ValueError(f"{field} 应为数组")
+            for item in value:
+                if not isinstance(item, dict) or any(not isinstance(item.get(key), str) for key in rule):
+                    raise ValueError(f"{field} 的元素应包含字符串字段 {', '.join(rule)}")
+        fields[field] = value
+    return fields
+
+def generate_summary_section(client, transcript: str, name: str, refresh: bool = False) -> Dict:
+    """生成总结的一个部分，校验失败或请求失败时只重试这一部分"""
+    spec = SUMMARY_SECTION_SPECS[name]
+    prompt = f"""你是"研究型播客精读师 + 知识管理专家"，正在为播客文字稿制作深度学习笔记中的【{name}】部分。
+{spec['instructions']}
+
+{SUMMARY_COMMON_RULES}
+
+【输出结构】
+{spec['shape']}
+
+---
+文字稿：
+{transcript}"""
+    last_error = None
+    for attempt in range(SUMMARY_SECTION_RETRIES + 1):
+        try:
+            response = groq_chat(
+                client,
+                cache_version=LLM_PROMPT_VERSIONS["summary_section"],
+                cache_refresh=refresh,
+                model="openai/gpt-oss-120b",
+                messages=[
+                    {"role": "system", "content": "你是一个只输出 JSON 的 API。你必须生成非常详尽、深度的内容，绝对禁止简短的概括。所有时间范围必须使用[mm:ss - mm:ss]格式。"},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.4,
+                max_tokens=spec["max_tokens"]
+            )
+            if not response or not response.choices:
+                raise ValueError("Groq返回空响应")
+            return validate_summary_section(name, json.loads(clean_json_response(response.choices[0].message.content or "")))
+        except Exception as e:
+            last_error = e
+            llm_cache.discard_last()
+            print(f"⚠️  Summary section '{name}' attempt {attempt + 1}/{SUMMARY_SECTION_RETRIES + 1} failed: {e}")
+    raise Exception(f"{name}: {last_error}")
+
+def generate_summary_sections(client, transcript: str, sections: Optional[List[str]] = None, existing: Optional[Dict] = None, on_event=None, refresh: bool = False) -> Dict:
+    """并行生成指定部分（默认全部），合并进 existing；失败的部分保留原有内容并记录在 failedSections。
+    on_event 与 generate_summary_json 相同，每个部分完成时回调其字段"""
+    sections = sections or list(SUMMARY_SECTION_SPECS)
+    summary = dict(existing or {})
+    started = time.time()
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SUMMARY_MAP_CONCURRENCY) as executor:
+        futures = {executor.submit(generate_summary_section, client, transcript, name, refresh): name for name in sections}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                fields = future.result()
+                summary.update(fields)
+                if on_event:
+                    for field, value in fields.items():
+                        if isinstance(value, list):
+                            for index, item in enumerate(value):
+                                on_event(("item", field, index, item))
+                        else:
+                            on_event(("field", field, value))
+            except Exception as e:
+                print(f"✗ Summary section failed: {e}")
+                failed.append(name)
+    if len(failed) == len(sections) and not existing:
+        raise Exception(f"所有总结部分均生成失败: {', '.join(failed)}")
+    # 全新生成时为失败的部分补上空结构，保证前端字段完整
+    defaults = {"title": "播客精读笔记", "overview": {"type": "无法确定", "participants": "无法确定", "coreIssue": "无法确定", "summary": "概览生成失败，可点击'重新生成总结'重试。"},
+                "coreConclusions": [], "topicBlocks": [], "concepts": [], "cases": [], "actionableAdvice": [], "criticalReview": "无法确定"}
+    for field, value in defaults.items():
+        summary.setdefault(field, value)
+    previous_failed = [name for name in summary.get("failedSections", []) if name not in sections]
+    if previous_failed or failed:
+        summary["failedSections"] = previous_failed + sorted(failed)
+    else:
+        summary.pop("failedSections", None)
+    print(f"✓ Section summary: {len(sections) - len(failed)}/{len(sections)} sections in {time.time() - started:.1f}s" + (f", failed: {', '.join(failed)}" if failed else ""))
+    return summary
+
+# 长文稿中直接由分段笔记合并、不经过 reduce 的部分
+MAP_MERGED_SECTIONS = {"concepts": "term", "cases": "story"}
+
+def regenerate_map_reduce_sections(client, transcript: str, sections: List[str], existing: Dict) -> Optional[Dict]:
+    """长文稿只重新生成指定部分：分段笔记优先用 LLM 缓存（只补跑未命中的段），reduce 产出的部分只重跑一次 reduce；
+    概念/案例由分段笔记合并而来，只有重新生成它们时才刷新分段总结。切分后只有一段时返回 None"""
+    chunks = split_transcript_sections(transcript, SUMMARY_SECTION_CHARS)
+    if len(chunks) < 2:
+        return None
+    started = time.time()
+    reduce_sections = [name for name in sections if name not in MAP_MERGED_SECTIONS]
+    merged_sections = [name for name in sections if name in MAP_MERGED_SECTIONS]
+    section_results = map_section_summaries(client, chunks, refresh=bool(merged_sections))
+    succeeded = [result for result in section_results if result]
+    if not succeeded:
+        raise Exception("所有分段总结均失败")
+
+    summary = dict(existing)
+    failed = []
+    for name in merged_sections:
+        summary[name] = merge_section_lists(succeeded, name, MAP_MERGED_SECTIONS[name])
+    if reduce_sections:
+        try:
+            fresh = reduce_section_summaries(client, chunks, section_results, refresh=True)
+            if "topicBlocks" in reduce_sections:
+                add_failed_section_blocks(fresh, [chunks[i]["scope"] for i, result in enumerate(section_results) if result is None])
+            for name in reduce_sections:
+                for field in SUMMARY_SECTION_SPECS[name]["schema"]:
+                    summary[field] = fresh.get(field, summary.get(field))
+        except Exception as e:
+            print(f"✗ Reduce step failed while regenerating {', '.join(reduce_sections)}: {e}")
+            failed = reduce_sections  # 保留原有内容
+    previous_failed = [name for name in summary.get("failedSections", []) if name not in sections]
+    if previous_failed or failed:
+        summary["failedSections"] = previous_failed + sorted(failed)
+    else:
+        summary.pop("failedSections", None)
+    print(f"✓ Regenerated {', '.join(sections)} for a {len(chunks)}-section transcript in {time.time() - started:.1f}s")
+    return summary
+
+def regenerate_summary_sections(client, transcript: str, sections: List[str], existing: Dict) -> Dict:
+    """只重新生成指定部分，其余部分保持不变（不读 LLM 缓存，新结果覆盖缓存）"""
+    if len(transcript) > SUMMARY_MAP_REDUCE_CHARS:
+        # 长文稿单次请求可能超出上下文：复用分段笔记，只重做需要的 reduce / 合并
+        summary = regenerate_map_reduce_sections(client, transcript, sections, existing)
+        if summary is not None:
+            return summary
+    return generate_summary_sections(client, transcript, sections, existing, refresh=True)
+
+class IncrementalJSONFields:
+    """增量解析流式输出的 JSON 对象：顶层的非数组字段完整时产出 ("field", key, value)，
+    顶层数组的每个元素完整时产出 ("item", key, index, value)。第一个 { 之前的内容（如 ```json）会被忽略"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.stack = []  # 未闭合的 { / [
+        self.in_string = False
+        self.escape = False
+        self.awaiting = None  # 顶层对象中下一个期待的是 "key" / "colon" / "value"
+        self.token_start = None  # 顶层键字符串的起点
+        self.key = None
+        self.value_start = None  # 顶层值的起点
+        self.item_start = None  # 顶层数组当前元素的起点
+        self.item_index = 0
+        self.done = False
+
+    def in_top_array(self) -> bool:
+        return len(self.stack) == 2 and self.stack[1] == "["
+
+    def finish_field(self, end: int):
+        raw, self.value_start = self.buffer[self.value_start:end], None
+        if raw.lstrip().startswith("["):
+            return None  # 数组已逐个元素产出
+        try:
+            return ("field", self.key, json.loads(raw))
+        except json.JSONDecodeError:
+            return None
+
+    def finish_item(self, end: int):
+        raw, self.item_start = self.buffer[self.item_start:end], None
+        index = self.item_index
+        self.item_index += 1
+        try:
+            return ("item", self.key, index, json.loads(raw))
+        except json.JSONDecodeError:
+            return None
+
+    def feed(self, text: str) -> List[tuple]:
+        events = []
+        start = len(self.buffer)
+        self.buffer += text
+        buf = self.buffer
+        for i in range(start, len(buf)):
+            if self.done:
+                break
+            ch = buf[i]
+            depth = len(self.stack)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if depth == 1 and self.awaiting == "key":
+                        self.key = json.loads(buf[self.token_start:i + 1])
+                        self.item_index = 0
+                        self.awaiting = "colon"
+                    elif depth == 1 and self.value_start is not None:
+                        events.append(self.finish_field(i + 1))
+                    elif self.in_top_array() and self.item_start is not None:
+                        events.append(self.finish_item(i + 1))
+                continue
+            if ch.isspace():
+                continue
+            if depth == 0:
+                if ch == "{":
+                    self.stack.append(ch)
+                    self.awaiting = "key"
+                continue
+            # 数字 / true / false / null 在遇到分隔符时结束
+            if ch in ",}]":
+                if depth == 1 and self.value_start is not None and ch != "]":
+                    events.append(self.finish_field(i))
+                elif self.in_top_array() and self.item_start is not None and ch != "}":
+                    events.append(self.finish_item(i))
+            if ch == '"':
+                self.in_string = True
+                if depth == 1 and self.awaiting == "key":
+                    self.token_start = i
+                elif depth == 1 and self.awaiting == "value":
+                    self.value_start, self.awaiting = i, None
+                elif self.in_top_array() and self.item_start is None:
+                    self.item_start = i
+            elif ch in "{[":
+                if depth == 1 and self.awaiting == "value":
+                    self.value_start, self.awaiting = i, None
+                elif self.in_top_array() and self.item_start is None:
+                    self.item_start = i
+                self.stack.append(ch)
+            elif ch in "}]":
+                self.stack.pop()
+                if not self.stack:
+                    self.done = True
+                elif len(self.stack) == 1 and self.value_start is not None:
+                    events.append(self.finish_field(i + 1))
+                elif self.in_top_array() and self.item_start is not None:
+                    events.append(self.finish_item(i + 1))
+            elif ch == ":":
+                if depth == 1:
+                    self.awaiting = "value"
+            elif ch == ",":
+                if depth == 1:
+                    self.awaiting = "key"
+            elif depth == 1 and self.awaiting == "value":
+                self.value_start, self.awaiting = i, None
+            elif self.in_top_array() and self.item_start is None:
+                self.item_start = i
+        return [event for event in events if event]
+
+def stream_chat_content(client, on_event, cache_version: Optional[str] = None, cache_refresh: bool = False, **kwargs) -> str:
+    """流式请求 chat completion，边接收边增量解析 JSON 并回调 on_event，返回完整输出文本。
+    LLM 缓存命中时把缓存文本一次性交给解析器，回调的事件与流式时相同"""
+    cached = llm_cache.get(cache_version, kwargs) if cache_version and not cache_refresh else None
+    stream = [cached] if cached is not None else (
+        chunk.choices[0].delta.content for chunk in groq_chat(client, stream=True, **kwargs) if chunk.choices
+    )
+    parser = IncrementalJSONFields()
+    parts = []
+    for delta in stream:
+        if not delta:
+            continue
+        parts.append(delta)
+        for event in parser.feed(delta):
+            try:
+                on_event(event)
+            except Exception as e:
+                print(f"⚠️  Summary stream callback failed: {e}")
+    content = "".join(parts)
+    if cache_version and cached is None:
+        llm_cache.put(cache_version, kwargs, content)
+    return content
+
+def generate_summary_json(client, transcript, on_event=None, refresh=False):
+    """生成结构化总结；传入 on_event 时流式生成，每个完整的顶层字段/数组元素回调一次（最终结果不受影响）。
+    refresh=True（重新生成）时不读 LLM 缓存"""
+    # 超长文稿走分层总结：单次 prompt 既慢又可能超出上下文，且容易遗漏后半部分、输出被截断
+    if len(transcript) > SUMMARY_MAP_REDUCE_CHARS:
+        try:
+            result = generate_summary_map_reduce(client, transcript, refresh, on_event=on_event)
+            if result is not None:
+                return result
+        except Exception as e:
+            print(f"⚠️  Map-reduce summary failed ({e}), falling back to single-pass summary")
+    elif SUMMARY_PARALLEL_SECTIONS:
+        try:
+            return generate_summary_sections(client, transcript, on_event=on_event, refresh=refresh)
+        except Exception as e:
+            print(f"⚠️  Section summary failed ({e}), falling back to single-pass summary")
+    
     prompt = """【重要】你必须只输出纯JSON格式，不要包含任何其他文字、解释或markdown标记。
 
 你是一位"研究型播客精读师 + 知识管理专家"。目标是将播客文字稿转成可反复复习的【深度长篇学习笔记】。
@@ -1271,7 +2938,7 @@ def generate_summary_json(client, transcript):
 
 {prompt.format(transcript=transcript)}"""
         
-        response = client.chat.completions.create(
+        request_kwargs = dict(
             model="openai/gpt-oss-120b",
             messages=[
                 {"role": "system", "content": "你是一个只输出 JSON 的 API。你必须生成非常详尽、深度的内容，绝对禁止简短的概括。重要：所有时间范围必须使用[mm:ss - mm:ss]格式，覆盖该话题/案例/结论从开始讨论到结束讨论的完整时间段，不要只标注某一句话的时间点。"},
@@ -1281,54 +2948,30 @@ def generate_summary_json(client, transcript):
             max_tokens=8192
         )
         
-        # 验证Groq响应
-        if not response or not response.choices or len(response.choices) == 0:
-            raise Exception("Groq返回空响应")
-        
-        # 获取Groq输出并清理
-        raw_content = response.choices[0].message.content.strip()
+        if on_event is not None:
+            # 流式生成：字段一完整就推送给前端，完整文本仍走下面同样的清理和解析
+            raw_content = stream_chat_content(client, on_event, cache_version=LLM_PROMPT_VERSIONS["summary"], cache_refresh=refresh, **request_kwargs).strip()
+            if not raw_content:
+                raise Exception("Groq返回空响应")
+        else:
+            response = groq_chat(client, cache_version=LLM_PROMPT_VERSIONS["summary"], cache_refresh=refresh, **request_kwargs)
+            
+            # 验证Groq响应
+            if not response or not response.choices or len(response.choices) == 0:
+                raise Exception("Groq返回空响应")
+            
+            # 获取Groq输出并清理
+            raw_content = response.choices[0].message.content.strip()
         print(f"✓ GPT-OSS-120B返回内容长度: {len(raw_content)} 字符")
         print(f"✓ GPT-OSS-120B返回前100字符: {raw_content[:100]}")
         print(f"✓ GPT-OSS-120B返回后100字符: {raw_content[-100:]}")
         
-        # 清理可能的markdown代码块标记
-        if raw_content.startswith("```json"):
-            raw_content = raw_content[7:]  # 移除 ```json
-            print("✓ 移除了开头的 ```json 标记")
-        elif raw_content.startswith("```"):
-            raw_content = raw_content[3:]  # 移除 ```
-            print("✓ 移除了开头的 ``` 标记")
-        
-        if raw_content.endswith("```"):
-            raw_content = raw_content[:-3]  # 移除结尾的 ```
-            print("✓ 移除了结尾的 ``` 标记")
-        
-        raw_content = raw_content.strip()
-        
-        # 移除可能的BOM标记
-        raw_content = raw_content.lstrip('\ufeff')
-        
-        # 检查是否是有效的JSON开头
-        if not raw_content.startswith('{'):
-            print(f"⚠ 警告：内容不是以 {{ 开头，前200字符: {raw_content[:200]}")
-            # 尝试找到第一个 { 并从那里开始
-            first_brace = raw_content.find('{')
-            if first_brace > 0:
-                print(f"✓ 找到第一个 {{ 在位置 {first_brace}，裁剪前面的内容")
-                raw_content = raw_content[first_brace:]
-            else:
-                raise Exception(f"模型输出不是JSON格式，内容前200字符: {raw_content[:200]}")
-        
-        # 检查是否是有效的JSON结尾
-        if not raw_content.endswith('}'):
-            print(f"⚠ 警告：内容不是以 }} 结尾，后200字符: {raw_content[-200:]}")
-            # 尝试找到最后一个 } 并到那里结束
-            last_brace = raw_content.rfind('}')
-            if last_brace > 0:
-                print(f"✓ 找到最后一个 }} 在位置 {last_brace}，裁剪后面的内容")
-                raw_content = raw_content[:last_brace+1]
-            else:
-                raise Exception(f"模型输出不完整，内容后200字符: {raw_content[-200:]}")
+        # 清理markdown代码块标记、BOM以及JSON前后的多余内容
+        try:
+            raw_content = clean_json_response(raw_content)
+        except ValueError as e:
+            llm_cache.discard_last()
+            raise Exception(str(e))
         
         # 解析JSON
         try:
@@ -1339,6 +2982,7 @@ def generate_summary_json(client, transcript):
             print(f"❌ 错误位置: line {json_err.lineno}, column {json_err.colno}")
             print(f"❌ 原始内容前500字符: {raw_content[:500]}")
             print(f"❌ 原始内容后500字符: {raw_content[-500:]}")
+            llm_cache.discard_last()
             # 直接抛出，让外层处理
             raise
         
@@ -1407,158 +3051,1084 @@ def generate_summary_json(client, transcript):
             "criticalReview": f"技术错误 ({error_type}): {error_msg}。请检查后端日志。"
         }
 
-# --- Core Logic ---
+# --- Analysis Cache ---
 
-async def process_audio_logic(source_type: str, user_id: Optional[int], url: str = None, file_path: str = None, session_id: str = "", request = None):
-    # 获取客户端标识（优先使用 user_id，否则使用 session_id）
-    client_id = f"user_{user_id}" if user_id else f"session_{session_id}"
-    
-    print(f"📥 New request: {session_id[:8]} (client: {client_id})")
-    
-    # 检查是否有正在进行的任务，如果有则标记为取消
-    if client_id in active_transcriptions:
-        old_session = active_transcriptions[client_id]
-        # 重要：保存旧任务的引用，因为我们即将覆盖它
-        old_session_id = old_session["session_id"]
-        old_session["cancelled"] = True
-        print(f"⚠️  Marking old transcription as cancelled: {old_session_id[:8]}")
-        # 清理旧任务的临时文件
-        try:
-            old_temp_pattern = os.path.join(TEMP_DIR, f"{old_session_id}*")
-            import glob
-            for old_file in glob.glob(old_temp_pattern):
-                try:
-                    os.remove(old_file)
-                    print(f"   ✓ Removed old temp file: {os.path.basename(old_file)}")
-                except:
-                    pass
-        except Exception as e:
-            print(f"   ⚠️  Failed to cleanup old session files: {e}")
-    
-    # 注册当前任务
-    active_transcriptions[client_id] = {
-        "session_id": session_id,
-        "cancelled": False,
-        "start_time": time.time()
-    }
-    print(f"✓ Registered new task: {session_id[:8]}")
-    
-    # 并发限流：等待可用槽位
-    await transcription_semaphore.acquire()
-    print(f"🎯 Starting transcription for session {session_id[:8]}... (client: {client_id})")
-    
-    client = Groq(api_key=GROQ_API_KEY)
-    temp_base = os.path.join(TEMP_DIR, session_id)
-    temp_source = ""
-    audio_url_to_save = None  # 用于查重的原始URL
-    chunk_paths = []  # 初始化，避免 finally 块中引用错误
-    ffmpeg_process = None  # 保存 FFmpeg 进程引用，用于断开时终止
-    
-    # 用于检查任务是否被取消的辅助函数
-    def is_task_cancelled():
-        task_info = active_transcriptions.get(client_id, {})
-        # 只有当 session_id 匹配且被标记为取消时才返回 True
-        if task_info.get("session_id") == session_id and task_info.get("cancelled", False):
-            return True
-        return False
-    
+# 命中统计（进程级，重启清零；持久的命中次数见 AnalysisCache.hit_count）
+analysis_cache_stats = {"lookups": 0, "hits": 0, "source_url_hits": 0, "url_hits": 0, "content_hits": 0}
+
+# 这些查询参数只用于追踪来源，不影响音频内容
+TRACKING_QUERY_PARAMS = {"utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "from", "share_source", "s"}
+
+def normalize_audio_url(url: Optional[str]) -> Optional[str]:
+    """规范化URL用作缓存键：统一大小写、去掉默认端口/片段/追踪参数、排序查询参数"""
+    if not url:
+        return None
     try:
-        # 检查点 1: 开始下载前
-        if is_task_cancelled():
-            print(f"⚠️  Task cancelled before download: {session_id[:8]}")
-            yield f"data: {json.dumps({'stage': 'error', 'msg': 'Task cancelled - new analysis started'})}\n\n"
-            return
-        
-        yield f"data: {json.dumps({'stage': 'downloading', 'percent': 10, 'msg': 'Downloading audio...'})}\n\n"
-        
-        if source_type == "url":
-            real_url = get_real_audio_url(url)
-            if not real_url:
-                raise Exception("Invalid URL")
-            
-            audio_url_to_save = real_url
-            yield f"data: {json.dumps({'stage': 'resolved_url', 'url': real_url})}\n\n"
-            
-            temp_source = f"{temp_base}.m4a"
-            with requests.get(real_url, stream=True) as r:
-                r.raise_for_status()
-                with open(temp_source, 'wb') as f:
-                    for chunk in r.iter_content(1024*1024):
-                        # 检查点 2: 下载过程中
-                        if is_task_cancelled():
-                            print(f"⚠️  Task cancelled during download: {session_id[:8]}")
-                            return
-                        f.write(chunk)
-        else:
-            temp_source = file_path 
-            if not os.path.exists(temp_source):
-                 raise Exception("File upload failed")
-            audio_url_to_save = f"file://{os.path.basename(file_path)}"
+        from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").lower()
+        if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+            host = f"{host}:{parts.port}"
+        path = parts.path.rstrip("/") or "/"
+        query = urlencode(sorted(
+            (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+            if k.lower() not in TRACKING_QUERY_PARAMS
+        ))
+        return urlunsplit((scheme, host, path, query, ""))
+    except Exception:
+        return url.strip()
+
+def hash_file(path: str) -> str:
+    """计算文件内容的 sha256（分块读取，避免大文件占用内存）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def is_cacheable_result(result_payload: Dict) -> bool:
+    """只缓存成功的分析结果（总结失败时的占位结果不缓存）"""
+    summary = result_payload.get("summary") or {}
+    overview = summary.get("overview") or {}
+    if result_payload.get("failed_spans"):
+        return False  # 有分片转写失败的结果不共享，下次分析时补转
+    if summary.get("failedSections"):
+        return False  # 部分总结失败的结果不共享
+    return bool(result_payload.get("transcript")) and overview.get("type") != "Error"
+
+def lookup_analysis_cache(source_url: Optional[str] = None, url: Optional[str] = None, content_hash: Optional[str] = None):
+    """按 提交URL → 真实URL → 内容哈希 的顺序查找缓存，返回 (AnalysisCache id, 命中方式)"""
+    candidates = [
+        ("source_url", AnalysisCache.source_url_key, normalize_audio_url(source_url)),
+        ("url", AnalysisCache.url_key, normalize_audio_url(url)),
+        ("content", AnalysisCache.content_hash, content_hash),
+    ]
+    db = SessionLocal()
+    try:
+        for kind, column, key in candidates:
+            if not key:
+                continue
+            entry = db.query(AnalysisCache).filter(column == key).order_by(AnalysisCache.id.desc()).first()
+            if entry:
+                return entry.id, kind
+        return None, None
+    finally:
+        db.close()
+
+def store_analysis_cache(result_payload: Dict, source_url: Optional[str], url: Optional[str], content_hash: Optional[str]) -> Optional[int]:
+    """保存一次完整分析的结果，返回缓存条目 id"""
+    if not is_cacheable_result(result_payload):
+        print("⚠ Result not cacheable (summary failed or empty transcript)")
+        return None
+    db = SessionLocal()
+    try:
+        entry = AnalysisCache(
+            source_url_key=normalize_audio_url(source_url),
+            url_key=normalize_audio_url(url),
+            content_hash=content_hash,
+            audio_url=url,
+            title=(result_payload.get("summary") or {}).get("title", "New Analysis"),
+            data_json=json.dumps(result_payload),
+        )
+        db.add(entry)
+        db.commit()
+        print(f"✓ Stored analysis cache entry #{entry.id}")
+        return entry.id
+    except Exception as e:
+        print(f"✗ Failed to store analysis cache: {e}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+def serve_cached_analysis(cache_id: int, hit_kind: str, user_id: Optional[int], audio_url: Optional[str] = None, source_url: Optional[str] = None, content_hash: Optional[str] = None, history_id: Optional[int] = None):
+    """命中缓存：为当前用户建立指向共享结果的历史记录，返回 (completed 事件内容, 播放用音频URL)；
+    history_id 为重试任务上次写入的记录，此时改为用缓存结果覆盖这条记录"""
+    db = SessionLocal()
+    try:
+        entry = db.query(AnalysisCache).filter(AnalysisCache.id == cache_id).first()
+        if not entry:
+            return None, None
+        entry.hit_count = (entry.hit_count or 0) + 1
+        entry.last_hit_at = datetime.utcnow()
+        # 补全缺失的键，使后续请求可以更早命中
+        if source_url and not entry.source_url_key:
+            entry.source_url_key = normalize_audio_url(source_url)
+        if content_hash and not entry.content_hash:
+            entry.content_hash = content_hash
+        if not audio_url:
+            audio_url = entry.audio_url
+        elif not entry.url_key and not audio_url.startswith("file://"):
+            entry.url_key = normalize_audio_url(audio_url)
+            entry.audio_url = audio_url
+
+        result_payload = json.loads(entry.data_json)
+        if user_id is not None:
+            history_item = db.query(HistoryItem).filter(
+                HistoryItem.user_id == user_id,
+                HistoryItem.analysis_cache_id == entry.id
+            ).first()
+            if not history_item:
+                if history_id is not None:
+                    # 重试任务：覆盖上次带失败占位行的记录，文稿变了，旧的说话人版本作废
+                    history_item = db.query(HistoryItem).filter(HistoryItem.id == history_id, HistoryItem.user_id == user_id).first()
+                if history_item:
+                    history_item.title = entry.title
+                    history_item.audio_url = audio_url
+                    history_item.data_json = entry.data_json
+                    history_item.analysis_cache_id = entry.id
+                    history_item.speaker_transcript = None
+                    for field, value in history_index_fields(result_payload).items():
+                        setattr(history_item, field, value)
+                else:
+                    history_item = HistoryItem(
+                        user_id=user_id,
+                        title=entry.title,
+                        audio_url=audio_url,
+                        data_json=entry.data_json,
+                        analysis_cache_id=entry.id,
+                        **history_index_fields(result_payload)
+                    )
+                    db.add(history_item)
+                    db.flush()
+                store_transcript_segments(db, history_item.id, result_payload.get("transcript", ""))
+                index_history_search(db, history_item.id, user_id, result_payload)
+                print(f"✓ {'Replaced' if history_item.id == history_id else 'Created'} history item #{history_item.id} from cache #{entry.id} for user {user_id}")
+        db.commit()
+        if user_id is not None:
+            result_payload["history_id"] = history_item.id
+
+        analysis_cache_stats["hits"] += 1
+        analysis_cache_stats[f"{hit_kind}_hits"] += 1
+        result_payload["cached"] = True
+        return result_payload, audio_url
+    except Exception as e:
+        print(f"✗ Failed to serve cached analysis #{cache_id}: {e}")
+        db.rollback()
+        return None, None
+    finally:
+        db.close()
+
+# --- Transcript Segments ---
+# 文稿按行拆成 transcript_segments（起止秒数、文本、可选说话人），供分页接口按播放位置懒加载；
+# data_json 中的完整 transcript 仍然保留。旧记录在第一次请求分页接口时补建
+TRANSCRIPT_PAGE_DEFAULT = 200
+TRANSCRIPT_PAGE_MAX = 1000
+
+def parse_transcript_segments(transcript: str) -> List[Dict]:
+    """把 "[mm:ss - mm:ss] 文本" 行解析为 [{start, end, text}]；没有时间戳的行并入上一段"""
+    segments = []
+    for line in (transcript or "").split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        match = TRANSCRIPT_LINE_RE.match(line)
+        if match:
+            segments.append({
+                "start": timestamp_to_seconds(match.group(1)),
+                "end": timestamp_to_seconds(match.group(2)),
+                "text": match.group(3).strip(),
+            })
+        elif segments:
+            segments[-1]["text"] += "\n" + line
+    return segments
+
+def speaker_spans(speaker_transcript: Optional[str]) -> List[tuple]:
+    """说话人版本文稿中的 (起始秒, 结束秒, 角色)，按起始时间排序"""
+    spans = []
+    for segment in parse_transcript_segments(speaker_transcript or ""):
+        match = re.match(r'^([^:\[\]]{1,15}):', segment["text"])
+        if match:
+            spans.append((segment["start"], segment["end"], match.group(1).strip()))
+    spans.sort()
+    return spans
+
+def speaker_at(spans: List[tuple], starts: List[float], seconds: float) -> Optional[str]:
+    """起始时间落在哪个说话人区间内（说话人版本会合并相邻行，区间比原始分段长）"""
+    index = bisect.bisect_right(starts, seconds + 0.01) - 1
+    if index >= 0 and seconds <= spans[index][1] + 0.01:
+        return spans[index][2]
+    return None
+
+def store_transcript_segments(db: Session, history_id: int, transcript: str, speaker_transcript: Optional[str] = None) -> int:
+    """重建某条历史记录的分段（调用方负责 commit），返回分段数"""
+    db.query(TranscriptSegment).filter(TranscriptSegment.history_id == history_id).delete(synchronize_session=False)
+    spans = speaker_spans(speaker_transcript)
+    starts = [span[0] for span in spans]
+    segments = parse_transcript_segments(transcript)
+    db.bulk_save_objects([
+        TranscriptSegment(
+            history_id=history_id, position=position, start_time=segment["start"], end_time=segment["end"],
+            text=segment["text"], speaker=speaker_at(spans, starts, segment["start"]) if spans else None
+        )
+        for position, segment in enumerate(segments)
+    ])
+    return len(segments)
+
+def assign_segment_speakers(db: Session, history_id: int, speaker_transcript: str):
+    """说话人识别完成后回填已有分段的 speaker（调用方负责 commit）"""
+    spans = speaker_spans(speaker_transcript)
+    starts = [span[0] for span in spans]
+    for segment in db.query(TranscriptSegment).filter(TranscriptSegment.history_id == history_id).all():
+        segment.speaker = speaker_at(spans, starts, segment.start_time)
+
+def ensure_transcript_segments(db: Session, item: HistoryItem) -> int:
+    """返回分段数；旧记录还没有分段时从 data_json 补建"""
+    count = db.query(TranscriptSegment).filter(TranscriptSegment.history_id == item.id).count()
+    if count:
+        return count
+    try:
+        transcript = json.loads(item.data_json or "{}").get("transcript", "")
+    except json.JSONDecodeError:
+        return 0
+    count = store_transcript_segments(db, item.id, transcript, item.speaker_transcript)
+    db.commit()
+    if count:
+        print(f"✓ Backfilled {count} transcript segments for history {item.id}")
+    return count
+
+# --- History Index ---
+# 历史列表只读 HistoryItem 上的冗余列（标题、类型、时长、摘要开头），按 (created_at, id) 做 keyset 分页
+HISTORY_SNIPPET_CHARS = 120
+HISTORY_PAGE_MAX = 200
+HISTORY_BACKFILL_BATCH = 100
+
+def transcript_duration(transcript: str) -> Optional[int]:
+    for line in reversed((transcript or "").split("\n")):
+        match = TRANSCRIPT_LINE_RE.match(line.strip())
+        if match:
+            return int(timestamp_to_seconds(match.group(2)))
+    return None
+
+def history_index_fields(payload: Dict) -> Dict:
+    """从分析结果中提取列表页需要的字段，写入/更新 data_json 时一起设置"""
+    summary = payload.get("summary") if isinstance(payload.get("summary"), dict) else {}
+    overview = summary.get("overview") if isinstance(summary.get("overview"), dict) else {}
+    snippet = " ".join(str(overview.get("summary") or "").split())[:HISTORY_SNIPPET_CHARS]
+    return {
+        "summary_type": overview.get("type") or "Podcast",
+        "duration_seconds": transcript_duration(payload.get("transcript", "")),
+        "snippet": snippet or None,
+    }
+
+def parse_history_cursor(before: str) -> tuple:
+    """解析 "<created_at ISO>,<id>" 形式的游标"""
+    try:
+        created_at, item_id = before.rsplit(",", 1)
+        return datetime.fromisoformat(created_at), int(item_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor, expected before=<created_at>,<id>")
+
+def backfill_history_index():
+    """为加列之前的旧记录补齐冗余字段（分批读取 data_json，只在启动时跑一次）"""
+    db = SessionLocal()
+    try:
+        pending = [item_id for (item_id,) in db.query(HistoryItem.id).filter(HistoryItem.summary_type.is_(None)).all()]
+        for start in range(0, len(pending), HISTORY_BACKFILL_BATCH):
+            batch = db.query(HistoryItem).filter(HistoryItem.id.in_(pending[start:start + HISTORY_BACKFILL_BATCH])).all()
+            for item in batch:
+                try:
+                    fields = history_index_fields(json.loads(item.data_json) if item.data_json else {})
+                except json.JSONDecodeError:
+                    fields = {"summary_type": "Podcast", "duration_seconds": None, "snippet": None}
+                for name, value in fields.items():
+                    setattr(item, name, value)
+            db.commit()
+            db.expunge_all()
+        if pending:
+            print(f"✓ Backfilled list fields for {len(pending)} history items")
+    except Exception as e:
+        print(f"⚠️  History index backfill failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+# --- Full-Text Search ---
+# SQLite FTS5 索引覆盖文稿分段、核心结论、主题模块、概念和案例。unicode61 不会切分中文，
+# 写入和查询时都把连续的 CJK 字符展开为重叠的二元组（"播客精读" -> "播客 客精 精读 读"，末字单独再记一次，
+# 单字查询 "读"* 才能命中段尾的字），查询词作为短语匹配。
+# owner / history 两列存 "u<用户ID>" / "h<记录ID>" 词元，按用户过滤和按记录删除都走索引
+SEARCH_PAGE_MAX = 50
+SEARCH_SNIPPET_CHARS = 80
+SEARCH_INDEX_BATCH = 50
+SEARCH_INDEX_VERSION = 2  # 分词方式变化时递增，启动时清空索引并由 backfill_search_index 重建
+CJK_RUN_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+TIME_RANGE_RE = re.compile(r'\[(\d{1,2}:\d{2}(?::\d{2})?)\s*-\s*(\d{1,2}:\d{2}(?::\d{2})?)\]')
+# 总结中参与索引的条目：字段 -> (正文使用的键, 时间范围所在的键)
+SEARCH_SUMMARY_FIELDS = {
+    "coreConclusions": (("point", "basis"), "source"),
+    "topicBlocks": (("title", "coreView"), "scope"),
+    "concepts": (("term", "definition", "context"), "timestamp"),
+    "cases": (("story", "provesPoint"), "source"),
+}
+
+def ensure_search_index() -> bool:
+    """建立 FTS5 虚表；SQLite 未编译 FTS5 时返回 False，搜索功能整体停用"""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                "content, owner, history, history_id UNINDEXED, kind UNINDEXED, "
+                "start_time UNINDEXED, end_time UNINDEXED, body UNINDEXED, tokenize='unicode61')"
+            ))
+            conn.execute(text("CREATE TABLE IF NOT EXISTS search_index_meta (version INTEGER NOT NULL)"))
+            version = conn.execute(text("SELECT version FROM search_index_meta")).scalar()
+            if version != SEARCH_INDEX_VERSION:
+                conn.execute(text("DELETE FROM search_index"))
+                conn.execute(text("DELETE FROM search_index_meta"))
+                conn.execute(text("INSERT INTO search_index_meta (version) VALUES (:version)"), {"version": SEARCH_INDEX_VERSION})
+                if version is not None:
+                    print(f"✓ Search index format changed (v{version} -> v{SEARCH_INDEX_VERSION}), rebuilding")
+        return True
+    except Exception as e:
+        print(f"⚠️  FTS5 unavailable, search disabled: {e}")
+        return False
+
+SEARCH_AVAILABLE = ensure_search_index()
+
+def cjk_bigrams(value: str) -> str:
+    def expand(match):
+        run = match.group(0)
+        if len(run) == 1:
+            return f" {run} "
+        return " " + " ".join(run[i:i + 2] for i in range(len(run) - 1)) + " "
+    return CJK_RUN_RE.sub(expand, value or "")
+
+def search_content(value: str, query: bool = False) -> str:
+    """FTS 索引和查询用的文本：在 cjk_bigrams 的基础上为每段 CJK 补上末字的单字词元。
+    query 时位于查询词末尾的一段不补（文档中这段可能还没结束，补了短语就对不上）"""
+    value = value or ""
+
+    def expand(match):
+        run = match.group(0)
+        if len(run) == 1:
+            return f" {run} "
+        tokens = [run[i:i + 2] for i in range(len(run) - 1)]
+        if not (query and match.end() == len(value)):
+            tokens.append(run[-1])
+        return " " + " ".join(tokens) + " "
+    return CJK_RUN_RE.sub(expand, value)
+
+def search_match_expression(query: str, user_id: int) -> Optional[str]:
+    """把用户输入转换成 FTS5 表达式：空白分隔的每个词是一个短语，词之间为 AND"""
+    phrases = []
+    for term in query.split():
+        tokens = re.findall(r'\w+', search_content(term, query=True))
+        if not tokens:
+            continue
+        if len(tokens) == 1 and CJK_RUN_RE.fullmatch(tokens[0]) and len(tokens[0]) == 1:
+            phrases.append(f'content:"{tokens[0]}"*')  # 单个汉字：匹配以它开头的二元组和段尾的单字
+        else:
+            phrases.append('content:"' + " ".join(tokens) + '"')
+    if not phrases:
+        return None
+    return f"owner:u{user_id} AND " + " AND ".join(phrases)
+
+def search_entries(payload: Dict, include_segments: bool = True) -> List[Dict]:
+    """从分析结果中提取要索引的条目 [{kind, start, end, body}]"""
+    entries = []
+    if include_segments:
+        for segment in parse_transcript_segments(payload.get("transcript", "")):
+            entries.append({"kind": "segment", "start": segment["start"], "end": segment["end"], "body": segment["text"]})
+    summary = payload.get("summary") if isinstance(payload.get("summary"), dict) else {}
+    for field, (text_keys, range_key) in SEARCH_SUMMARY_FIELDS.items():
+        for item in summary.get(field) or []:
+            if not isinstance(item, dict):
+                continue
+            body = " ".join(str(item.get(key) or "").strip() for key in text_keys).strip()
+            if not body:
+                continue
+            match = TIME_RANGE_RE.search(str(item.get(range_key) or ""))
+            entries.append({
+                "kind": field,
+                "start": timestamp_to_seconds(match.group(1)) if match else None,
+                "end": timestamp_to_seconds(match.group(2)) if match else None,
+                "body": body,
+            })
+    return entries
+
+def remove_from_search_index(db: Session, history_id: int, kinds: Optional[List[str]] = None):
+    """删除某条记录的索引条目（kinds 为空时全部删除）；调用方负责 commit"""
+    if not SEARCH_AVAILABLE:
+        return
+    params = {"match": f"history:h{history_id}"}
+    condition = ""
+    if kinds is not None:
+        if not kinds:
+            return
+        params.update({f"kind{i}": kind for i, kind in enumerate(kinds)})
+        condition = " AND kind IN (" + ", ".join(f":kind{i}" for i in range(len(kinds))) + ")"
+    db.execute(text(
+        "DELETE FROM search_index WHERE rowid IN (SELECT rowid FROM search_index WHERE search_index MATCH :match)" + condition
+    ), params)
+
+def index_history_search(db: Session, history_id: int, user_id: int, payload: Dict, summary_only: bool = False):
+    """（重新）索引一条历史记录；summary_only 时只替换总结条目（重新生成总结后文稿不变）。调用方负责 commit"""
+    if not SEARCH_AVAILABLE:
+        return
+    remove_from_search_index(db, history_id, list(SEARCH_SUMMARY_FIELDS) if summary_only else None)
+    rows = [
+        {
+            "content": search_content(entry["body"]), "owner": f"u{user_id}", "history": f"h{history_id}",
+            "history_id": history_id, "kind": entry["kind"], "start_time": entry["start"], "end_time": entry["end"], "body": entry["body"],
+        }
+        for entry in search_entries(payload, include_segments=not summary_only)
+    ]
+    if rows:
+        db.execute(text(
+            "INSERT INTO search_index (content, owner, history, history_id, kind, start_time, end_time, body) "
+            "VALUES (:content, :owner, :history, :history_id, :kind, :start_time, :end_time, :body)"
+        ), rows)
+
+def backfill_search_index():
+    """为尚未建立索引的历史记录补建（启动时运行）"""
+    if not SEARCH_AVAILABLE:
+        return
+    db = SessionLocal()
+    try:
+        indexed = {row[0] for row in db.execute(text("SELECT DISTINCT history_id FROM search_index")).fetchall()}
+        pending = [item_id for (item_id,) in db.query(HistoryItem.id).all() if item_id not in indexed]
+        for start in range(0, len(pending), SEARCH_INDEX_BATCH):
+            for item in db.query(HistoryItem).filter(HistoryItem.id.in_(pending[start:start + SEARCH_INDEX_BATCH])).all():
+                try:
+                    payload = json.loads(item.data_json) if item.data_json else {}
+                except json.JSONDecodeError:
+                    continue
+                index_history_search(db, item.id, item.user_id, payload)
+            db.commit()
+            db.expunge_all()
+        if pending:
+            print(f"✓ Built search index for {len(pending)} history items")
+    except Exception as e:
+        print(f"⚠️  Search index backfill failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+def highlight_snippet(body: str, terms: List[str]) -> str:
+    """在原文中截取第一个命中词附近的片段，命中词用 <mark> 包裹（其余内容做 HTML 转义）"""
+    lowered = body.lower()
+    positions = [(lowered.find(term.lower()), term) for term in terms]
+    positions = [(pos, term) for pos, term in positions if pos >= 0]
+    first = min(pos for pos, _ in positions) if positions else 0
+    start = max(0, first - SEARCH_SNIPPET_CHARS // 3)
+    end = min(len(body), start + SEARCH_SNIPPET_CHARS)
+    window = body[start:end]
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE) if terms else None
+    parts, last = [], 0
+    for match in (pattern.finditer(window) if pattern else []):
+        parts.append(html.escape(window[last:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group(0))}</mark>")
+        last = match.end()
+    parts.append(html.escape(window[last:]))
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(body) else "")
+
+# --- Chat Retrieval ---
+# 对话时按问题从完整文稿中检索相关分段：每份文稿建一个 BM25 索引（分词同全文搜索，中文按二元组），
+# 按文稿内容哈希存为 data/rag_index/<hash>.json，进程内再保留最近用过的若干个，检索本身只需几毫秒
+RAG_INDEX_DIR = os.path.join("data", "rag_index")
+RAG_INDEX_VERSION = 1  # 分词或索引格式变化时递增，旧文件自动重建
+RAG_MEMORY_ENTRIES = 32
+RAG_DISK_MAX_FILES = 500
+CHAT_RETRIEVAL_TOP_K = 8
+CHAT_RETRIEVAL_BUDGET_CHARS = 6000  # 检索片段总长度上限（约 4k tokens）
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+def retrieval_tokens(value: str) -> List[str]:
+    return re.findall(r'\w+', cjk_bigrams(value).lower())
+
+class TranscriptRetriever:
+    """单份文稿的 BM25 倒排索引"""
+
+    def __init__(self, segments: List[Dict], postings: Dict[str, List], doc_lengths: List[int]):
+        self.segments = segments
+        self.postings = postings  # term -> [[分段序号, 词频], ...]
+        self.doc_lengths = doc_lengths
+        self.avg_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+
+    @classmethod
+    def build(cls, transcript: str) -> "TranscriptRetriever":
+        segments = parse_transcript_segments(transcript)
+        postings: Dict[str, List] = {}
+        doc_lengths = []
+        for index, segment in enumerate(segments):
+            counts = collections.Counter(retrieval_tokens(segment["text"]))
+            doc_lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                postings.setdefault(term, []).append([index, count])
+        return cls(segments, postings, doc_lengths)
+
+    def to_dict(self) -> Dict:
+        return {"version": RAG_INDEX_VERSION, "segments": self.segments, "postings": self.postings, "doc_lengths": self.doc_lengths}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> Optional["TranscriptRetriever"]:
+        if data.get("version") != RAG_INDEX_VERSION:
+            return None
+        return cls(data["segments"], data["postings"], data["doc_lengths"])
+
+    def search(self, question: str, top_k: int = CHAT_RETRIEVAL_TOP_K, budget_chars: int = CHAT_RETRIEVAL_BUDGET_CHARS) -> List[Dict]:
+        """返回得分最高、总长度不超过预算的分段，按时间顺序排列"""
+        total = len(self.segments)
+        scores: Dict[int, float] = collections.defaultdict(float)
+        for term in set(retrieval_tokens(question)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, count in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[index] / (self.avg_length or 1))
+                scores[index] += idf * count * (BM25_K1 + 1) / (count + norm)
+        selected, used = [], 0
+        for index, score in heapq.nlargest(top_k * 2, scores.items(), key=lambda item: item[1]):
+            length = len(self.segments[index]["text"])
+            if used + length > budget_chars:
+                continue
+            selected.append({**self.segments[index], "score": round(score, 3)})
+            used += length
+            if len(selected) >= top_k:
+                break
+        return sorted(selected, key=lambda segment: segment["start"])
+
+class RetrieverCache:
+    """内存 LRU + 磁盘 JSON 两级缓存；key 为文稿内容的 sha256"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memory: "collections.OrderedDict[str, TranscriptRetriever]" = collections.OrderedDict()
+        self._history_keys: Dict[int, str] = {}  # history_id -> 文稿哈希，避免每次都读 data_json
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "builds": 0}
+
+    def _remember(self, key: str, retriever: TranscriptRetriever):
+        with self._lock:
+            self._memory[key] = retriever
+            self._memory.move_to_end(key)
+            while len(self._memory) > RAG_MEMORY_ENTRIES:
+                self._memory.popitem(last=False)
+
+    def _from_memory(self, key: str) -> Optional[TranscriptRetriever]:
+        with self._lock:
+            retriever = self._memory.get(key)
+            if retriever is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+            return retriever
+
+    def for_transcript(self, transcript: str) -> TranscriptRetriever:
+        key = hashlib.sha256(transcript.encode("utf-8")).hexdigest()
+        retriever = self._from_memory(key)
+        if retriever is not None:
+            return retriever
+        path = os.path.join(RAG_INDEX_DIR, f"{key}.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                retriever = TranscriptRetriever.from_dict(json.load(f))
+            if retriever is not None:
+                os.utime(path)  # 按访问时间淘汰
+                self.stats["disk_hits"] += 1
+        except (OSError, ValueError, KeyError):
+            retriever = None
+        if retriever is None:
+            started = time.perf_counter()
+            retriever = TranscriptRetriever.build(transcript)
+            self.stats["builds"] += 1
+            self._write(path, retriever)
+            print(f"✓ Built retrieval index: {len(retriever.segments)} segments, {len(retriever.postings)} terms in {(time.perf_counter() - started) * 1000:.0f} ms")
+        self._remember(key, retriever)
+        return retriever
+
+    def for_history(self, item: HistoryItem) -> Optional[TranscriptRetriever]:
+        key = self._history_keys.get(item.id)
+        retriever = self._from_memory(key) if key else None
+        if retriever is not None:
+            return retriever
+        try:
+            transcript = json.loads(item.data_json or "{}").get("transcript", "")
+        except json.JSONDecodeError:
+            return None
+        if not transcript:
+            return None
+        self._history_keys[item.id] = hashlib.sha256(transcript.encode("utf-8")).hexdigest()
+        return self.for_transcript(transcript)
+
+    def forget_history(self, history_id: int):
+        with self._lock:
+            key = self._history_keys.pop(history_id, None)
+            if key:
+                self._memory.pop(key, None)
+
+    @staticmethod
+    def _write(path: str, retriever: TranscriptRetriever):
+        try:
+            os.makedirs(RAG_INDEX_DIR, exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(retriever.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            files = sorted((os.path.join(RAG_INDEX_DIR, name) for name in os.listdir(RAG_INDEX_DIR) if name.endswith(".json")), key=os.path.getmtime)
+            for old in files[:max(0, len(files) - RAG_DISK_MAX_FILES)]:
+                os.remove(old)
+        except OSError as e:
+            print(f"⚠️  Failed to write retrieval index: {e}")
+
+retrievers = RetrieverCache()
+
+def retrieve_chat_context(question: str, history_id: Optional[int], user_id: int, context: Dict) -> List[Dict]:
+    """按问题检索文稿分段：优先用 history_id 对应记录的文稿，否则用请求上下文里的 transcript"""
+    retriever = None
+    if history_id is not None:
+        db = SessionLocal()
+        try:
+            item = db.query(HistoryItem).filter(HistoryItem.id == history_id, HistoryItem.user_id == user_id).first()
+            if not item:
+                raise HTTPException(status_code=404, detail="History item not found")
+            retriever = retrievers.for_history(item)
+        finally:
+            db.close()
+    elif isinstance(context.get("transcript"), str) and context["transcript"].strip():
+        retriever = retrievers.for_transcript(context["transcript"])
+    return retriever.search(question) if retriever else []
+
+def format_retrieved_segments(segments: List[Dict]) -> str:
+    return "\n".join(f"[{format_time(s['start'])} - {format_time(s['end'])}] {s['text']}" for s in segments)
+
+# --- Transcription Checkpoints ---
+# 每个分片的 verbose_json 结果按 (内容哈希, 分片起止, 模型) 落库；重试或重启后的任务只重新转写缺失的分片
+CHECKPOINT_BOUNDARY_TOLERANCE = 0.5  # 秒，同一切点两次切片的起止时间会有少量编码帧误差
+
+def serialize_transcription(result) -> str:
+    segments = [
+        {"start": seg["start"], "end": seg["end"], "text": seg["text"]}
+        for seg in (getattr(result, "segments", None) or [])
+    ]
+    return json.dumps({"text": getattr(result, "text", ""), "segments": segments}, ensure_ascii=False)
+
+def load_chunk_checkpoint(content_hash: str, model: str, start: float, end: float):
+    """返回与 transcribe_chunk 结果结构相同的对象（.text / .segments），没有检查点时返回 None"""
+    db = SessionLocal()
+    try:
+        row = db.query(ChunkCheckpoint).filter(
+            ChunkCheckpoint.content_hash == content_hash,
+            ChunkCheckpoint.model == model,
+            ChunkCheckpoint.start_time.between(start - CHECKPOINT_BOUNDARY_TOLERANCE, start + CHECKPOINT_BOUNDARY_TOLERANCE),
+            ChunkCheckpoint.end_time.between(end - CHECKPOINT_BOUNDARY_TOLERANCE, end + CHECKPOINT_BOUNDARY_TOLERANCE),
+        ).first()
+        if not row:
+            return None
+        data = json.loads(row.result_json)
+        return types.SimpleNamespace(text=data.get("text", ""), segments=data.get("segments", []))
+    finally:
+        db.close()
+
+def save_chunk_checkpoint(content_hash: str, model: str, start: float, end: float, result):
+    db = SessionLocal()
+    try:
+        db.add(ChunkCheckpoint(
+            content_hash=content_hash, model=model,
+            start_time=round(start, 3), end_time=round(end, 3),
+            result_json=serialize_transcription(result)
+        ))
+        db.commit()
+    except Exception as e:
+        print(f"⚠️  Failed to save chunk checkpoint ({start:.0f}s-{end:.0f}s): {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+def checkpoint_cuts(content_hash: str, model: str) -> List[float]:
+    """已有检查点的分片边界；重试时按这些切点切片，才能与上次的分片对上"""
+    db = SessionLocal()
+    try:
+        rows = db.query(ChunkCheckpoint.start_time, ChunkCheckpoint.end_time).filter(
+            ChunkCheckpoint.content_hash == content_hash, ChunkCheckpoint.model == model
+        ).all()
+    finally:
+        db.close()
+    if not rows:
+        return []
+    last_end = max(end for _, end in rows)
+    # 最后一个检查点的结束时间可能就是音频结尾，不作为切点
+    return sorted({t for row in rows for t in row if 0 < t < last_end})
+
+# --- Core Logic ---
+
+async def process_audio_logic(source_type: str, user_id: Optional[int], url: str = None, file_path: str = None, session_id: str = "", is_cancelled=None, content_hash: Optional[str] = None, history_id: Optional[int] = None):
+    """执行一次完整分析，以 SSE 字符串的形式逐条产出进度事件；由任务队列的 worker 调用，
+    session_id 即任务ID，is_cancelled 为任务队列提供的取消检查；
+    URL 任务传入 content_hash 表示之前的尝试已得到内容哈希（重试/重启），此时先落盘再切片以便复用分片检查点；
+    history_id 为上次完成时写入的历史记录（重试补齐失败分片），结果覆盖到这条记录而不是新建"""
+    client_id = f"user_{user_id}" if user_id else f"session_{session_id}"
+    
+    print(f"📥 New request: {session_id[:8]} (client: {client_id})")
+    
+    # 缓存检查 1: 按提交的URL / 上传文件的内容哈希查找，命中时不占用转录槽位
+    analysis_cache_stats["lookups"] += 1
+    if source_type == "url":
+        cache_id, hit_kind = await asyncio.to_thread(lookup_analysis_cache, source_url=url)
+    else:
+        cache_id, hit_kind = await asyncio.to_thread(lookup_analysis_cache, content_hash=content_hash)
+    if cache_id:
+        saved_audio_url = f"file://{os.path.basename(file_path)}" if file_path else None
+        cached_payload, cached_audio_url = await asyncio.to_thread(serve_cached_analysis, cache_id, hit_kind, user_id, saved_audio_url, source_url=url, content_hash=content_hash, history_id=history_id)
+        if cached_payload:
+            print(f"⚡ Cache hit ({hit_kind}) for session {session_id[:8]}, skipping pipeline")
+            if cached_audio_url and not cached_audio_url.startswith("file://"):
+                yield f"data: {json.dumps({'stage': 'resolved_url', 'url': cached_audio_url})}\n\n"
+            yield f"data: {json.dumps(cached_payload)}\n\n"
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+            return
+    
+    print(f"🎯 Starting transcription for session {session_id[:8]}... (client: {client_id})")
+    
+    client = clients.groq
+    temp_base = os.path.join(TEMP_DIR, session_id)
+    temp_source = ""
+    audio_url_to_save = None  # 用于查重的原始URL
+    chunk_paths = []  # 初始化，避免 finally 块中引用错误
+    ffmpeg_process = None  # 保存 FFmpeg 进程引用，用于断开时终止
+    download_response = None  # 流式下载时的HTTP响应，finally 中关闭
+    chunk_futures = {}  # 分片序号 -> 转写 Future，finally 中取消未开始的
+    segment_list_path = f"{os.path.join(TEMP_DIR, session_id)}_segments.csv"
+    keep_upload = False  # 失败时保留上传文件，供 /api/jobs/{id}/retry 使用
+    
+    # 用于检查任务是否被取消的辅助函数
+    def is_task_cancelled():
+        return bool(is_cancelled and is_cancelled())
+    
+    try:
+        # 检查点 1: 开始下载前
+        if is_task_cancelled():
+            print(f"⚠️  Task cancelled before download: {session_id[:8]}")
+            yield f"data: {json.dumps({'stage': 'error', 'msg': 'Task cancelled - new analysis started'})}\n\n"
+            return
+        
+        yield f"data: {json.dumps({'stage': 'downloading', 'percent': 10, 'msg': 'Downloading audio...'})}\n\n"
+        
+        ingest_mode = "staged"
+        if source_type == "url":
+            real_url = await asyncio.to_thread(get_real_audio_url, url)
+            if not real_url:
+                raise Exception("Invalid URL")
+            
+            audio_url_to_save = real_url
+            yield f"data: {json.dumps({'stage': 'resolved_url', 'url': real_url})}\n\n"
+            
+            # 缓存检查 2: 不同的分享链接可能解析到同一个音频URL
+            cache_id, hit_kind = await asyncio.to_thread(lookup_analysis_cache, url=real_url)
+            if cache_id:
+                cached_payload, _ = await asyncio.to_thread(serve_cached_analysis, cache_id, hit_kind, user_id, real_url, source_url=url, history_id=history_id)
+                if cached_payload:
+                    print(f"⚡ Cache hit ({hit_kind}) for session {session_id[:8]}, skipping download")
+                    yield f"data: {json.dumps(cached_payload)}\n\n"
+                    return
+            
+            # 先读取第一块数据，判断容器能否从管道直接解复用
+            download_response = await asyncio.to_thread(clients.http.get, real_url, stream=True, timeout=30)
+            download_response.raise_for_status()
+            download_body = download_response.iter_content(1024*1024)
+            head_chunk = await asyncio.to_thread(next, download_body, b"")
+            
+            if STREAMING_INGEST and not content_hash and head_chunk and not mp4_requires_seek(head_chunk):
+                ingest_mode = "stream"
+                print(f"✓ Streaming ingest for session {session_id[:8]} (download overlaps slicing)")
+            else:
+                if content_hash:
+                    print(f"✓ Resuming with known content hash, staging download to reuse chunk checkpoints: {session_id[:8]}")
+                elif STREAMING_INGEST:
+                    print(f"⚠️  Container needs seeking (moov atom at end), staging download to disk: {session_id[:8]}")
+                temp_source = f"{temp_base}.m4a"
+                download_digest = hashlib.sha256()
+                with open(temp_source, 'wb') as f:
+                    async for chunk in iterate_in_thread(itertools.chain([head_chunk], download_body)):
+                        # 检查点 2: 下载过程中
+                        if is_task_cancelled():
+                            print(f"⚠️  Task cancelled during download: {session_id[:8]}")
+                            return
+                        f.write(chunk)
+                        download_digest.update(chunk)
+                download_response.close()
+                download_response = None
+                content_hash = download_digest.hexdigest()
+        else:
+            temp_source = file_path 
+            if not os.path.exists(temp_source):
+                 raise Exception("File upload failed")
+            audio_url_to_save = f"file://{os.path.basename(file_path)}"
+            if not content_hash:
+                content_hash = await asyncio.to_thread(hash_file, temp_source)
+        if content_hash:
+            await asyncio.to_thread(record_job_content_hash, session_id, content_hash)
         
         # 检查点 3: 下载完成后
         if is_task_cancelled():
             print(f"⚠️  Task cancelled after download: {session_id[:8]}")
             return
-
-        yield f"data: {json.dumps({'stage': 'processing', 'percent': 20, 'msg': 'Slicing audio...'})}\n\n"
         
+        # 缓存检查 3: 相同的音频内容（镜像地址、重复上传）；流式模式下要等切片结束才知道哈希
+        content_hash_checked = False
+        if ingest_mode == "staged":
+            content_hash_checked = True
+            cache_id, hit_kind = await asyncio.to_thread(lookup_analysis_cache, content_hash=content_hash)
+            if cache_id:
+                cached_payload, _ = await asyncio.to_thread(serve_cached_analysis, cache_id, hit_kind, user_id, audio_url_to_save, source_url=url if source_type == "url" else None, content_hash=content_hash, history_id=history_id)
+                if cached_payload:
+                    print(f"⚡ Cache hit ({hit_kind}) for session {session_id[:8]}, skipping pipeline")
+                    yield f"data: {json.dumps(cached_payload)}\n\n"
+                    return
+
         # 优化：合并转换和切片为一次ffmpeg调用，大幅提升速度
         chunk_pattern = f"{temp_base}_%03d.mp3"
+        slice_state = {}
         
-        # 启动 ffmpeg 进程
-        ffmpeg_process = subprocess.Popen([
-            "ffmpeg", "-i", temp_source, "-y",
-            "-f", "segment", "-segment_time", "1500",  # 25分钟切片（优化：减少API调用，提升处理速度）
-            "-c:a", "libmp3lame", "-ab", "64k", "-ar", "16000", "-ac", "1",
-            "-threads", "2",  # 使用2线程（优化：关闭Cursor后CPU可用，加速处理）
-            "-q:a", "9",  # 最快编码速度（0-9，9最快，质量足够转写使用）
-            chunk_pattern
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        # 模拟进度增长（20-65%，每1秒增长1%）
-        progress_percent = 20
-        last_update = time.time()
-        
-        while ffmpeg_process.poll() is None:
-            # 检查点 4: 检查任务是否被取消
-            if is_task_cancelled():
-                print(f"⚠️  Task cancelled during slicing: {session_id[:8]}, terminating FFmpeg...")
-                ffmpeg_process.terminate()
-                try:
-                    ffmpeg_process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    ffmpeg_process.kill()
+        # 输入时长用于计算真实进度：优先用单集记录，否则后台 ffprobe（不阻塞切片启动）
+        input_duration = 0
+        if source_type == "url":
+            input_duration = await asyncio.to_thread(lookup_episode_duration, audio_url_to_save, url)
+        duration_probe = None
+        if not input_duration:
+            duration_probe = asyncio.create_task(asyncio.to_thread(
+                get_audio_duration_from_url, temp_source if ingest_mode == "staged" else audio_url_to_save
+            ))
+        
+        # --- 切片与转写流水线：ffmpeg 每写完一个分片（segment_list 新增一行）就立即提交转写 ---
+        chunk_entries = []  # [{"path", "start", "end"}]，下标即分片序号
+        chunk_events = collections.deque()  # 工作线程写入的 (generation, idx, state)
+        checkpointed = set()  # 已写入检查点（或从检查点恢复、或转写失败）的分片序号
+        pipeline = {"generation": 0, "percent": 20}
+        
+        def process_chunk(generation, idx, path):
+            chunk_events.append((generation, idx, "uploading"))
+            result = transcribe_chunk(clients.groq, path)
+            chunk_events.append((generation, idx, "transcribed" if result else "failed"))
+            return idx, result
+        
+        async def submit_finished_segments():
+            loop = asyncio.get_running_loop()
+            for entry in read_segment_list(segment_list_path)[len(chunk_entries):]:
+                idx = len(chunk_entries)
+                chunk_entries.append(entry)
+                chunk_paths.append(entry["path"])
+                chunk_events.append((pipeline["generation"], idx, "sliced"))
+                restored = await asyncio.to_thread(load_chunk_checkpoint, content_hash, TRANSCRIBE_MODEL, entry["start"], entry["end"]) if content_hash else None
+                if restored is not None:
+                    checkpointed.add(idx)
+                    chunk_futures[idx] = loop.create_future()
+                    chunk_futures[idx].set_result((idx, restored))
+                    chunk_events.append((pipeline["generation"], idx, "restored from checkpoint"))
+                    continue
+                chunk_futures[idx] = loop.run_in_executor(
+                    groq_executor, process_chunk, pipeline["generation"], idx, entry["path"]
+                )
+        
+        async def flush_checkpoints():
+            """内容哈希已知后，把已完成且尚未落库的分片结果写入检查点（流式模式下哈希要等下载结束才知道）"""
+            if not content_hash:
                 return
+            for idx, future in list(chunk_futures.items()):
+                if idx in checkpointed or not future.done() or future.cancelled() or future.exception():
+                    continue
+                checkpointed.add(idx)
+                result = future.result()[1]
+                if result is not None:
+                    await asyncio.to_thread(save_chunk_checkpoint, content_hash, TRANSCRIBE_MODEL, chunk_entries[idx]["start"], chunk_entries[idx]["end"], result)
+        
+        def drain_chunk_events():
+            events = []
+            while chunk_events:
+                generation, idx, state = chunk_events.popleft()
+                if generation != pipeline["generation"]:
+                    continue  # 回退前提交的旧分片
+                done = sum(1 for f in chunk_futures.values() if f.done())
+                events.append(f"data: {json.dumps({'stage': 'transcribing', 'percent': pipeline['percent'], 'msg': f'Chunk {idx + 1}: {state} ({done}/{len(chunk_entries)} done)', 'chunk': idx, 'chunk_state': state})}\n\n")
+            return events
+        
+        async def run_slicing(input_arg, stdin_chunks=None, segment_times=None):
+            """运行 ffmpeg 切片并推送进度；stdin_chunks 不为空时边下载边写入 ffmpeg stdin；segment_times 为预先规划的切点"""
+            nonlocal ffmpeg_process
+            slice_state.clear()
+            slice_state.update({"aborted": False, "returncode": None})
             
-            # 检查客户端是否断开连接
-            if request:
-                is_disconnected = await request.is_disconnected()
-                if is_disconnected:
-                    print(f"⚠️  Client disconnected for session {session_id[:8]}, terminating FFmpeg...")
-                    ffmpeg_process.terminate()
-                    try:
-                        ffmpeg_process.wait(timeout=5)  # 等待最多5秒
-                    except subprocess.TimeoutExpired:
-                        ffmpeg_process.kill()  # 强制终止
-                    return
+            # asyncio 子进程：等待 ffmpeg 时不阻塞事件循环（其他请求和 SSE 流照常响应）
+            nonlocal input_duration
+            ffmpeg_process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-i", input_arg, "-y",
+                "-progress", "pipe:1", "-nostats",  # 机器可读的真实进度输出到 stdout
+                "-f", "segment",
+                # 有规划好的静音切点时按切点分片，否则固定25分钟（流式输入无法预先扫描静音）
+                *(["-segment_times", ",".join(f"{t:.3f}" for t in segment_times)] if segment_times
+                  else ["-segment_time", str(SEGMENT_TARGET_SECONDS)]),
+                "-segment_list", segment_list_path, "-segment_list_type", "csv",  # 分片写完即记录，供流水线提交转写
+                "-c:a", "libmp3lame", "-ab", "64k", "-ar", "16000", "-ac", "1",
+                "-threads", str(FFMPEG_THREADS),
+                "-q:a", "9",  # 最快编码速度（0-9，9最快，质量足够转写使用）
+                chunk_pattern,
+                stdin=asyncio.subprocess.PIPE if stdin_chunks is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            slice_started = time.time()
+            progress_info = {"out_time": 0.0, "speed": 0.0, "state": "continue"}
+            progress_reader = asyncio.create_task(read_ffmpeg_progress(ffmpeg_process.stdout, progress_info))
             
-            current_time = time.time()
+            feeder = None
+            if stdin_chunks is not None:
+                slice_state["digest"] = hashlib.sha256()
+                feeder = asyncio.create_task(
+                    feed_process_stdin(ffmpeg_process, stdin_chunks, slice_state, is_task_cancelled)
+                )
+            wait_task = asyncio.create_task(ffmpeg_process.wait())
             
-            # 每1秒发送一次进度更新
-            if current_time - last_update >= 1.0:
-                if progress_percent < 64:
-                    progress_percent = min(64, progress_percent + 1)
-                    yield f"data: {json.dumps({'stage': 'processing', 'percent': int(progress_percent), 'msg': 'Slicing audio... please wait'})}\n\n"
-                    last_update = current_time
+            progress_percent = 20
+            last_update = time.time()
             
-            time.sleep(0.1)
+            try:
+                while not wait_task.done():
+                    await asyncio.wait({wait_task}, timeout=0.5)
+                    if wait_task.done():
+                        break
+                    
+                    # 检查点 4: 检查任务是否被取消
+                    if is_task_cancelled():
+                        print(f"⚠️  Task cancelled during slicing: {session_id[:8]}, terminating FFmpeg...")
+                        await terminate_process(ffmpeg_process)
+                        slice_state["aborted"] = True
+                        return
+                    
+                    if not input_duration and duration_probe is not None and duration_probe.done():
+                        input_duration = duration_probe.result() or 0
+                    
+                    await submit_finished_segments()
+                    await flush_checkpoints()
+                    for event in drain_chunk_events():
+                        yield event
+                    
+                    current_time = time.time()
+                    
+                    # 每1秒发送一次进度更新
+                    if current_time - last_update >= 1.0:
+                        last_update = current_time
+                        out_time = progress_info["out_time"]
+                        speed = progress_info["speed"]
+                        if input_duration > 0:
+                            # 真实进度：20-64% 对应已编码时长 / 总时长
+                            progress_percent = max(progress_percent, 20 + int(44 * min(1.0, out_time / input_duration)))
+                            eta = int((input_duration - out_time) / speed) if speed > 0 else None
+                            msg = f"Slicing audio... {format_time(out_time)} / {format_time(input_duration)}"
+                            if speed > 0:
+                                msg += f" ({speed:.1f}x, ETA {format_time(eta)})"
+                        else:
+                            # 时长未知：保留缓慢增长，但消息中给出真实已处理时长
+                            progress_percent = min(64, progress_percent + 1)
+                            eta = None
+                            msg = f"Slicing audio... {format_time(out_time)} processed"
+                        pipeline["percent"] = progress_percent
+                        yield f"data: {json.dumps({'stage': 'processing', 'percent': progress_percent, 'msg': msg, 'out_time': round(out_time, 1), 'duration': input_duration or None, 'speed': speed or None, 'eta': eta})}\n\n"
+            finally:
+                # 生成器被关闭（如 StreamingResponse 取消）时同样要结束 ffmpeg 和写入任务
+                if not wait_task.done():
+                    await terminate_process(ffmpeg_process)
+                    wait_task.cancel()
+                if feeder is not None:
+                    if not feeder.done():
+                        feeder.cancel()
+                    await asyncio.gather(feeder, return_exceptions=True)
+                await asyncio.gather(progress_reader, return_exceptions=True)
+            
+            slice_state["returncode"] = ffmpeg_process.returncode
+            # 记录编码速度倍率，用于根据实际数据调整 FFMPEG_THREADS
+            wall_time = time.time() - slice_started
+            avg_speed = progress_info["out_time"] / wall_time if wall_time > 0 else 0
+            print(f"📊 FFmpeg slicing: {format_time(progress_info['out_time'])} audio in {wall_time:.1f}s, "
+                  f"speed={progress_info['speed']:.2f}x (avg {avg_speed:.2f}x), threads={FFMPEG_THREADS}, "
+                  f"input={'pipe' if stdin_chunks is not None else 'file'}, rc={ffmpeg_process.returncode}")
+        
+        def remove_partial_chunks():
+            for f in os.listdir(TEMP_DIR):
+                if f.startswith(f"{session_id}_") and f.endswith(".mp3"):
+                    try:
+                        os.remove(os.path.join(TEMP_DIR, f))
+                    except OSError:
+                        pass
+        
+        if ingest_mode == "stream":
+            yield f"data: {json.dumps({'stage': 'processing', 'percent': 20, 'msg': 'Streaming and slicing audio...'})}\n\n"
+            async for event in run_slicing("pipe:0", itertools.chain([head_chunk], download_body)):
+                yield event
+            download_response.close()
+            download_response = None
+            if slice_state["aborted"]:
+                return
+            
+            if slice_state["returncode"] == 0 and slice_state.get("fed_all"):
+                content_hash = slice_state["digest"].hexdigest()
+                await asyncio.to_thread(record_job_content_hash, session_id, content_hash)
+            else:
+                # 回退：管道无法解复用（例如未识别的 moov 位置）或下载中断，改为先落盘再切片
+                print(f"⚠️  Streaming ingest failed (rc={slice_state['returncode']}, fed_all={slice_state.get('fed_all')}), falling back to staged download: {session_id[:8]}")
+                for f in chunk_futures.values():
+                    f.cancel()
+                chunk_futures.clear()
+                chunk_entries.clear()
+                checkpointed.clear()
+                pipeline["generation"] += 1
+                remove_partial_chunks()
+                ingest_mode = "staged"
+                temp_source = f"{temp_base}.m4a"
+                download_digest = hashlib.sha256()
+                download_response = await asyncio.to_thread(clients.http.get, real_url, stream=True, timeout=30)
+                download_response.raise_for_status()
+                with open(temp_source, 'wb') as f:
+                    async for chunk in iterate_in_thread(download_response.iter_content(1024*1024)):
+                        if is_task_cancelled():
+                            print(f"⚠️  Task cancelled during download: {session_id[:8]}")
+                            return
+                        f.write(chunk)
+                        download_digest.update(chunk)
+                download_response.close()
+                download_response = None
+                content_hash = download_digest.hexdigest()
+                await asyncio.to_thread(record_job_content_hash, session_id, content_hash)
+        
+        if ingest_mode == "staged":
+            # 重试时沿用上次的分片边界，已转写的分片才能从检查点恢复
+            planned_cuts = await asyncio.to_thread(checkpoint_cuts, content_hash, TRANSCRIBE_MODEL) if content_hash else []
+            if planned_cuts:
+                print(f"✓ Reusing {len(planned_cuts)} chunk boundaries from checkpoints: {session_id[:8]}")
+            elif SILENCE_AWARE_SPLIT:
+                if not input_duration and duration_probe is not None:
+                    input_duration = await duration_probe or 0
+                if input_duration > SEGMENT_TARGET_SECONDS + SILENCE_SEARCH_WINDOW:
+                    yield f"data: {json.dumps({'stage': 'processing', 'percent': 20, 'msg': 'Finding quiet points for chunk boundaries...'})}\n\n"
+                    planned_cuts = await plan_chunk_boundaries(temp_source, input_duration)
+            yield f"data: {json.dumps({'stage': 'processing', 'percent': 20, 'msg': 'Slicing audio...'})}\n\n"
+            async for event in run_slicing(temp_source, segment_times=planned_cuts):
+                yield event
+            if slice_state["aborted"]:
+                return
+        
+        if duration_probe is not None and not duration_probe.done():
+            duration_probe.cancel()
         
         # 检查返回码
-        if ffmpeg_process.returncode != 0:
-            raise Exception(f"FFmpeg failed with return code {ffmpeg_process.returncode}")
+        if slice_state["returncode"] != 0:
+            raise Exception(f"FFmpeg failed with return code {slice_state['returncode']}")
         
         yield f"data: {json.dumps({'stage': 'processing', 'percent': 65, 'msg': 'Audio sliced successfully'})}\n\n"
         
+        # 流式模式下内容哈希此时才可用，命中缓存仍可省掉转写和总结
+        if not content_hash_checked and content_hash:
+            cache_id, hit_kind = await asyncio.to_thread(lookup_analysis_cache, content_hash=content_hash)
+            if cache_id:
+                cached_payload, _ = await asyncio.to_thread(serve_cached_analysis, cache_id, hit_kind, user_id, audio_url_to_save, source_url=url if source_type == "url" else None, content_hash=content_hash, history_id=history_id)
+                if cached_payload:
+                    print(f"⚡ Cache hit ({hit_kind}) for session {session_id[:8]} after streaming, skipping transcription")
+                    for f in chunk_futures.values():
+                        f.cancel()
+                    yield f"data: {json.dumps(cached_payload)}\n\n"
+                    return
+        
         # --- 不保存音频文件到本地，只使用外部 URL（节省磁盘空间和带宽）---
         local_audio_path = None
         # 注释掉本地保存逻辑，音频将直接从外部 CDN 播放
@@ -1581,35 +4151,44 @@ async def process_audio_logic(source_type: str, user_id: Optional[int], url: str
             print(f"⚠️  Task cancelled after slicing: {session_id[:8]}")
             return
         
-        chunk_files = sorted([f for f in os.listdir(TEMP_DIR) if f.startswith(f"{session_id}_") and f.endswith(".mp3")])
-        chunk_paths = [os.path.join(TEMP_DIR, f) for f in chunk_files]
-        total_chunks = len(chunk_paths)
+        # 提交最后的分片，等待仍在转写的分片（大部分已在切片期间完成）
+        await submit_finished_segments()
+        total_chunks = len(chunk_entries)
+        if total_chunks == 0:
+            raise Exception("FFmpeg produced no audio segments")
         
         full_transcript_lines = []
-        transcript_results = {}
-        
-        def process_chunk(idx, path):
-            local_client = Groq(api_key=GROQ_API_KEY)
-            return idx, transcribe_chunk(local_client, path)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_chunk = {executor.submit(process_chunk, i, p): i for i, p in enumerate(chunk_paths)}
-            completed = 0
-            for future in concurrent.futures.as_completed(future_to_chunk):
-                # 检查点 6: 转写过程中
-                if is_task_cancelled():
-                    print(f"⚠️  Task cancelled during transcription: {session_id[:8]}")
-                    # 取消所有未完成的任务
-                    for f in future_to_chunk:
-                        f.cancel()
-                    return
-                
-                completed += 1
-                idx, result = future.result()
-                transcript_results[idx] = result
-                
-                percent = 65 + int((completed / total_chunks) * 20) 
-                yield f"data: {json.dumps({'stage': 'transcribing', 'percent': percent, 'msg': f'Transcribing chunk {completed}/{total_chunks}'})}\n\n"
+        pending = set(chunk_futures.values())
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=0.5)
+            # 检查点 6: 转写过程中
+            if is_task_cancelled():
+                print(f"⚠️  Task cancelled during transcription: {session_id[:8]}")
+                # 取消所有未开始的任务
+                for f in pending:
+                    f.cancel()
+                return
+            pipeline["percent"] = 65 + int(((total_chunks - len(pending)) / total_chunks) * 20)
+            await flush_checkpoints()
+            for event in drain_chunk_events():
+                yield event
+        await flush_checkpoints()
+        
+        transcript_results = {idx: f.result()[1] for idx, f in chunk_futures.items()}
+        print(f"✓ Transcribed {total_chunks} chunks in pipeline")
+        
+        # 转写失败的分片不再静默跳过：记录时间段，在文稿中插入明确的提示行
+        failed_spans = [
+            {"start": chunk_entries[i]["start"], "end": chunk_entries[i]["end"]}
+            for i in range(total_chunks) if transcript_results.get(i) is None
+        ]
+        if len(failed_spans) == total_chunks:
+            raise Exception("All chunks failed to transcribe")
+        if failed_spans:
+            keep_upload = True
+            spans_text = ", ".join(f"{format_time(span['start'])}-{format_time(span['end'])}" for span in failed_spans)
+            print(f"⚠️  {len(failed_spans)}/{total_chunks} chunks failed to transcribe: {spans_text}")
+            yield f"data: {json.dumps({'stage': 'transcribing', 'percent': 85, 'msg': f'⚠️ {len(failed_spans)} chunk(s) failed to transcribe ({spans_text}), retry the job to fill them in'})}\n\n"
 
         full_text_pure = ""
         paragraph_buffer = {"text": "", "start": None, "end": None}
@@ -1628,65 +4207,84 @@ async def process_audio_logic(source_type: str, user_id: Optional[int], url: str
                              '由于', '另外', '此外', '同时', '然后', '接着', '进一步', '更重要的是',
                              '也就是说', '换句话说', '首先', '其次', '第一', '第二', '再者']
         
-        # 创建用于标点的 client
-        punctuation_client = Groq(api_key=GROQ_API_KEY)
-        segments_processed = 0
-        segments_punctuated = 0
-        
+        # 第一遍：展开所有 Whisper segment（时间加上分片实际起点），记录同一分片内的下一句用于连接词判断
+        whisper_segments = []
         for i in range(total_chunks):
             res = transcript_results.get(i)
-            if res and hasattr(res, 'segments'):
-                offset = i * 1500  # 25分钟 = 1500秒
+            if res is None:
+                start, end = chunk_entries[i]["start"], chunk_entries[i]["end"]
+                whisper_segments.append({
+                    "start": start,
+                    "end": end,
+                    "text": f"⚠️ 此段音频转写失败（{format_time(start)} - {format_time(end)}），内容缺失，可重试任务补转。",
+                    "next_text": "",
+                    "failed": True
+                })
+            elif hasattr(res, 'segments'):
+                offset = chunk_entries[i]["start"]  # ffmpeg 记录的实际分片起点（秒）
                 for seg_idx, seg in enumerate(res.segments):
-                    start = seg['start'] + offset
-                    end = seg['end'] + offset
                     text = seg['text'].strip()
                     if not text: continue
-                    
-                    # ✨ 关键改进：在转写阶段立即检查并添加标点
-                    # 如果 Whisper 没有添加标点，立即处理
-                    segments_processed += 1
-                    if not any(c in text for c in '，。！？；：、,.!?;:') and len(text) > 5:
-                        try:
-                            text = add_punctuation_to_segment(punctuation_client, text)
-                            segments_punctuated += 1
-                            if segments_punctuated % 20 == 0:
-                                print(f"  Added punctuation to {segments_punctuated} segments...")
-                        except Exception as e:
-                            print(f"⚠️ Failed to add punctuation to segment: {e}")
-                    
-                    full_text_pure += text
-                    
-                    if paragraph_buffer["start"] is None: paragraph_buffer["start"] = start
-                    paragraph_buffer["text"] += text
-                    paragraph_buffer["end"] = end
-                    
-                    # 智能分段判断
-                    should_flush = False
-                    
-                    # 1. 检查是否有句子结束标点
-                    has_end_punctuation = text.endswith(('。', '！', '？', '!', '?', '.', '；', ';'))
-                    
-                    # 2. 检查下一句是否以连接词开头（如果是，不要分段）
-                    next_starts_with_continuation = False
-                    if seg_idx + 1 < len(res.segments):
-                        next_text = res.segments[seg_idx + 1]['text'].strip()
-                        next_starts_with_continuation = any(next_text.startswith(word) for word in continuation_words)
-                    
-                    # 3. 分段条件：有结束标点 且 不是连接词开头 且 长度合理
-                    if has_end_punctuation and not next_starts_with_continuation:
-                        # 如果当前段落长度在50-300字之间，可以分段
-                        if 50 <= len(paragraph_buffer["text"]) <= 300:
-                            should_flush = True
-                        # 如果超过300字，强制分段（避免段落过长）
-                        elif len(paragraph_buffer["text"]) > 300:
-                            should_flush = True
-                    # 4. 如果段落过长（超过400字），即使没有结束标点也要分段
-                    elif len(paragraph_buffer["text"]) > 400:
-                        should_flush = True
-                    
-                    if should_flush:
-                        flush_buffer(paragraph_buffer, full_transcript_lines)
+                    next_text = res.segments[seg_idx + 1]['text'].strip() if seg_idx + 1 < len(res.segments) else ""
+                    whisper_segments.append({
+                        "start": seg['start'] + offset,
+                        "end": seg['end'] + offset,
+                        "text": text,
+                        "next_text": next_text
+                    })
+        
+        # ✨ 关键改进：Whisper 没有加标点的 segment 按批并发补标点，按下标映射回原位置
+        unpunctuated = [
+            idx for idx, seg in enumerate(whisper_segments)
+            if not seg.get("failed") and not any(c in seg["text"] for c in '，。！？；：、,.!?;:') and len(seg["text"]) > 5
+        ]
+        if unpunctuated:
+            yield f"data: {json.dumps({'stage': 'analyzing', 'percent': 85, 'msg': f'Adding punctuation to {len(unpunctuated)} segments...'})}\n\n"
+            punctuation_started = time.time()
+            punctuated = await punctuate_segments(client, [whisper_segments[idx]["text"] for idx in unpunctuated])
+            for idx, text in zip(unpunctuated, punctuated):
+                whisper_segments[idx]["text"] = text
+            elapsed = max(time.time() - punctuation_started, 0.001)
+            print(f"✓ Segment punctuation: {len(unpunctuated)}/{len(whisper_segments)} segments in {elapsed:.1f}s ({len(unpunctuated) / elapsed:.1f} segments/sec)")
+        
+        # 第二遍：智能分段
+        for seg in whisper_segments:
+            start, end, text = seg["start"], seg["end"], seg["text"]
+            
+            if seg.get("failed"):
+                flush_buffer(paragraph_buffer, full_transcript_lines)
+                full_transcript_lines.append(f"[{format_time(start)} - {format_time(end)}] {text}")
+                continue
+            
+            full_text_pure += text
+            
+            if paragraph_buffer["start"] is None: paragraph_buffer["start"] = start
+            paragraph_buffer["text"] += text
+            paragraph_buffer["end"] = end
+            
+            # 智能分段判断
+            should_flush = False
+            
+            # 1. 检查是否有句子结束标点
+            has_end_punctuation = text.endswith(('。', '！', '？', '!', '?', '.', '；', ';'))
+            
+            # 2. 检查下一句是否以连接词开头（如果是，不要分段）
+            next_starts_with_continuation = any(seg["next_text"].startswith(word) for word in continuation_words)
+            
+            # 3. 分段条件：有结束标点 且 不是连接词开头 且 长度合理
+            if has_end_punctuation and not next_starts_with_continuation:
+                # 如果当前段落长度在50-300字之间，可以分段
+                if 50 <= len(paragraph_buffer["text"]) <= 300:
+                    should_flush = True
+                # 如果超过300字，强制分段（避免段落过长）
+                elif len(paragraph_buffer["text"]) > 300:
+                    should_flush = True
+            # 4. 如果段落过长（超过400字），即使没有结束标点也要分段
+            elif len(paragraph_buffer["text"]) > 400:
+                should_flush = True
+            
+            if should_flush:
+                flush_buffer(paragraph_buffer, full_transcript_lines)
         
         flush_buffer(paragraph_buffer, full_transcript_lines)
         transcript_str = "\n".join(full_transcript_lines)
@@ -1742,7 +4340,7 @@ async def process_audio_logic(source_type: str, user_id: Optional[int], url: str
                 if len(combined_text.strip()) > 10:
                     try:
                         # 调用标点添加（使用新的编号格式函数）
-                        punctuated_combined = add_punctuation_numbered(client, combined_text, len(batch_data))
+                        punctuated_combined = await asyncio.to_thread(add_punctuation_numbered, client, combined_text, len(batch_data))
                         
                         # 按编号提取结果
                         punctuated_texts = []
@@ -1817,7 +4415,21 @@ async def process_audio_logic(source_type: str, user_id: Optional[int], url: str
         
         yield f"data: {json.dumps({'stage': 'analyzing', 'percent': 85, 'msg': 'Generating deep insights...'})}\n\n"
         
-        summary_json = generate_summary_json(client, transcript_str)
+        # 流式生成总结：工作线程把完整的字段/数组元素放进 summary_events，这里转成 SSE 推送
+        summary_events = collections.deque()
+        summary_task = asyncio.ensure_future(asyncio.to_thread(generate_summary_json, client, transcript_str, summary_events.append))
+        while True:
+            if not summary_task.done():
+                await asyncio.wait({summary_task}, timeout=0.3)
+            while summary_events:
+                event = summary_events.popleft()
+                if event[0] == "field":
+                    yield f"data: {json.dumps({'stage': 'summary_field', 'field': event[1], 'value': event[2]})}\n\n"
+                else:
+                    yield f"data: {json.dumps({'stage': 'summary_item', 'field': event[1], 'index': event[2], 'value': event[3]})}\n\n"
+            if summary_task.done():
+                break
+        summary_json = summary_task.result()
         
         print(f"✓ Summary generated: {len(str(summary_json))} chars")
         print(f"  - Title: {summary_json.get('title', 'N/A')}")
@@ -1829,35 +4441,67 @@ async def process_audio_logic(source_type: str, user_id: Optional[int], url: str
             "percent": 100,
             "transcript": transcript_str, 
             "summary": summary_json,
-            "local_audio_path": local_audio_path # 将本地路径存入 JSON
+            "local_audio_path": local_audio_path, # 将本地路径存入 JSON
+            "failed_spans": failed_spans  # 转写失败的时间段（秒），为空表示完整
         }
         
         print(f"✓ Sending result payload: stage={result_payload['stage']}, has_summary={bool(result_payload.get('summary'))}, transcript_len={len(result_payload.get('transcript', ''))}")
         
         # --- Save to DB ---
-        # 只有登录用户才保存历史记录
+        # 共享缓存对匿名用户同样生效
+        cache_id = await asyncio.to_thread(
+            store_analysis_cache,
+            result_payload,
+            source_url=url if source_type == "url" else None,
+            url=audio_url_to_save if source_type == "url" else None,
+            content_hash=content_hash
+        )
+        
+        # 只有登录用户才保存历史记录；写历史、文稿分段和全文索引都是批量 SQLite 写入，放到线程里执行
         if user_id is not None:
-            db = None
-            try:
-                db = SessionLocal()
-                title = summary_json.get("title", "New Analysis")
-                history_item = HistoryItem(
-                    user_id=user_id,
-                    title=title,
-                    audio_url=audio_url_to_save, # 存原始URL用于查重
-                    data_json=json.dumps(result_payload)
-                )
-                db.add(history_item)
-                db.commit()
-                print(f"✓ Saved history item #{history_item.id} for user {user_id}")
-            except Exception as e:
-                print(f"✗ Failed to save history: {e}")
-                if db:
-                    db.rollback()
-                # 不抛出异常，因为转录已完成，只是保存失败
-            finally:
-                if db:
-                    db.close()
+            def save_history():
+                db = None
+                try:
+                    db = SessionLocal()
+                    title = summary_json.get("title", "New Analysis")
+                    history_item = None
+                    if history_id is not None:
+                        history_item = db.query(HistoryItem).filter(HistoryItem.id == history_id, HistoryItem.user_id == user_id).first()
+                    if history_item is not None:
+                        # 重试：原记录带着失败分片的占位行，原地更新；文稿变了，旧的说话人版本作废
+                        history_item.title = title
+                        history_item.audio_url = audio_url_to_save
+                        history_item.data_json = json.dumps(result_payload)
+                        history_item.analysis_cache_id = cache_id
+                        history_item.speaker_transcript = None
+                        for field, value in history_index_fields(result_payload).items():
+                            setattr(history_item, field, value)
+                    else:
+                        history_item = HistoryItem(
+                            user_id=user_id,
+                            title=title,
+                            audio_url=audio_url_to_save, # 存原始URL用于查重
+                            data_json=json.dumps(result_payload),
+                            analysis_cache_id=cache_id,
+                            **history_index_fields(result_payload)
+                        )
+                        db.add(history_item)
+                    db.flush()
+                    segment_count = store_transcript_segments(db, history_item.id, transcript_str)
+                    index_history_search(db, history_item.id, user_id, result_payload)
+                    db.commit()
+                    result_payload["history_id"] = history_item.id
+                    print(f"✓ {'Updated' if history_item.id == history_id else 'Saved'} history item #{history_item.id} for user {user_id} ({segment_count} transcript segments)")
+                except Exception as e:
+                    print(f"✗ Failed to save history: {e}")
+                    if db:
+                        db.rollback()
+                    # 不抛出异常，因为转录已完成，只是保存失败
+                finally:
+                    if db:
+                        db.close()
+
+            await asyncio.to_thread(save_history)
         else:
             print(f"⚠ Skipping history save - user not logged in")
 
@@ -1865,40 +4509,743 @@ async def process_audio_logic(source_type: str, user_id: Optional[int], url: str
 
     except Exception as e:
         print(f"✗ Error in process_audio_logic: {str(e)[:200]}")
+        keep_upload = True
         yield f"data: {json.dumps({'stage': 'error', 'msg': str(e)})}\n\n"
     finally:
-        # 清理活跃任务记录
-        if client_id in active_transcriptions:
-            if active_transcriptions[client_id].get("session_id") == session_id:
-                del active_transcriptions[client_id]
-                print(f"✓ Removed task from active list: {client_id}")
+        if download_response is not None:
+            download_response.close()
         
         # 清理临时文件
         cleanup_count = 0
         cleanup_errors = []
         try:
-            if temp_source and os.path.exists(temp_source):
+            if keep_upload and source_type == "file":
+                print(f"✓ Keeping upload for retry: {os.path.basename(temp_source)}")
+            elif temp_source and os.path.exists(temp_source):
                 os.remove(temp_source)
                 cleanup_count += 1
         except Exception as e:
             cleanup_errors.append(f"temp_source: {e}")
         
         try:
-            for p in chunk_paths: 
+            for p in chunk_paths + [segment_list_path]: 
                 if os.path.exists(p):
                     os.remove(p)
                     cleanup_count += 1
         except Exception as e:
             cleanup_errors.append(f"chunks: {e}")
         
+        for f in chunk_futures.values():
+            f.cancel()
+        
         if cleanup_count > 0:
             print(f"✓ Cleaned up {cleanup_count} temporary files")
         if cleanup_errors:
             print(f"⚠ Cleanup warnings: {'; '.join(cleanup_errors)}")
-        
-        # 释放并发限流信号量
-        transcription_semaphore.release()
-        print(f"✓ Released transcription slot for session {session_id[:8]}")
+
+# --- Admission Control ---
+# 按内存决定任务能否开始：MAX_CONCURRENT_TRANSCRIPTIONS 只是 worker 上限，实际并发由可用内存决定。
+# 每个任务各阶段的内存估算来自 SYSTEM_CAPACITY_REPORT.md（单任务约 160-210 MB，其中基础进程约 80 MB 为共享）
+STAGE_MEMORY_MB = {
+    "admitted": 0,       # 已准入但尚未开始
+    "downloading": 10,   # 1MB 分块下载 / 流式写入 ffmpeg
+    "slicing": 80,       # ffmpeg 切片编码
+    "transcribing": 30,  # 分片上传与 verbose_json 结果
+    "summary": 20,       # 总结 prompt 与响应
+}
+STAGE_ORDER = ["admitted", "downloading", "slicing", "transcribing", "summary"]
+UPLOAD_MEMORY_MB = 20  # 上传接收时 8MB 缓冲区加请求解析开销
+MEMORY_RESERVE_MB = int(os.environ.get("MEMORY_RESERVE_MB", "150"))  # 始终保留给系统和其他进程的余量
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "20"))  # 排队任务超过此数时直接拒绝
+ADMISSION_RECHECK_SECONDS = 2
+
+# SSE 阶段 -> 内存阶段（分片进度事件 chunk_state 在切片期间就会出现，不据此推进阶段）
+EVENT_MEMORY_STAGE = {
+    "downloading": "downloading",
+    "resolved_url": "downloading",
+    "processing": "slicing",
+    "transcribing": "transcribing",
+    "analyzing": "summary",
+}
+
+def read_memory_info() -> Optional[Dict]:
+    """读取 /proc/meminfo 和 /proc/self/status（MB）；非 Linux 环境返回 None，此时只按 worker 数限流"""
+    try:
+        values = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, rest = line.split(":", 1)
+                values[name] = int(rest.split()[0]) / 1024
+        rss = 0.0
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+        return {
+            "total_mb": round(values["MemTotal"]),
+            "available_mb": round(values.get("MemAvailable", values.get("MemFree", 0))),
+            "rss_mb": round(rss),
+        }
+    except (OSError, KeyError, ValueError):
+        return None
+
+class AdmissionController:
+    """跟踪已准入任务所处的阶段，按“可用内存 - 运行中任务后续阶段的增量 - 新任务峰值 >= 保留余量”决定准入"""
+
+    def __init__(self):
+        self.running: Dict[str, str] = {}  # job_id -> 当前内存阶段
+        self.uploads_in_progress = 0
+        self.decisions = collections.deque(maxlen=50)
+        self.counters = {"admitted": 0, "deferred": 0, "rejected": 0}
+        self.last_deferred_job = None
+        self.queue_positions: Dict[str, int] = {}  # 最近一次推送给客户端的排队位置
+
+    @staticmethod
+    def remaining_peak(stage: str) -> int:
+        return max(STAGE_MEMORY_MB[s] for s in STAGE_ORDER[STAGE_ORDER.index(stage):])
+
+    def pending_growth_mb(self) -> int:
+        """运行中的任务相对当前阶段还会增加的内存（当前阶段的占用已体现在可用内存中）"""
+        growth = sum(self.remaining_peak(stage) - STAGE_MEMORY_MB[stage] for stage in list(self.running.values()))
+        return growth + self.uploads_in_progress * UPLOAD_MEMORY_MB
+
+    def record(self, decision: str, job_id: Optional[str], memory: Optional[Dict], projected: Optional[int], reason: str = ""):
+        self.counters[decision] += 1
+        self.decisions.append({
+            "time": datetime.utcnow().isoformat(),
+            "decision": decision,
+            "job_id": job_id,
+            "reason": reason,
+            "running": len(self.running),
+            "projected_free_mb": projected,
+            **(memory or {}),
+        })
+
+    def projected_free_mb(self, memory: Optional[Dict], extra_mb: int) -> Optional[int]:
+        if memory is None:
+            return None
+        return memory["available_mb"] - self.pending_growth_mb() - extra_mb
+
+    def can_admit(self, job_id: str) -> bool:
+        memory = read_memory_info()
+        projected = self.projected_free_mb(memory, self.remaining_peak("admitted"))
+        if projected is not None and projected < MEMORY_RESERVE_MB and self.running:
+            if self.last_deferred_job != job_id:
+                self.last_deferred_job = job_id
+                self.record("deferred", job_id, memory, projected, f"projected free {projected} MB < reserve {MEMORY_RESERVE_MB} MB")
+                print(f"⚠️  Admission deferred for job {job_id[:8]}: {memory['available_mb']} MB available, projected {projected} MB after start ({len(self.running)} running)")
+            return False
+        # 没有运行中的任务时总是准入一个，否则估算偏大时队列会永远卡住
+        reason = "idle" if projected is not None and projected < MEMORY_RESERVE_MB else ""
+        self.running[job_id] = "admitted"
+        self.last_deferred_job = None
+        self.queue_positions.pop(job_id, None)
+        self.record("admitted", job_id, memory, projected, reason)
+        return True
+
+    def rejection_reason(self, queued: int, upload: bool = False) -> Optional[str]:
+        """入队前的硬性拒绝：队列已满，或上传时内存已不足以缓冲请求体"""
+        if queued >= ADMISSION_MAX_QUEUE:
+            return f"Server is busy ({queued} jobs queued), please try again later"
+        if upload:
+            memory = read_memory_info()
+            projected = self.projected_free_mb(memory, UPLOAD_MEMORY_MB)
+            if projected is not None and projected < MEMORY_RESERVE_MB // 2:
+                return "Server is low on memory, please try again later"
+        return None
+
+    def reject(self, reason: str, upload: bool = False):
+        memory = read_memory_info()
+        self.record("rejected", None, memory, self.projected_free_mb(memory, UPLOAD_MEMORY_MB if upload else 0), reason)
+        print(f"✗ Admission rejected: {reason}")
+        raise HTTPException(status_code=503, detail=reason, headers={"Retry-After": "30"})
+
+    def advance(self, job_id: str, payload: Dict):
+        """根据任务的进度事件推进其内存阶段（只前进不后退）"""
+        if job_id not in self.running or payload.get("chunk_state"):
+            return
+        stage = EVENT_MEMORY_STAGE.get(payload.get("stage"))
+        if stage and STAGE_ORDER.index(stage) > STAGE_ORDER.index(self.running[job_id]):
+            self.running[job_id] = stage
+
+    def release(self, job_id: str):
+        self.running.pop(job_id, None)
+
+    def snapshot(self) -> Dict:
+        """运维视图：任务只显示 ID 前 8 位（与日志一致），完整 ID 可用于访问任务，不对外暴露"""
+        memory = read_memory_info()
+        return {
+            "memory": memory,
+            "reserve_mb": MEMORY_RESERVE_MB,
+            "stage_estimates_mb": STAGE_MEMORY_MB,
+            "pending_growth_mb": self.pending_growth_mb(),
+            "projected_free_mb": self.projected_free_mb(memory, self.remaining_peak("admitted")),
+            "running": {job_id[:8]: stage for job_id, stage in list(self.running.items())},
+            "uploads_in_progress": self.uploads_in_progress,
+            "max_workers": MAX_CONCURRENT_TRANSCRIPTIONS,
+            "max_queue": ADMISSION_MAX_QUEUE,
+            "queue_positions": {job_id[:8]: position for job_id, position in list(self.queue_positions.items())},
+            "counters": dict(self.counters),
+            "recent_decisions": [{**d, "job_id": d["job_id"][:8] if d["job_id"] else None} for d in list(self.decisions)],
+        }
+
+admission = AdmissionController()
+
+# --- Fair Scheduling ---
+# 排队任务分两条 lane：interactive（用户提交的单次分析）和 bulk（批量/后台任务）。
+# lane 之间按权重、lane 内按用户做步幅调度（stride scheduling），同一用户的任务先进先出；
+# 匿名客户端共用一个 "anonymous" 用户，避免靠多开会话挤占资源
+LANE_WEIGHTS = {"interactive": 3, "bulk": 1}  # 两条 lane 都有任务时约 3:1 领取
+LANE_MAX_RUNNING = {
+    "interactive": MAX_CONCURRENT_TRANSCRIPTIONS,
+    "bulk": max(1, MAX_CONCURRENT_TRANSCRIPTIONS - 1),  # 至少给单次分析留一个 worker
+}
+USER_MAX_RUNNING_JOBS = int(os.environ.get("USER_MAX_RUNNING_JOBS", "2"))  # 每个登录用户同时运行的任务数
+ANONYMOUS_MAX_RUNNING_JOBS = int(os.environ.get("ANONYMOUS_MAX_RUNNING_JOBS", "2"))  # 所有匿名客户端合计
+BULK_MAX_QUEUED_PER_USER = int(os.environ.get("BULK_MAX_QUEUED_PER_USER", "200"))
+
+def fairness_key(user_id: Optional[int]) -> str:
+    return f"user_{user_id}" if user_id else "anonymous"
+
+def user_running_cap(key: str) -> int:
+    return ANONYMOUS_MAX_RUNNING_JOBS if key == "anonymous" else USER_MAX_RUNNING_JOBS
+
+def job_queued_at(job) -> datetime:
+    return job.queued_at or job.created_at
+
+class FairScheduler:
+    """两级步幅调度：每次领取后该 lane 的 pass 增加 1/权重、该用户的 pass 增加 1，总是选 pass 最小的；
+    重新变为活跃的 lane/用户从当前全局 pass 起步，不能凭空闲期间的积累连续抢占"""
+
+    def __init__(self):
+        self.lane_pass = {lane: 0.0 for lane in LANE_WEIGHTS}
+        self.global_lane_pass = 0.0
+        self.user_pass: Dict[tuple, float] = {}  # (lane, fairness_key) -> pass
+        self.global_user_pass = {lane: 0.0 for lane in LANE_WEIGHTS}
+        self.wait_stats = {
+            lane: {"started": 0, "total_wait": 0.0, "max_wait": 0.0, "recent": collections.deque(maxlen=200)}
+            for lane in LANE_WEIGHTS
+        }
+
+    def order(self, queued: List) -> List:
+        """模拟依次领取，返回排队任务的领取顺序（不考虑并发上限，领取时再跳过已达上限的用户）"""
+        queues: Dict[str, Dict[str, collections.deque]] = {}
+        for job in sorted(queued, key=lambda j: (job_queued_at(j), j.id)):
+            queues.setdefault(job.lane or "interactive", {}).setdefault(fairness_key(job.user_id), collections.deque()).append(job)
+        lane_pass = {lane: max(self.lane_pass.get(lane, 0.0), self.global_lane_pass) for lane in queues}
+        user_pass = {
+            (lane, key): max(self.user_pass.get((lane, key), 0.0), self.global_user_pass.get(lane, 0.0))
+            for lane, users in queues.items() for key in users
+        }
+        ordered = []
+        while queues:
+            lane = min(queues, key=lambda l: (lane_pass[l], list(LANE_WEIGHTS).index(l) if l in LANE_WEIGHTS else len(LANE_WEIGHTS)))
+            users = queues[lane]
+            key = min(users, key=lambda k: (user_pass[(lane, k)], job_queued_at(users[k][0])))
+            ordered.append(users[key].popleft())
+            lane_pass[lane] += 1.0 / LANE_WEIGHTS.get(lane, 1)
+            user_pass[(lane, key)] += 1.0
+            if not users[key]:
+                del users[key]
+            if not users:
+                del queues[lane]
+        return ordered
+
+    def served(self, job):
+        """任务被领取：推进 pass 并记录排队等待时间"""
+        lane = job.lane or "interactive"
+        key = fairness_key(job.user_id)
+        start = max(self.lane_pass.get(lane, 0.0), self.global_lane_pass)
+        self.global_lane_pass = start
+        self.lane_pass[lane] = start + 1.0 / LANE_WEIGHTS.get(lane, 1)
+        user_start = max(self.user_pass.get((lane, key), 0.0), self.global_user_pass.get(lane, 0.0))
+        self.global_user_pass[lane] = user_start
+        self.user_pass[(lane, key)] = user_start + 1.0
+        # pass 不高于全局值的用户下次也会被抬到全局值，不必保留
+        self.user_pass = {k: v for k, v in self.user_pass.items() if v > self.global_user_pass.get(k[0], 0.0)}
+
+        waited = max(0.0, (datetime.utcnow() - job_queued_at(job)).total_seconds())
+        stats = self.wait_stats.setdefault(lane, {"started": 0, "total_wait": 0.0, "max_wait": 0.0, "recent": collections.deque(maxlen=200)})
+        stats["started"] += 1
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        stats["recent"].append(waited)
+        print(f"✓ Scheduled job {job.id[:8]} (lane={lane}, user={key}, waited {waited:.1f}s)")
+
+    def lane_stats(self) -> Dict:
+        result = {}
+        for lane, stats in self.wait_stats.items():
+            recent = sorted(stats["recent"])
+            result[lane] = {
+                "weight": LANE_WEIGHTS.get(lane, 1),
+                "max_running": LANE_MAX_RUNNING.get(lane),
+                "started": stats["started"],
+                "avg_wait": round(stats["total_wait"] / stats["started"], 1) if stats["started"] else 0.0,
+                "p50_wait": round(recent[len(recent) // 2], 1) if recent else 0.0,
+                "p95_wait": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1) if recent else 0.0,
+                "max_wait": round(stats["max_wait"], 1),
+            }
+        return result
+
+fair_scheduler = FairScheduler()
+
+# --- Job Queue ---
+# 分析任务持久化在 jobs 表中，由 MAX_CONCURRENT_TRANSCRIPTIONS 个 worker 在准入控制允许时依次领取执行；
+# 进度事件写入 job_events，客户端可随时断开，并通过 /api/jobs/{id}/events?after=N 重新接入
+JOB_TERMINAL_STATES = ("completed", "failed", "cancelled")
+JOB_RETENTION_DAYS = 7  # 已结束任务及其事件的保留天数
+JOB_KEEPALIVE_SECONDS = 15
+
+job_wakeup = asyncio.Event()  # 有新任务入队时唤醒空闲 worker
+job_listeners: Dict[str, set] = {}  # job_id -> 订阅该任务事件流的 asyncio.Event
+cancelled_jobs = set()  # 已请求取消、仍在运行的任务
+job_worker_tasks = []
+job_loop: Optional[asyncio.AbstractEventLoop] = None  # worker 所在的事件循环，start_job_workers 中设置
+job_claim_lock = threading.Lock()  # 领取任务/推送排队位置在线程中执行，避免两个 worker 领到同一个任务
+
+def call_in_job_loop(fn, *args):
+    """asyncio.Event 不是线程安全的：从工作线程（to_thread、同步接口）调用时交给事件循环执行"""
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if job_loop is None or running is job_loop or job_loop.is_closed():
+        fn(*args)
+    else:
+        job_loop.call_soon_threadsafe(fn, *args)
+
+def wake_job_workers():
+    call_in_job_loop(job_wakeup.set)
+
+def job_to_dict(job: Job) -> Dict:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "lane": job.lane,
+        "source_type": job.source_type,
+        "url": job.url,
+        "status": job.status,
+        "error": job.error,
+        "history_id": job.history_id,
+        "failed_chunks": job.failed_chunks or 0,
+        "events": job.event_count or 0,
+        "attempts": job.attempts or 0,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "queued_at": job.queued_at.isoformat() if job.queued_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+def notify_job_listeners(job_id: str):
+    for listener in list(job_listeners.get(job_id, ())):
+        call_in_job_loop(listener.set)
+
+def append_job_event(job_id: str, payload: Dict, **job_updates) -> int:
+    """写入一条任务事件（可同时更新任务字段），返回事件的 seq"""
+    db = SessionLocal()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if not job:
+            return 0
+        job.event_count = (job.event_count or 0) + 1
+        db.add(JobEvent(job_id=job_id, seq=job.event_count, payload=json.dumps({**payload, "job_id": job_id, "seq": job.event_count})))
+        for name, value in job_updates.items():
+            setattr(job, name, value)
+        db.commit()
+        return job.event_count
+    except Exception as e:
+        print(f"✗ Failed to record event for job {job_id[:8]}: {e}")
+        db.rollback()
+        return 0
+    finally:
+        db.close()
+
+def remove_job_upload(job: Job):
+    if job.source_type == "file" and job.file_path and os.path.exists(job.file_path):
+        try:
+            os.remove(job.file_path)
+        except OSError as e:
+            print(f"⚠️  Failed to remove upload for job {job.id[:8]}: {e}")
+
+def cancel_job(job_id: str, reason: str = "Task cancelled") -> Optional[str]:
+    """取消任务：排队中的直接结束，运行中的在下一个检查点停止。返回取消后的状态"""
+    db = SessionLocal()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if not job:
+            return None
+        if job.status == "running":
+            cancelled_jobs.add(job_id)
+            print(f"⚠️  Marking running job as cancelled: {job_id[:8]}")
+            return "cancelling"
+        if job.status != "queued":
+            return job.status
+        remove_job_upload(job)
+    finally:
+        db.close()
+    append_job_event(job_id, {"stage": "error", "msg": reason}, status="cancelled", error=reason, finished_at=datetime.utcnow())
+    notify_job_listeners(job_id)
+    print(f"⚠️  Cancelled queued job {job_id[:8]}")
+    return "cancelled"
+
+def create_job(source_type: str, user_id: Optional[int], url: Optional[str] = None, file_path: Optional[str] = None, content_hash: Optional[str] = None, job_id: Optional[str] = None, lane: str = "interactive", kind: str = "analyze", history_id: Optional[int] = None, secret: Optional[str] = None) -> str:
+    """入队一个任务；新的单次分析会取消同一客户端仍在排队或运行的旧单次分析（批量任务和说话人识别任务不受影响）。
+    匿名任务传入 secret（访问凭证），之后访问该任务须出示同一凭证"""
+    job_id = job_id or uuid.uuid4().hex
+    client_id = f"user_{user_id}" if user_id else f"session_{job_id}"
+    db = SessionLocal()
+    try:
+        previous = []
+        if lane == "interactive" and kind == "analyze":
+            previous = [j.id for j in db.query(Job).filter(
+                Job.client_id == client_id, Job.lane == "interactive", Job.kind == "analyze", Job.status.in_(("queued", "running"))
+            ).all()]
+        db.add(Job(id=job_id, user_id=user_id, client_id=client_id, kind=kind, lane=lane, source_type=source_type, url=url, file_path=file_path, content_hash=content_hash, history_id=history_id,
+                   secret_hash=hashlib.sha256(secret.encode()).hexdigest() if secret else None))
+        db.commit()
+    finally:
+        db.close()
+    for old_id in previous:
+        cancel_job(old_id, "Task cancelled - new analysis started")
+    append_job_event(job_id, {"stage": "queued", "percent": 5, "msg": "Queued for processing..."})
+    print(f"✓ Enqueued {kind} job {job_id[:8]} ({source_type}, lane={lane}, client: {client_id})")
+    wake_job_workers()
+    return job_id
+
+def enforce_admission(upload: bool = False):
+    """入队前检查：单次分析队列已满或内存不足以接收上传时返回 503（批量任务有各自的上限）"""
+    db = SessionLocal()
+    try:
+        queued = db.query(Job).filter(Job.status == "queued", Job.lane == "interactive").count()
+    finally:
+        db.close()
+    reason = admission.rejection_reason(queued, upload=upload)
+    if reason:
+        admission.reject(reason, upload=upload)
+
+def record_job_content_hash(job_id: str, content_hash: str):
+    """记录任务音频的内容哈希，重试时据此复用分片检查点"""
+    db = SessionLocal()
+    try:
+        db.query(Job).filter(Job.id == job_id).update({"content_hash": content_hash})
+        db.commit()
+    finally:
+        db.close()
+
+def retryable(job: Job) -> bool:
+    return job.status in ("failed", "cancelled") or (job.status == "completed" and bool(job.failed_chunks))
+
+def retry_job(job_id: str) -> int:
+    """把已结束的任务重新排队（已转写的分片从检查点恢复），返回重试前最后一个事件的 seq"""
+    db = SessionLocal()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        last_seq = job.event_count or 0
+    finally:
+        db.close()
+    # 保留 history_id：说话人识别任务以它为输入；分析任务重跑后覆盖这条记录，而不是再插入一条
+    append_job_event(job_id, {"stage": "queued", "percent": 5, "msg": "Re-queued, finished chunks will be reused..."},
+                     status="queued", error=None, failed_chunks=0, finished_at=None, queued_at=datetime.utcnow())
+    notify_job_listeners(job_id)
+    print(f"✓ Re-queued job {job_id[:8]} for retry")
+    wake_job_workers()
+    return last_seq
+
+def queued_jobs_in_order(db: Session) -> List[Job]:
+    """排队中的任务，按公平调度的领取顺序"""
+    return fair_scheduler.order(db.query(Job).filter(Job.status == "queued").all())
+
+def publish_queue_positions():
+    """排队位置有变化时向对应任务推送 queued 事件"""
+    with job_claim_lock:
+        db = SessionLocal()
+        try:
+            order = [job.id for job in queued_jobs_in_order(db)]
+        finally:
+            db.close()
+        for position, job_id in enumerate(order, start=1):
+            if admission.queue_positions.get(job_id) == position:
+                continue
+            admission.queue_positions[job_id] = position
+            ahead = f"{position - 1} job(s) ahead" if position > 1 else "next in line"
+            append_job_event(job_id, {"stage": "queued", "percent": 5, "msg": f"Waiting for a processing slot ({ahead})...", "position": position})
+            notify_job_listeners(job_id)
+        for job_id in set(admission.queue_positions) - set(order):
+            admission.queue_positions.pop(job_id, None)
+
+def claim_next_job() -> Optional[Job]:
+    """按公平调度顺序领取第一个未超出用户/lane 并发上限的任务，经准入控制后标记为 running（在线程中调用）"""
+    with job_claim_lock:
+        db = SessionLocal()
+        try:
+            queued = queued_jobs_in_order(db)
+            if not queued:
+                return None
+            running = db.query(Job.user_id, Job.lane).filter(Job.status == "running").all()
+            running_by_user = collections.Counter(fairness_key(user_id) for user_id, _ in running)
+            running_by_lane = collections.Counter(lane or "interactive" for _, lane in running)
+            job = next((
+                j for j in queued
+                if running_by_user[fairness_key(j.user_id)] < user_running_cap(fairness_key(j.user_id))
+                and running_by_lane[j.lane or "interactive"] < LANE_MAX_RUNNING.get(j.lane or "interactive", MAX_CONCURRENT_TRANSCRIPTIONS)
+            ), None)
+            if job is None or not admission.can_admit(job.id):
+                return None
+            fair_scheduler.served(job)
+            job.status = "running"
+            job.started_at = datetime.utcnow()
+            job.attempts = (job.attempts or 0) + 1
+            db.commit()
+            db.refresh(job)
+            db.expunge(job)
+            return job
+        finally:
+            db.close()
+
+async def run_job(job: Job):
+    job_id = job.id
+    print(f"🎯 Worker picked job {job_id[:8]} (attempt {job.attempts})")
+    outcome = {"status": None}
+
+    async def record(payload: Dict):
+        stage = payload.get("stage")
+        updates = {}
+        if stage == "completed":
+            updates = {"status": "completed", "history_id": payload.get("history_id"), "failed_chunks": len(payload.get("failed_spans") or []), "finished_at": datetime.utcnow()}
+        elif stage == "error":
+            status_after = "cancelled" if job_id in cancelled_jobs else "failed"
+            updates = {"status": status_after, "error": payload.get("msg"), "finished_at": datetime.utcnow()}
+        if updates:
+            outcome["status"] = updates["status"]
+        admission.advance(job_id, payload)
+        await asyncio.to_thread(append_job_event, job_id, payload, **updates)
+        notify_job_listeners(job_id)
+
+    try:
+        if job.kind == "speakers":
+            events = identify_speakers_logic(job.history_id, is_cancelled=lambda: job_id in cancelled_jobs)
+        else:
+            if job.source_type == "file" and not (job.file_path and os.path.exists(job.file_path)):
+                await record({"stage": "error", "msg": "Uploaded file is no longer available, please upload again"})
+                return
+            events = process_audio_logic(
+                job.source_type, job.user_id, url=job.url, file_path=job.file_path, session_id=job_id,
+                is_cancelled=lambda: job_id in cancelled_jobs, content_hash=job.content_hash, history_id=job.history_id
+            )
+        async for event in events:
+            await record(json.loads(event[len("data: "):]))
+        if outcome["status"] is None:
+            # 在检查点被取消时管道直接返回，没有结束事件
+            msg = "Task cancelled" if job_id in cancelled_jobs else "Analysis ended without a result"
+            await record({"stage": "error", "msg": msg})
+    except Exception as e:
+        print(f"✗ Job {job_id[:8]} crashed: {e}")
+        if outcome["status"] is None:
+            await record({"stage": "error", "msg": str(e)})
+    finally:
+        cancelled_jobs.discard(job_id)
+        admission.release(job_id)
+        job_wakeup.set()  # 释放的内存可能允许下一个任务开始
+        print(f"✓ Job {job_id[:8]} finished: {outcome['status']}")
+
+async def job_worker(worker_id: int):
+    while True:
+        job = await asyncio.to_thread(claim_next_job)
+        if job is None:
+            job_wakeup.clear()
+            job = await asyncio.to_thread(claim_next_job)  # clear 之后再查一次，避免错过刚入队的任务
+            if job is None:
+                await asyncio.to_thread(publish_queue_positions)
+                try:
+                    # 内存不足而推迟时定期重新检查（内存也可能被其他进程释放）
+                    await asyncio.wait_for(job_wakeup.wait(), timeout=ADMISSION_RECHECK_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+        await asyncio.to_thread(publish_queue_positions)
+        await run_job(job)
+
+def recover_jobs():
+    """启动时把上次进程中断的 running 任务放回队列，并清理过期的已结束任务"""
+    db = SessionLocal()
+    try:
+        interrupted = [j.id for j in db.query(Job).filter(Job.status == "running").all()]
+        cutoff = datetime.utcnow() - timedelta(days=JOB_RETENTION_DAYS)
+        expired_jobs = db.query(Job).filter(Job.status.in_(JOB_TERMINAL_STATES), Job.created_at < cutoff).all()
+        expired = [j.id for j in expired_jobs]
+        for job in expired_jobs:
+            remove_job_upload(job)  # 失败任务为重试保留的上传文件
+        if expired:
+            db.query(JobEvent).filter(JobEvent.job_id.in_(expired)).delete(synchronize_session=False)
+            db.query(Job).filter(Job.id.in_(expired)).delete(synchronize_session=False)
+            db.commit()
+            print(f"✓ Purged {len(expired)} finished jobs older than {JOB_RETENTION_DAYS} days")
+    finally:
+        db.close()
+    for job_id in interrupted:
+        append_job_event(job_id, {"stage": "queued", "percent": 5, "msg": "Server restarted, job re-queued..."}, status="queued")
+    if interrupted:
+        print(f"✓ Re-queued {len(interrupted)} interrupted jobs")
+
+def load_job_events(job_id: str, after: int):
+    """返回 (任务状态, [(seq, payload)])；先读状态再读事件，状态为终态时事件一定是完整的"""
+    db = SessionLocal()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if not job:
+            return None, []
+        events = db.query(JobEvent.seq, JobEvent.payload).filter(
+            JobEvent.job_id == job_id, JobEvent.seq > after
+        ).order_by(JobEvent.seq).all()
+        return job.status, events
+    finally:
+        db.close()
+
+async def stream_job_events(job_id: str, after: int = 0):
+    """回放 seq > after 的事件，然后实时推送，直到任务结束；客户端断开不影响任务执行"""
+    listener = asyncio.Event()
+    job_listeners.setdefault(job_id, set()).add(listener)
+    try:
+        while True:
+            listener.clear()
+            status_now, events = await asyncio.to_thread(load_job_events, job_id, after)
+            for seq, payload in events:
+                after = seq
+                yield f"data: {payload}\n\n"
+            if status_now is None or status_now in JOB_TERMINAL_STATES:
+                return
+            try:
+                await asyncio.wait_for(listener.wait(), timeout=JOB_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        listeners = job_listeners.get(job_id)
+        if listeners is not None:
+            listeners.discard(listener)
+            if not listeners:
+                job_listeners.pop(job_id, None)
+
+@app.on_event("startup")
+def start_clients():
+    clients.start()
+
+@app.on_event("shutdown")
+async def close_clients():
+    await clients.aclose()
+
+@app.on_event("startup")
+async def backfill_history_list_fields():
+    await asyncio.to_thread(backfill_history_index)
+
+@app.on_event("startup")
+async def backfill_search():
+    await asyncio.to_thread(backfill_search_index)
+
+@app.on_event("startup")
+async def prune_llm_cache():
+    await asyncio.to_thread(llm_cache.prune)
+
+@app.on_event("startup")
+async def start_job_workers():
+    global job_loop
+    job_loop = asyncio.get_running_loop()
+    recover_jobs()
+    for worker_id in range(MAX_CONCURRENT_TRANSCRIPTIONS):
+        job_worker_tasks.append(asyncio.create_task(job_worker(worker_id)))
+    job_wakeup.set()
+    print(f"✓ Started {MAX_CONCURRENT_TRANSCRIPTIONS} job workers")
+
+# --- Speaker Identification Jobs ---
+# 说话人识别作为 kind="speakers" 的任务进入同一队列：接口立即返回 202 和任务ID，
+# 按分段推送进度，完成后写入 HistoryItem.speaker_transcript；同一条历史记录同时只有一个识别任务
+
+def speaker_transcript_is_valid(text: Optional[str]) -> bool:
+    """缓存的说话人版本至少应有 20% 的行带说话人格式"""
+    if not text or len(text) <= 100:
+        return False
+    speaker_lines = [l for l in text.split('\n') if ':' in l and '[' in l]
+    total_lines = len([l for l in text.split('\n') if l.strip()])
+    return len(speaker_lines) >= total_lines * 0.2
+
+def active_speaker_job(db: Session, history_id: int) -> Optional[Job]:
+    return db.query(Job).filter(
+        Job.kind == "speakers", Job.history_id == history_id, Job.status.in_(("queued", "running"))
+    ).order_by(Job.created_at.desc()).first()
+
+def latest_job_event(db: Session, job: Job) -> Optional[Dict]:
+    event = db.query(JobEvent.payload).filter(JobEvent.job_id == job.id, JobEvent.seq == job.event_count).first()
+    return json.loads(event[0]) if event else None
+
+async def identify_speakers_logic(history_id: int, is_cancelled=None):
+    """说话人识别任务的执行体，事件格式与 process_audio_logic 相同"""
+    db = SessionLocal()
+    try:
+        item = db.query(HistoryItem).filter(HistoryItem.id == history_id).first()
+        original_transcript = ""
+        if item:
+            try:
+                original_transcript = json.loads(item.data_json).get("transcript", "")
+            except json.JSONDecodeError:
+                pass
+    finally:
+        db.close()
+    if not item:
+        yield f"data: {json.dumps({'stage': 'error', 'msg': 'History item not found'})}\n\n"
+        return
+    if not original_transcript or len(original_transcript) < 50:
+        yield f"data: {json.dumps({'stage': 'error', 'msg': 'No valid transcript available'})}\n\n"
+        return
+
+    print(f"Starting speaker identification for history {history_id}")
+    print(f"Input: {len(original_transcript)} chars, ~{len(original_transcript.split())} words")
+    yield f"data: {json.dumps({'stage': 'identifying_speakers', 'percent': 10, 'msg': 'Identifying speakers...', 'chunks_done': 0})}\n\n"
+
+    # 工作线程每完成一个分段就放入 progress，这里转成进度事件
+    client = clients.groq
+    progress = collections.deque()
+    task = asyncio.ensure_future(asyncio.to_thread(
+        format_transcript_with_speakers, client, original_transcript, lambda done, total: progress.append((done, total))
+    ))
+    while True:
+        if not task.done():
+            await asyncio.wait({task}, timeout=0.5)
+        while progress:
+            done, total = progress.popleft()
+            percent = 10 + int(85 * done / total)
+            yield f"data: {json.dumps({'stage': 'identifying_speakers', 'percent': percent, 'msg': f'Identified speakers in {done}/{total} chunks', 'chunks_done': done, 'chunks_total': total})}\n\n"
+        if task.done():
+            break
+        if is_cancelled and is_cancelled():
+            # 已提交的分段仍会在线程中跑完，结果丢弃
+            print(f"⚠️  Speaker identification cancelled for history {history_id}")
+            return
+
+    try:
+        speaker_transcript = task.result()
+        if not speaker_transcript or len(speaker_transcript) < 50:
+            raise Exception("Generated transcript too short or empty")
+        if '[' not in speaker_transcript:
+            print("⚠ Warning: Generated transcript missing timestamps")
+    except Exception as e:
+        print(f"✗ Speaker identification failed: {e}")
+        yield f"data: {json.dumps({'stage': 'error', 'msg': f'AI processing failed: {e}'})}\n\n"
+        return
+
+    db = SessionLocal()
+    try:
+        db.query(HistoryItem).filter(HistoryItem.id == history_id).update({"speaker_transcript": speaker_transcript})
+        assign_segment_speakers(db, history_id, speaker_transcript)
+        db.commit()
+        print(f"✓ Saved to database: {len(speaker_transcript)} chars")
+    except Exception as e:
+        db.rollback()
+        print(f"⚠ Database save failed: {e}")
+        yield f"data: {json.dumps({'stage': 'error', 'msg': f'Failed to save speaker transcript: {e}'})}\n\n"
+        return
+    finally:
+        db.close()
+
+    yield f"data: {json.dumps({'stage': 'completed', 'percent': 100, 'history_id': history_id, 'speaker_transcript': speaker_transcript, 'cached': False})}\n\n"
 
 # --- API Endpoints ---
 
@@ -1906,6 +5253,57 @@ async def process_audio_logic(source_type: str, user_id: Optional[int], url: str
 def health():
     return {"status": "ok"}
 
+@app.get("/api/cache/stats", dependencies=[Depends(require_admin)])
+def cache_stats(db: Session = Depends(get_db)):
+    """分析结果缓存命中率（进程级计数 + 持久化的累计命中次数）"""
+    lookups = analysis_cache_stats["lookups"]
+    total_saved = sum(count or 0 for (count,) in db.query(AnalysisCache.hit_count).all())
+    return {
+        **analysis_cache_stats,
+        "hit_rate": round(analysis_cache_stats["hits"] / lookups, 4) if lookups else 0.0,
+        "entries": db.query(AnalysisCache).count(),
+        "total_runs_saved": total_saved,
+    }
+
+@app.get("/api/clients/stats", dependencies=[Depends(require_admin)])
+def client_stats():
+    """共享 Groq/HTTP 客户端的请求数、新建连接数和连接复用率"""
+    return clients.snapshot()
+
+@app.get("/api/cache/llm", dependencies=[Depends(require_admin)])
+def llm_cache_stats():
+    """LLM 响应缓存的命中率、大小和按提示词版本的统计"""
+    return llm_cache.snapshot()
+
+@app.get("/api/admin/admission", dependencies=[Depends(require_admin)])
+def admission_stats():
+    """准入控制：当前内存、运行中任务的阶段、排队位置和最近的准入/推迟/拒绝记录"""
+    return admission.snapshot()
+
+@app.get("/api/admin/queue", dependencies=[Depends(require_admin)])
+def queue_stats(db: Session = Depends(get_db)):
+    """任务队列：各 lane 的排队/运行数和排队等待时间，各用户（匿名合计）的排队/运行数"""
+    lanes = fair_scheduler.lane_stats()
+    now = datetime.utcnow()
+    users = {}
+    for job in db.query(Job).filter(Job.status.in_(("queued", "running"))).all():
+        lane = job.lane or "interactive"
+        lane_info = lanes.setdefault(lane, {})
+        lane_info[job.status] = lane_info.get(job.status, 0) + 1
+        if job.status == "queued":
+            waited = (now - job_queued_at(job)).total_seconds()
+            lane_info["oldest_queued_wait"] = round(max(lane_info.get("oldest_queued_wait", 0.0), waited), 1)
+        user = users.setdefault(fairness_key(job.user_id), {"queued": 0, "running": 0})
+        user[job.status] += 1
+    for key, user in users.items():
+        user["max_running"] = user_running_cap(key)
+    return {"lanes": lanes, "users": users}
+
+@app.get("/api/scheduler/stats", dependencies=[Depends(require_admin)])
+def scheduler_stats():
+    """Groq 调度器各模型的队列深度、限流次数和平均等待时间"""
+    return {"limits": {m: {"rpm": r, "burst": c} for m, (r, c) in GROQ_RATE_LIMITS.items()}, "models": groq_scheduler.snapshot()}
+
 @app.post("/api/auth/register", response_model=Token)
 def register(user: UserCreate, db: Session = Depends(get_db)):
     try:
@@ -1945,39 +5343,49 @@ def read_users_me(current_user: User = Depends(get_current_user)):
     return {"username": current_user.username, "id": current_user.id}
 
 @app.get("/api/history")
-def get_history(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """获取历史记录列表（仅基本信息，不包含大内容如 summary 和 transcript）"""
-    items = db.query(HistoryItem).filter(HistoryItem.user_id == current_user.id).order_by(HistoryItem.created_at.desc()).all()
-    results = []
-    for item in items:
-        try:
-            data = json.loads(item.data_json) if item.data_json else {}
-            # 只提取基本信息
-            summary = data.get('summary', {})
-            overview = summary.get('overview', {}) if isinstance(summary, dict) else {}
-            
-            results.append({
-                "id": item.id,
-                "title": item.title or summary.get('title', 'Untitled'),
-                "created_at": item.created_at.isoformat() if item.created_at else datetime.utcnow().isoformat(),
-                "audio_url": item.audio_url if hasattr(item, 'audio_url') else None,
-                "type": overview.get('type', 'Podcast') if isinstance(overview, dict) else 'Podcast',
-                # 不包含 summary 详情和 transcript（节省带宽）
-            })
-        except Exception as e:
-            print(f"Error processing history item {item.id}: {e}")
-            results.append({
-                "id": item.id,
-                "title": item.title or "Untitled",
-                "created_at": item.created_at.isoformat() if item.created_at else datetime.utcnow().isoformat(),
-                "audio_url": None,
-                "type": "Podcast"
-            })
-    return results
+def get_history(
+    response: Response,
+    before: Optional[str] = None,
+    limit: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """获取历史记录列表（仅基本信息，不读取 data_json）。传 limit 时分页：
+    下一页的游标 "<created_at>,<id>" 在 X-Next-Before 响应头中，作为 before 传回"""
+    query = db.query(
+        HistoryItem.id, HistoryItem.title, HistoryItem.created_at, HistoryItem.audio_url,
+        HistoryItem.summary_type, HistoryItem.duration_seconds, HistoryItem.snippet
+    ).filter(HistoryItem.user_id == current_user.id)
+    if before:
+        created_at, item_id = parse_history_cursor(before)
+        query = query.filter(
+            (HistoryItem.created_at < created_at) | ((HistoryItem.created_at == created_at) & (HistoryItem.id < item_id))
+        )
+    query = query.order_by(HistoryItem.created_at.desc(), HistoryItem.id.desc())
+    if limit is not None:
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+        query = query.limit(limit)
+    rows = query.all()
+    if limit is not None and len(rows) == limit and rows[-1].created_at:
+        response.headers["X-Next-Before"] = f"{rows[-1].created_at.isoformat()},{rows[-1].id}"
+    return [
+        {
+            "id": row.id,
+            "title": row.title or "Untitled",
+            "created_at": row.created_at.isoformat() if row.created_at else datetime.utcnow().isoformat(),
+            "audio_url": row.audio_url,
+            "type": row.summary_type or "Podcast",
+            "duration_seconds": row.duration_seconds,
+            "snippet": row.snippet,
+            # 不包含 summary 详情和 transcript（节省带宽）
+        }
+        for row in rows
+    ]
 
 @app.get("/api/history/{history_id}")
-def get_history_detail(history_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """获取单条历史记录的完整详情（包含 summary 和 transcript）"""
+def get_history_detail(history_id: str, include_transcript: bool = True, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """获取单条历史记录的完整详情（包含 summary 和 transcript）；include_transcript=false 时不带文稿，
+    由 /api/history/{id}/transcript 分页加载"""
     history_item = db.query(HistoryItem).filter(
         HistoryItem.id == history_id,
         HistoryItem.user_id == current_user.id
@@ -1990,7 +5398,7 @@ def get_history_detail(history_id: str, current_user: User = Depends(get_current
         data = json.loads(history_item.data_json) if history_item.data_json else {}
         # 返回完整的 summary 和 transcript
         analysis_result = data.get('summary', {})
-        if data.get('transcript'):
+        if data.get('transcript') and include_transcript:
             analysis_result['transcript'] = data.get('transcript')
         if data.get('local_audio_path'):
             analysis_result['local_audio_path'] = data.get('local_audio_path')
@@ -2006,70 +5414,257 @@ def get_history_detail(history_id: str, current_user: User = Depends(get_current
         print(f"Error loading history detail {history_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to load history detail: {str(e)}")
 
-def web_search(query: str, max_results: int = 5) -> str:
-    """使用 DuckDuckGo 进行网络搜索"""
-    try:
-        from duckduckgo_search import DDGS
-        
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, max_results=max_results))
-            
-        if not results:
-            return "No search results found."
-        
-        # 格式化搜索结果
-        formatted_results = []
-        for i, result in enumerate(results, 1):
-            formatted_results.append(
-                f"{i}. {result.get('title', 'No title')}\n"
-                f"   {result.get('body', 'No description')}\n"
-                f"   URL: {result.get('href', 'No URL')}"
-            )
-        
-        return "\n\n".join(formatted_results)
-    except Exception as e:
-        print(f"Search error: {e}")
-        return f"Search failed: {str(e)}"
+@app.get("/api/history/{history_id}/transcript")
+def get_history_transcript(
+    history_id: int,
+    from_seconds: Optional[float] = Query(None, alias="from"),
+    to_seconds: Optional[float] = Query(None, alias="to"),
+    limit: int = TRANSCRIPT_PAGE_DEFAULT,
+    cursor: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """分页读取文稿分段：from/to（秒）筛选与该时间范围重叠的分段，cursor 为上一页返回的 next_cursor"""
+    item = db.query(HistoryItem).filter(
+        HistoryItem.id == history_id,
+        HistoryItem.user_id == current_user.id
+    ).first()
+    if not item:
+        raise HTTPException(status_code=404, detail="History item not found")
+    total = ensure_transcript_segments(db, item)
+
+    limit = max(1, min(limit, TRANSCRIPT_PAGE_MAX))
+    query = db.query(TranscriptSegment).filter(TranscriptSegment.history_id == history_id)
+    if from_seconds is not None:
+        query = query.filter(TranscriptSegment.end_time >= from_seconds)
+    if to_seconds is not None:
+        query = query.filter(TranscriptSegment.start_time <= to_seconds)
+    if cursor is not None:
+        query = query.filter(TranscriptSegment.position > cursor)
+    rows = query.order_by(TranscriptSegment.position).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "history_id": history_id,
+        "total": total,
+        "segments": [
+            {"index": row.position, "start": row.start_time, "end": row.end_time, "text": row.text, "speaker": row.speaker}
+            for row in rows
+        ],
+        "next_cursor": rows[-1].position if has_more else None,
+    }
 
-@app.post("/api/chat")
-async def chat(
-    request: ChatRequest,
-    current_user: User = Depends(get_current_user)
+@app.get("/api/search")
+def search_history(
+    q: str,
+    limit: int = 20,
+    kind: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
 ):
-    try:
-        client = Groq(api_key=GROQ_API_KEY)
-        
-        # Construct context string
-        context_str = f"""
-        Podcast Title: {request.context.get('title', 'Unknown')}
-        Summary: {request.context.get('overview', {}).get('summary', '')}
-        Core Conclusions: {json.dumps(request.context.get('coreConclusions', []), ensure_ascii=False)}
-        """
-
-        # Define web search tool for function calling
-        tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "web_search",
-                    "description": "Search the web for current information, news, facts, or any knowledge not in the podcast context. Use this when the user asks about topics not covered in the podcast, or needs real-time/updated information.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "The search query to look up on the web"
-                            }
-                        },
-                        "required": ["query"]
+    """在当前用户的文稿分段和总结条目中全文搜索，按 BM25 排序；kind 可限定为 segment 或某个总结字段"""
+    if not SEARCH_AVAILABLE:
+        raise HTTPException(status_code=503, detail="Full-text search is not available on this server")
+    if kind and kind != "segment" and kind not in SEARCH_SUMMARY_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown kind: {kind} (valid: segment, {', '.join(SEARCH_SUMMARY_FIELDS)})")
+    expression = search_match_expression(q, current_user.id)
+    if not expression:
+        raise HTTPException(status_code=400, detail="Query must contain at least one word")
+    started = time.perf_counter()
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    rows = db.execute(text(
+        "SELECT history_id, kind, start_time, end_time, body, bm25(search_index, 1.0, 0.0, 0.0) AS score FROM search_index "
+        "WHERE search_index MATCH :match" + (" AND kind = :kind" if kind else "") + " ORDER BY score LIMIT :limit"
+    ), {"match": expression, "kind": kind, "limit": limit}).fetchall()
+    titles = dict(db.query(HistoryItem.id, HistoryItem.title).filter(HistoryItem.id.in_({row.history_id for row in rows})).all()) if rows else {}
+    terms = q.split()
+    hits = [
+        {
+            "history_id": row.history_id,
+            "title": titles.get(row.history_id) or "Untitled",
+            "kind": row.kind,
+            "start": row.start_time,
+            "end": row.end_time,
+            "range": f"[{format_time(row.start_time)} - {format_time(row.end_time)}]" if row.start_time is not None else None,
+            "snippet": highlight_snippet(row.body, terms),
+            "score": round(-row.score, 4),  # bm25() 越小越相关，取反后越大越好
+        }
+        for row in rows
+    ]
+    return {"query": q, "took_ms": round((time.perf_counter() - started) * 1000, 1), "hits": hits}
+
+# --- Web Search ---
+# 对话工具 web_search：结果按规范化后的查询缓存（TTL + 条数上限），相同查询在途时合并为一次请求，
+# 并限制并发和超时。WEB_SEARCH_BACKEND=stub 时使用本地假数据，便于离线压测对话的工具调用流程
+WEB_SEARCH_BACKEND = os.environ.get("WEB_SEARCH_BACKEND", "duckduckgo")
+WEB_SEARCH_TTL_SECONDS = int(os.environ.get("WEB_SEARCH_TTL_SECONDS", "3600"))
+WEB_SEARCH_CACHE_ENTRIES = int(os.environ.get("WEB_SEARCH_CACHE_ENTRIES", "512"))
+WEB_SEARCH_TIMEOUT = float(os.environ.get("WEB_SEARCH_TIMEOUT", "8"))
+WEB_SEARCH_CONCURRENCY = int(os.environ.get("WEB_SEARCH_CONCURRENCY", "3"))
+WEB_SEARCH_STUB_DELAY = float(os.environ.get("WEB_SEARCH_STUB_DELAY", "0.5"))  # stub 模拟的外部查询耗时（秒）
+
+def duckduckgo_search_results(query: str, max_results: int) -> List[Dict]:
+    """使用 DuckDuckGo 进行网络搜索"""
+    from duckduckgo_search import DDGS
+
+    with DDGS(timeout=int(WEB_SEARCH_TIMEOUT)) as ddgs:
+        return list(ddgs.text(query, max_results=max_results))
+
+def stub_search_results(query: str, max_results: int) -> List[Dict]:
+    """离线假数据：按查询生成固定结果，并按 WEB_SEARCH_STUB_DELAY 模拟耗时"""
+    time.sleep(WEB_SEARCH_STUB_DELAY)
+    return [
+        {"title": f"{query} - result {i}", "body": f"Stub search result {i} for \"{query}\".", "href": f"https://example.com/search/{i}?q={query}"}
+        for i in range(1, max_results + 1)
+    ]
+
+WEB_SEARCH_BACKENDS = {
+    "duckduckgo": duckduckgo_search_results,
+    "stub": stub_search_results,
+}
+
+def normalize_search_query(query: str) -> str:
+    """缓存 key：全半角统一、小写、合并空白、去掉首尾标点"""
+    value = unicodedata.normalize("NFKC", query or "").lower()
+    return re.sub(r'\s+', ' ', value).strip(" \t?？!！.。,，;；:：\"'")
+
+def format_search_results(results: List[Dict]) -> str:
+    if not results:
+        return "No search results found."
+
+    # 格式化搜索结果
+    formatted_results = []
+    for i, result in enumerate(results, 1):
+        formatted_results.append(
+            f"{i}. {result.get('title', 'No title')}\n"
+            f"   {result.get('body', 'No description')}\n"
+            f"   URL: {result.get('href', 'No URL')}"
+        )
+    return "\n\n".join(formatted_results)
+
+class WebSearcher:
+    """带 TTL/LRU 缓存、在途合并、并发上限和超时的搜索；backend 是同步函数 (query, max_results) -> 结果列表，
+    在线程中执行。失败和超时不缓存"""
+
+    def __init__(self, backend, ttl: int = WEB_SEARCH_TTL_SECONDS, max_entries: int = WEB_SEARCH_CACHE_ENTRIES,
+                 timeout: float = WEB_SEARCH_TIMEOUT, concurrency: int = WEB_SEARCH_CONCURRENCY):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._cache: "collections.OrderedDict[tuple, tuple]" = collections.OrderedDict()  # key -> (过期时间, 文本)
+        self._in_flight: Dict[tuple, asyncio.Future] = {}
+        # 专用线程池限制并发：超时只是不再等待，线程仍会跑完当前查询并一直占着名额，
+        # 慢后端不会因为反复超时堆积出越来越多的线程（也不占用默认线程池）
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="web-search")
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "timeouts": 0, "errors": 0, "evictions": 0}
+
+    async def search(self, query: str, max_results: int = 5) -> str:
+        key = (normalize_search_query(query), max_results)
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached[1]
+            del self._cache[key]
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            # 查询作为独立任务执行：发起请求的客户端断开，合并进来的其他请求仍能拿到结果
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._fetch(key, query, max_results))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: tuple, query: str, max_results: int) -> str:
+        started = time.perf_counter()
+        lookup = asyncio.get_running_loop().run_in_executor(self._executor, self.backend, query, max_results)
+        try:
+            # 超时包含排队等待线程的时间；尚未开始的查询会随之取消
+            results = await asyncio.wait_for(lookup, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            print(f"⚠️  Web search timed out after {self.timeout:g}s: {query}")
+            return f"Search failed: timed out after {self.timeout:g}s"
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Search error: {e}")
+            return f"Search failed: {str(e)}"
+        print(f"✓ Web search ({len(results)} results) in {(time.perf_counter() - started) * 1000:.0f} ms: {query}")
+        result = format_search_results(results)
+        self._cache[key] = (time.monotonic() + self.ttl, result)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.stats["evictions"] += 1
+        return result
+
+    def snapshot(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"]
+        return {
+            "backend": getattr(self.backend, "__name__", str(self.backend)),
+            "entries": len(self._cache),
+            "in_flight": len(self._in_flight),
+            "hit_rate": round((self.stats["hits"] + self.stats["coalesced"]) / lookups, 3) if lookups else 0.0,
+            **self.stats,
+        }
+
+web_searcher = WebSearcher(WEB_SEARCH_BACKENDS.get(WEB_SEARCH_BACKEND, duckduckgo_search_results))
+
+async def web_search(query: str, max_results: int = 5) -> str:
+    return await web_searcher.search(query, max_results)
+
+@app.get("/api/cache/web-search", dependencies=[Depends(require_admin)])
+def web_search_cache_stats():
+    """web_search 缓存的命中、合并、超时统计"""
+    return web_searcher.snapshot()
+
+# 对话可用的工具（function calling）
+CHAT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "web_search",
+            "description": "Search the web for current information, news, facts, or any knowledge not in the podcast context. Use this when the user asks about topics not covered in the podcast, or needs real-time/updated information.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "The search query to look up on the web"
                     }
-                }
+                },
+                "required": ["query"]
             }
-        ]
-
-        # Initial message
-        messages = [
-            {"role": "system", "content": f"""You are a helpful AI assistant. You have access to:
+        }
+    }
+]
+
+def build_chat_messages(request: ChatRequest, user_id: int):
+    """检索文稿片段并组装 system prompt，返回 (messages, sources)；会查数据库，在线程中调用"""
+    # 从完整文稿中检索与问题相关的分段，连同概要一起作为上下文
+    started = time.perf_counter()
+    excerpts = retrieve_chat_context(request.message, request.history_id, user_id, request.context)
+    print(f"✓ Retrieved {len(excerpts)} transcript segments in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    # Construct context string
+    context_str = f"""
+    Podcast Title: {request.context.get('title', 'Unknown')}
+    Summary: {request.context.get('overview', {}).get('summary', '')}
+    Core Conclusions: {json.dumps(request.context.get('coreConclusions', []), ensure_ascii=False)}
+    """
+    if excerpts:
+        context_str += f"""
+    Transcript Excerpts (most relevant to the question, with timestamps):
+{format_retrieved_segments(excerpts)}
+    """
+    sources = [{"start": s["start"], "end": s["end"], "range": f"{format_time(s['start'])} - {format_time(s['end'])}"} for s in excerpts]
+
+    messages = [
+        {"role": "system", "content": f"""You are a helpful AI assistant. You have access to:
 1. Podcast context (provided below) - use this to answer questions about the podcast
 2. Web search tool - use this ONLY when the question requires information not in the podcast context
 
@@ -2077,18 +5672,46 @@ Podcast Context:
 {context_str}
 
 Guidelines:
-- For questions about the podcast content, use the context provided
+- For questions about the podcast content, use the context provided, including the transcript excerpts
+- When your answer draws on a transcript excerpt, cite its timestamp range, e.g. [12:30 - 13:05]
 - For questions about external topics, current events, or general knowledge, use web_search
+- Do not search the web for details the transcript excerpts already cover
 - Keep answers concise and relevant
 - If using search results, cite your sources"""},
-            {"role": "user", "content": request.message}
-        ]
+        {"role": "user", "content": request.message}
+    ]
+    return messages, sources
+
+async def run_chat_tool(name: str, arguments: str):
+    """执行模型请求的工具调用，返回 (query, 结果文本)"""
+    try:
+        function_args = json.loads(arguments or "{}")
+    except json.JSONDecodeError:
+        function_args = {}
+    if name != "web_search":
+        return "", f"Unknown tool: {name}"
+    search_query = function_args.get("query", "")
+    print(f"Executing web search: {search_query}")
+    return search_query, await web_search(search_query)
+
+@app.post("/api/chat")
+async def chat(
+    request: ChatRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # 鉴权用的会话在响应结束后才关闭，先归还连接，避免等待 LLM 期间占着连接池
+    db.close()
+    try:
+        client = clients.async_groq
+        messages, sources = await asyncio.to_thread(build_chat_messages, request, current_user.id)
 
         # First API call
-        response = client.chat.completions.create(
+        response = await groq_chat_async(
+            client, PRIORITY_INTERACTIVE,
             model="qwen/qwen3-32b",  # Using Qwen3-32B model
             messages=messages,
-            tools=tools,
+            tools=CHAT_TOOLS,
             tool_choice="auto",
             temperature=0.7,
             max_tokens=1024
@@ -2102,196 +5725,320 @@ Guidelines:
             messages.append(response_message)
             
             for tool_call in response_message.tool_calls:
-                if tool_call.function.name == "web_search":
-                    function_args = json.loads(tool_call.function.arguments)
-                    search_query = function_args.get("query", "")
-                    
-                    print(f"Executing web search: {search_query}")
-                    search_results = web_search(search_query)
-                    
-                    # Add function response
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "name": "web_search",
-                        "content": search_results
-                    })
+                _, tool_result = await run_chat_tool(tool_call.function.name, tool_call.function.arguments)
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "name": tool_call.function.name,
+                    "content": tool_result
+                })
             
             # Second API call with search results
-            final_response = client.chat.completions.create(
+            final_response = await groq_chat_async(
+                client, PRIORITY_INTERACTIVE,
                 model="qwen/qwen3-32b",
                 messages=messages,
                 temperature=0.7,
                 max_tokens=1024
             )
             
-            return {"response": final_response.choices[0].message.content}
+            return {"response": final_response.choices[0].message.content, "sources": sources}
         else:
             # No tool call needed, return direct response
-            return {"response": response_message.content}
+            return {"response": response_message.content, "sources": sources}
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Chat Error: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+async def stream_chat_events(request: ChatRequest, user_id: int):
+    """流式对话：依次推送 context（引用的文稿片段）、token、tool_call/tool_result（联网搜索）、
+    第二轮的 token，最后是 completed（完整回答）或 error"""
+    def event(payload: Dict) -> str:
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def stream_tokens(**kwargs):
+        """流式请求一轮，逐段产出文本；工具调用的增量按 index 拼接到 tool_calls"""
+        stream = await groq_chat_async(clients.async_groq, PRIORITY_INTERACTIVE, model="qwen/qwen3-32b", temperature=0.7, max_tokens=1024, stream=True, **kwargs)
+        async with stream:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                for call in delta.tool_calls or []:
+                    entry = tool_calls.setdefault(call.index, {"id": "", "name": "", "arguments": ""})
+                    entry["id"] = call.id or entry["id"]
+                    if call.function:
+                        entry["name"] += call.function.name or ""
+                        entry["arguments"] += call.function.arguments or ""
+                if delta.content:
+                    yield delta.content
+
+    try:
+        messages, sources = await asyncio.to_thread(build_chat_messages, request, user_id)
+        yield event({"stage": "context", "sources": sources})
+
+        tool_calls: Dict[int, Dict] = {}
+        parts = []
+        async for content in stream_tokens(messages=messages, tools=CHAT_TOOLS, tool_choice="auto"):
+            parts.append(content)
+            yield event({"stage": "token", "content": content})
+
+        if tool_calls:
+            calls = [tool_calls[index] for index in sorted(tool_calls)]
+            messages.append({
+                "role": "assistant",
+                "content": "".join(parts) or None,
+                "tool_calls": [{"id": c["id"], "type": "function", "function": {"name": c["name"], "arguments": c["arguments"]}} for c in calls],
+            })
+            for call in calls:
+                query = ""
+                try:
+                    query = json.loads(call["arguments"] or "{}").get("query", "")
+                except (json.JSONDecodeError, AttributeError):
+                    pass
+                yield event({"stage": "tool_call", "name": call["name"], "query": query, "msg": f"Searching the web for \"{query}\"..."})
+                _, tool_result = await run_chat_tool(call["name"], call["arguments"])
+                messages.append({"role": "tool", "tool_call_id": call["id"], "name": call["name"], "content": tool_result})
+                yield event({"stage": "tool_result", "name": call["name"], "query": query})
+
+            # 第二轮带上搜索结果，同样流式返回
+            parts = []
+            async for content in stream_tokens(messages=messages):
+                parts.append(content)
+                yield event({"stage": "token", "content": content})
+
+        yield event({"stage": "completed", "response": "".join(parts), "sources": sources})
+    except HTTPException as e:
+        yield event({"stage": "error", "msg": e.detail})
+    except Exception as e:
+        print(f"Chat Stream Error: {e}")
+        import traceback
+        traceback.print_exc()
+        yield event({"stage": "error", "msg": str(e)})
+
+@app.post("/api/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # 与 /api/chat 相同的上下文和工具，但以 SSE 逐 token 推送；客户端断开时关闭上游流。
+    # 鉴权用的会话要到流结束才关闭，先归还连接
+    db.close()
+    return StreamingResponse(stream_chat_events(request, current_user.id), media_type="text/event-stream")
+
+def job_response_headers(job_id: str, secret: Optional[str]) -> Dict[str, str]:
+    headers = {"X-Job-Id": job_id}
+    if secret:
+        headers["X-Job-Secret"] = secret
+    return headers
+
 @app.post("/api/analyze/url")
 async def analyze_url(
     url: str = Form(...), 
     token: Optional[str] = Depends(oauth2_scheme_optional)
 ):
     # 可选认证：如果有token则验证并获取user_id，否则使用None
-    user_id = None
-    if token:
-        try:
-            db = SessionLocal()
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username: str = payload.get("sub")
-            if username:
-                user = db.query(User).filter(User.username == username).first()
-                if user:
-                    user_id = user.id
-            db.close()
-        except:
-            pass  # 忽略token验证失败，允许匿名访问
-    
-    session_id = uuid.uuid4().hex
-    print(f"🔍 Analyze URL request: user_id={user_id}, session={session_id[:8]}")
+    user_id = await asyncio.to_thread(get_optional_user_id, token)
+    await asyncio.to_thread(enforce_admission)
+    # 匿名任务凭 X-Job-Secret 访问（重新接入、取消、重试）
+    secret = secrets.token_urlsafe(24) if user_id is None else None
+    job_id = await asyncio.to_thread(create_job, "url", user_id, url=url, secret=secret)
+    print(f"🔍 Analyze URL request: user_id={user_id}, job={job_id[:8]}")
+    # 断开连接只会停止推送，任务继续执行；可通过 /api/jobs/{job_id}/events 重新接入
     return StreamingResponse(
-        process_audio_logic("url", user_id=user_id, url=url, session_id=session_id),
-        media_type="text/event-stream"
+        stream_job_events(job_id),
+        media_type="text/event-stream",
+        headers=job_response_headers(job_id, secret)
     )
 
 @app.post("/api/analyze/file")
 async def analyze_file(
-    file: UploadFile = File(...),
+    request: Request,
     token: Optional[str] = Depends(oauth2_scheme_optional)
 ):
+    # 不声明 File 参数：FastAPI 会在调用接口前收完整个 multipart 请求体，准入检查就来不及拒绝了。
+    # 这里先做准入检查，再自己解析表单（字段名仍为 file）
     # 可选认证：如果有token则验证并获取user_id，否则使用None
-    user_id = None
-    if token:
-        try:
-            db = SessionLocal()
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username: str = payload.get("sub")
-            if username:
-                user = db.query(User).filter(User.username == username).first()
-                if user:
-                    user_id = user.id
-            db.close()
-        except:
-            pass  # 忽略token验证失败，允许匿名访问
-    
-    session_id = uuid.uuid4().hex
-    file_path = os.path.join(TEMP_DIR, f"{session_id}_{file.filename}")
+    user_id = await asyncio.to_thread(get_optional_user_id, token)
+    await asyncio.to_thread(enforce_admission, upload=True)
     
+    job_id = uuid.uuid4().hex
     # 优化：使用更大的缓冲区 (8MB) 和异步写入加速文件接收
     # 8MB 缓冲区适合 2GB RAM 服务器（关闭 Cursor 后）
     chunk_size = 8 * 1024 * 1024  # 8MB chunks
-    with open(file_path, "wb") as buffer:
-        while True:
-            chunk = await file.read(chunk_size)
-            if not chunk:
-                break
-            buffer.write(chunk)
-        
+    digest = hashlib.sha256()  # 边接收边计算内容哈希，用于缓存查找
+    admission.uploads_in_progress += 1
+    try:
+        form = await request.form(max_files=1)
+        try:
+            file = form.get("file")
+            if file is None or isinstance(file, str):
+                raise HTTPException(status_code=422, detail="Missing upload field: file")
+            file_path = os.path.join(TEMP_DIR, f"{job_id}_{os.path.basename(file.filename or 'upload')}")
+            with open(file_path, "wb") as buffer:
+                while True:
+                    chunk = await file.read(chunk_size)
+                    if not chunk:
+                        break
+                    buffer.write(chunk)
+                    digest.update(chunk)
+        finally:
+            await form.close()
+    finally:
+        admission.uploads_in_progress -= 1
+    
+    secret = secrets.token_urlsafe(24) if user_id is None else None
+    await asyncio.to_thread(create_job, "file", user_id, file_path=file_path, content_hash=digest.hexdigest(), job_id=job_id, secret=secret)
+    return StreamingResponse(
+        stream_job_events(job_id),
+        media_type="text/event-stream",
+        headers=job_response_headers(job_id, secret)
+    )
+
+def job_client_secret(x_job_secret: Optional[str] = Header(None), secret: Optional[str] = Query(None)) -> Optional[str]:
+    """匿名任务的访问凭证：请求头 X-Job-Secret，或查询参数 secret（EventSource 无法设置请求头）"""
+    return x_job_secret or secret
+
+def get_job_for_client(job_id: str, token: Optional[str], db: Session, secret: Optional[str] = None) -> Job:
+    """登录用户的任务只对本人可见；匿名任务须出示创建时返回的凭证"""
+    job = db.query(Job).filter(Job.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.user_id is not None:
+        allowed = job.user_id == get_optional_user_id(token)
+    else:
+        allowed = bool(job.secret_hash and secret) and secrets.compare_digest(
+            hashlib.sha256(secret.encode()).hexdigest(), job.secret_hash
+        )
+    if not allowed:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs")
+def list_jobs(
+    limit: int = 50,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    jobs = db.query(Job).filter(Job.user_id == current_user.id).order_by(Job.created_at.desc()).limit(min(limit, 200)).all()
+    return [job_to_dict(job) for job in jobs]
+
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: str, token: Optional[str] = Depends(oauth2_scheme_optional), secret: Optional[str] = Depends(job_client_secret), db: Session = Depends(get_db)):
+    return job_to_dict(get_job_for_client(job_id, token, db, secret))
+
+@app.get("/api/jobs/{job_id}/events")
+def get_job_events(job_id: str, after: int = 0, token: Optional[str] = Depends(oauth2_scheme_optional), secret: Optional[str] = Depends(job_client_secret)):
+    """SSE：回放 seq > after 的事件后继续实时推送，直到任务结束"""
+    db = SessionLocal()  # 不使用 get_db，避免会话在整个推送期间保持打开
+    try:
+        get_job_for_client(job_id, token, db, secret)
+    finally:
+        db.close()
     return StreamingResponse(
-        process_audio_logic("file", user_id=user_id, file_path=file_path, session_id=session_id),
-        media_type="text/event-stream"
+        stream_job_events(job_id, after),
+        media_type="text/event-stream",
+        headers={"X-Job-Id": job_id}
     )
 
+@app.post("/api/jobs/{job_id}/cancel")
+def cancel_job_endpoint(job_id: str, token: Optional[str] = Depends(oauth2_scheme_optional), secret: Optional[str] = Depends(job_client_secret), db: Session = Depends(get_db)):
+    get_job_for_client(job_id, token, db, secret)
+    return {"id": job_id, "status": cancel_job(job_id)}
+
+@app.post("/api/jobs/{job_id}/retry")
+def retry_job_endpoint(job_id: str, token: Optional[str] = Depends(oauth2_scheme_optional), secret: Optional[str] = Depends(job_client_secret), db: Session = Depends(get_db)):
+    """重试失败的任务，或补转有分片失败的已完成任务；之后通过 /api/jobs/{id}/events?after=resume_after 接收进度"""
+    job = get_job_for_client(job_id, token, db, secret)
+    if not retryable(job):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status} and cannot be retried")
+    if job.source_type == "file" and not (job.file_path and os.path.exists(job.file_path)):
+        raise HTTPException(status_code=410, detail="Uploaded file is no longer available, please upload again")
+    enforce_admission()
+    resume_after = retry_job(job_id)
+    db.refresh(job)
+    return {**job_to_dict(job), "resume_after": resume_after}
+
 @app.post("/api/transcript/identify-speakers/{history_id}")
-async def identify_speakers(
+def identify_speakers(
     history_id: int,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
 ):
-    """按需生成说话人识别版本的transcript（带数据库缓存）"""
-    db = SessionLocal()
-    
-    try:
-        # 查询history item
-        item = db.query(HistoryItem).filter(
-            HistoryItem.id == history_id,
-            HistoryItem.user_id == current_user.id
-        ).first()
-        
-        if not item:
-            raise HTTPException(status_code=404, detail="History item not found")
-        
-        # 优先返回数据库缓存，但需要验证格式
-        if item.speaker_transcript and len(item.speaker_transcript) > 100:
-            # 验证缓存格式：至少应该有说话人标记（冒号）
-            speaker_lines = [l for l in item.speaker_transcript.split('\n') if ':' in l and '[' in l]
-            total_lines = len([l for l in item.speaker_transcript.split('\n') if l.strip()])
-            
-            if len(speaker_lines) >= total_lines * 0.2:  # 至少20%的行应该有说话人格式
-                print(f"✓ Cache hit for history {history_id} ({len(item.speaker_transcript)} chars, {len(speaker_lines)} speaker lines)")
-                return {
-                    "speaker_transcript": item.speaker_transcript,
-                    "cached": True
-                }
-            else:
-                print(f"⚠ Cache format invalid ({len(speaker_lines)}/{total_lines} speaker lines), clearing and regenerating...")
-                # 清除无效缓存
-                item.speaker_transcript = None
-                db.commit()
-        
-        # 解析存储的数据
+    """按需生成说话人识别版本的transcript：有有效缓存时直接返回，否则返回 202 和后台任务ID
+    （进度见 /api/jobs/{id}/events，或轮询 GET 同一路径）"""
+    item = db.query(HistoryItem).filter(
+        HistoryItem.id == history_id,
+        HistoryItem.user_id == current_user.id
+    ).first()
+    if not item:
+        raise HTTPException(status_code=404, detail="History item not found")
+
+    # 优先返回数据库缓存，但需要验证格式
+    if item.speaker_transcript:
+        if speaker_transcript_is_valid(item.speaker_transcript):
+            print(f"✓ Cache hit for history {history_id} ({len(item.speaker_transcript)} chars)")
+            return {
+                "speaker_transcript": item.speaker_transcript,
+                "cached": True
+            }
+        print(f"⚠ Cache format invalid for history {history_id}, clearing and regenerating...")
+        item.speaker_transcript = None
+        db.commit()
+
+    # 同一条记录已有识别任务在排队或运行时直接复用
+    job = active_speaker_job(db, history_id)
+    attached = job is not None
+    if not attached:
         try:
-            data = json.loads(item.data_json)
-            original_transcript = data.get("transcript", "")
+            original_transcript = json.loads(item.data_json).get("transcript", "")
         except json.JSONDecodeError as e:
             raise HTTPException(status_code=500, detail=f"Invalid data format: {e}")
-        
         if not original_transcript or len(original_transcript) < 50:
             raise HTTPException(status_code=400, detail="No valid transcript available")
-        
-        print(f"Starting speaker identification for history {history_id}")
-        print(f"Input: {len(original_transcript)} chars, ~{len(original_transcript.split())} words")
-        
-        # 使用AI进行说话人识别
-        client = Groq(api_key=GROQ_API_KEY)
-        
-        try:
-            speaker_transcript = format_transcript_with_speakers(client, original_transcript)
-            
-            # 验证输出
-            if not speaker_transcript or len(speaker_transcript) < 50:
-                raise Exception("Generated transcript too short or empty")
-            
-            # 验证格式：至少应该有时间戳
-            if '[' not in speaker_transcript:
-                print("⚠ Warning: Generated transcript missing timestamps")
-            
-        except Exception as e:
-            print(f"✗ Speaker identification failed: {e}")
-            raise HTTPException(status_code=500, detail=f"AI processing failed: {str(e)}")
-        
-        # 存储到数据库
-        try:
-            item.speaker_transcript = speaker_transcript
-            db.commit()
-            db.refresh(item)
-            print(f"✓ Saved to database: {len(speaker_transcript)} chars")
-        except Exception as e:
-            db.rollback()
-            print(f"⚠ Database save failed: {e}, but returning result anyway")
-        
-        return {
-            "speaker_transcript": speaker_transcript,
-            "cached": False
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"✗ Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-    finally:
-        db.close()
+        enforce_admission()
+        job_id = create_job("history", current_user.id, kind="speakers", history_id=history_id)
+        job = db.query(Job).filter(Job.id == job_id).first()
+    else:
+        print(f"✓ Attaching to running speaker job {job.id[:8]} for history {history_id}")
+
+    return JSONResponse(
+        status_code=202,
+        content={**job_to_dict(job), "job_id": job.id, "attached": attached},
+        headers={"X-Job-Id": job.id}
+    )
+
+@app.get("/api/transcript/identify-speakers/{history_id}")
+def get_speaker_identification(
+    history_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """轮询说话人识别：完成时返回 speaker_transcript，否则返回最近一次识别任务的状态和分段进度"""
+    item = db.query(HistoryItem).filter(
+        HistoryItem.id == history_id,
+        HistoryItem.user_id == current_user.id
+    ).first()
+    if not item:
+        raise HTTPException(status_code=404, detail="History item not found")
+    if speaker_transcript_is_valid(item.speaker_transcript):
+        return {"status": "completed", "speaker_transcript": item.speaker_transcript, "cached": True}
+
+    job = db.query(Job).filter(Job.kind == "speakers", Job.history_id == history_id).order_by(Job.created_at.desc()).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Speaker identification has not been started")
+    event = latest_job_event(db, job) or {}
+    return {
+        **job_to_dict(job),
+        "job_id": job.id,
+        "progress": {key: event.get(key) for key in ("percent", "msg", "chunks_done", "chunks_total")},
+    }
 
 class TranscriptIdentifyRequest(BaseModel):
     transcript: str
@@ -2312,10 +6059,10 @@ async def identify_speakers_direct(
         print(f"Input: {len(original_transcript)} chars, ~{len(original_transcript.split())} words")
         
         # 使用AI进行说话人识别
-        client = Groq(api_key=GROQ_API_KEY)
+        client = clients.groq
         
         try:
-            speaker_transcript = format_transcript_with_speakers(client, original_transcript)
+            speaker_transcript = await asyncio.to_thread(format_transcript_with_speakers, client, original_transcript)
             
             # 验证输出
             if not speaker_transcript or len(speaker_transcript) < 50:
@@ -2345,10 +6092,11 @@ async def identify_speakers_direct(
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @app.post("/api/transcript/add-punctuation")
-async def add_punctuation_to_transcript(
+def add_punctuation_to_transcript(
     request: TranscriptIdentifyRequest
 ):
-    """为 transcript 添加标点符号和智能分段（不需要登录）"""
+    """为 transcript 添加标点符号和智能分段（不需要登录）。
+    同步接口，由 FastAPI 放到线程池执行：Groq 调用可能在调度器里排队等令牌，不能占住事件循环"""
     
     try:
         original_transcript = request.transcript
@@ -2359,7 +6107,7 @@ async def add_punctuation_to_transcript(
         print(f"Starting punctuation addition for transcript")
         print(f"Input: {len(original_transcript)} chars")
         
-        client = Groq(api_key=GROQ_API_KEY)
+        client = clients.groq
         
         try:
             # 分行处理，保持时间戳格式
@@ -2407,11 +6155,11 @@ async def add_punctuation_to_transcript(
                                     punctuated_lines.append(original_text)
                     else:
                         # 文本太短，直接使用原文
-                        for timestamp, text in zip(timestamps, texts):
-                            if timestamp and text:
-                                punctuated_lines.append(f"{timestamp} {text}")
-                            elif text:
-                                punctuated_lines.append(text)
+                        for timestamp, line_text in zip(timestamps, texts):
+                            if timestamp and line_text:
+                                punctuated_lines.append(f"{timestamp} {line_text}")
+                            elif line_text:
+                                punctuated_lines.append(line_text)
             
             punctuated_transcript = '\n'.join(punctuated_lines)
             
@@ -2571,6 +6319,50 @@ async def get_podcaster_episodes(
         for ep in episodes
     ]
 
+@app.post("/api/podcasters/{podcaster_id}/analyze-all")
+def analyze_podcaster_backlog(
+    podcaster_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """把播主尚未分析过的单集全部加入 bulk lane，不影响单次分析的排队"""
+    podcaster = db.query(Podcaster).filter(
+        Podcaster.id == podcaster_id,
+        Podcaster.user_id == current_user.id
+    ).first()
+    if not podcaster:
+        raise HTTPException(status_code=404, detail="播主不存在")
+    
+    analyzed = {
+        url for (url,) in db.query(HistoryItem.audio_url).filter(HistoryItem.user_id == current_user.id).all() if url
+    }
+    pending_jobs = db.query(Job).filter(Job.user_id == current_user.id, Job.status.in_(("queued", "running"))).all()
+    analyzed.update(job.url for job in pending_jobs if job.url)
+    bulk_queued = sum(1 for job in pending_jobs if job.lane == "bulk" and job.status == "queued")
+    
+    episodes = db.query(PodcastEpisode).filter(
+        PodcastEpisode.podcaster_id == podcaster_id
+    ).order_by(PodcastEpisode.publish_time.desc()).all()
+    
+    job_ids = []
+    skipped = 0
+    for ep in episodes:
+        if not ep.audio_url or ep.audio_url in analyzed:
+            skipped += 1
+            continue
+        if bulk_queued + len(job_ids) >= BULK_MAX_QUEUED_PER_USER:
+            break
+        job_ids.append(create_job("url", current_user.id, url=ep.audio_url, lane="bulk"))
+        analyzed.add(ep.audio_url)
+    
+    print(f"✓ Queued {len(job_ids)} bulk jobs for podcaster {podcaster_id} (skipped {skipped} already analyzed)")
+    return {
+        "queued": len(job_ids),
+        "skipped": skipped,
+        "remaining": len(episodes) - skipped - len(job_ids),
+        "job_ids": job_ids,
+    }
+
 @app.post("/api/podcasters/{podcaster_id}/refresh")
 async def refresh_podcaster(
     podcaster_id: int,
@@ -2696,6 +6488,9 @@ async def delete_history(
         except Exception as e:
             print(f"Failed to delete audio file: {e}")
 
+        db.query(TranscriptSegment).filter(TranscriptSegment.history_id == history_item.id).delete(synchronize_session=False)
+        remove_from_search_index(db, history_item.id)
+        retrievers.forget_history(history_item.id)
         db.delete(history_item)
         db.commit()
         return {"status": "success", "message": "History item deleted"}
@@ -2706,12 +6501,22 @@ async def delete_history(
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to delete history item: {str(e)}")
 
+class RegenerateSummaryRequest(BaseModel):
+    sections: Optional[List[str]] = None  # 只重新生成这些部分，见 SUMMARY_SECTION_SPECS；为空时重新生成整份总结
+
 @app.post("/api/history/{history_id}/regenerate-summary")
 async def regenerate_summary(
     history_id: int,
+    request: Optional[RegenerateSummaryRequest] = Body(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    sections = request.sections if request else None
+    if sections:
+        unknown = [name for name in sections if name not in SUMMARY_SECTION_SPECS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown summary sections: {', '.join(unknown)} (valid: {', '.join(SUMMARY_SECTION_SPECS)})")
+
     try:
         history_item = db.query(HistoryItem).filter(
             HistoryItem.id == history_id,
@@ -2728,8 +6533,12 @@ async def regenerate_summary(
         if not transcript:
              raise HTTPException(status_code=400, detail="Original transcript not found, cannot regenerate summary")
 
-        client = Groq(api_key=GROQ_API_KEY)
-        new_summary_json = generate_summary_json(client, transcript)
+        client = clients.groq
+        existing_summary = data.get("summary") or {}
+        if sections and existing_summary.get("overview", {}).get("type") != "Error":
+            new_summary_json = await asyncio.to_thread(regenerate_summary_sections, client, transcript, sections, existing_summary)
+        else:
+            new_summary_json = await asyncio.to_thread(generate_summary_json, client, transcript, None, True)
         
         result_payload = {
             "stage": "completed",
@@ -2741,6 +6550,9 @@ async def regenerate_summary(
         
         history_item.data_json = json.dumps(result_payload)
         history_item.title = new_summary_json.get("title", history_item.title)
+        for name, value in history_index_fields(result_payload).items():
+            setattr(history_item, name, value)
+        index_history_search(db, history_item.id, current_user.id, result_payload, summary_only=True)
         
         db.commit()
         
@@ -105,7 +105,7 @@ function AppContent() {
     setSeekTime(null);
     
     try {
-      setChatSession(createPodcastChat(item.result));
+      setChatSession(createPodcastChat(item.result, item.id));
     } catch(e) { }
     
     if (window.innerWidth < 1024) setIsSidebarOpen(false);
@@ -37,13 +37,29 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ chatSession, isOpen, onCl
     setLoading(true);
 
     try {
-      const result = await chatSession.sendMessage({ message: userMsg.text });
-      const modelMsg: ChatMessage = {
-        id: (Date.now() + 1).toString(),
-        role: 'model',
-        text: result.text || "I'm sorry, I couldn't generate a response."
-      };
-      setMessages(prev => [...prev, modelMsg]);
+      const modelId = (Date.now() + 1).toString();
+      if (chatSession.sendMessageStream) {
+        // 流式：先插入空回复，随 token 更新其内容
+        const updateModelMsg = (text: string) => {
+          setLoading(false);
+          setMessages(prev => prev.some(m => m.id === modelId)
+            ? prev.map(m => m.id === modelId ? { ...m, text } : m)
+            : [...prev, { id: modelId, role: 'model', text }]);
+        };
+        const result = await chatSession.sendMessageStream({ message: userMsg.text }, {
+          onToken: updateModelMsg,
+          onActivity: updateModelMsg
+        });
+        updateModelMsg(result.text || "I'm sorry, I couldn't generate a response.");
+      } else {
+        const result = await chatSession.sendMessage({ message: userMsg.text });
+        const modelMsg: ChatMessage = {
+          id: modelId,
+          role: 'model',
+          text: result.text || "I'm sorry, I couldn't generate a response."
+        };
+        setMessages(prev => [...prev, modelMsg]);
+      }
     } catch (error) {
       console.error("Chat error", error);
       const errorMsg: ChatMessage = {
@@ -1,4 +1,4 @@
-import { PodcastAnalysisResult, HistoryItem, Podcaster, Episode } from "../types";
+import { PodcastAnalysisResult, HistoryItem, Podcaster, Episode, ChatStreamHandlers } from "../types";
 
 const API_BASE_URL = ""; 
 
@@ -117,8 +117,7 @@ export const regenerateSummary = async (historyId: string): Promise<PodcastAnaly
 export const generateAnalysis = async (
   input: string | Blob,
   onProgress?: (percent: number, total: number, currentSection: string) => void,
-  // eslint-disable-next-line @typescript-eslint/no-unused-vars
-  _onPartialUpdate?: (partial: Partial<PodcastAnalysisResult>) => void,
+  onPartialUpdate?: (partial: Partial<PodcastAnalysisResult>) => void,
   onAudioUrl?: (url: string) => void
 ): Promise<PodcastAnalysisResult> => {
   
@@ -153,6 +152,8 @@ export const generateAnalysis = async (
     let finalResult: PodcastAnalysisResult | null = null;
     let buffer = ""; 
     let completedMessageReceived = false;
+    // 摘要流式生成时逐字段拼出的部分结果
+    const partialSummary: Record<string, any> = {};
 
     while (true) {
       const { done, value } = await reader.read();
@@ -197,6 +198,22 @@ export const generateAnalysis = async (
                }
             }
 
+            if (data.stage === 'summary_field' && data.field) {
+                partialSummary[data.field] = data.value;
+                if (onPartialUpdate) {
+                    onPartialUpdate({ ...partialSummary } as Partial<PodcastAnalysisResult>);
+                }
+            }
+
+            if (data.stage === 'summary_item' && data.field && data.index !== undefined) {
+                const items = Array.isArray(partialSummary[data.field]) ? [...partialSummary[data.field]] : [];
+                items[data.index] = data.value;
+                partialSummary[data.field] = items;
+                if (onPartialUpdate) {
+                    onPartialUpdate({ ...partialSummary } as Partial<PodcastAnalysisResult>);
+                }
+            }
+
             if (data.stage === 'completed') {
                 completedMessageReceived = true;
                 if (data.summary) {
@@ -256,9 +273,12 @@ export const generateAnalysis = async (
 // --- Chat API (Backend Powered) ---
 export interface BackendChatSession {
     sendMessage: (payload: { message: string }) => Promise<{ text: string }>;
+    sendMessageStream: (payload: { message: string }, handlers: ChatStreamHandlers) => Promise<{ text: string }>;
 }
 
-export const createPodcastChat = (analysis: PodcastAnalysisResult): BackendChatSession => {
+// historyId 存在时后端直接从该记录的文稿中检索，无需再上传完整 transcript
+export const createPodcastChat = (analysis: PodcastAnalysisResult, historyId?: string): BackendChatSession => {
+    const { transcript, ...summaryContext } = analysis;
     return {
         sendMessage: async ({ message }: { message: string }) => {
             try {
@@ -267,7 +287,8 @@ export const createPodcastChat = (analysis: PodcastAnalysisResult): BackendChatS
                     headers: getAuthHeaders() as Record<string, string>,
                     body: JSON.stringify({
                         message,
-                        context: analysis
+                        context: historyId ? summaryContext : analysis,
+                        history_id: historyId ? Number(historyId) : undefined
                     })
                 });
 
@@ -285,6 +306,63 @@ export const createPodcastChat = (analysis: PodcastAnalysisResult): BackendChatS
                 console.error("Chat Error:", e);
                 return { text: "Sorry, I encountered an error connecting to the AI server." };
             }
+        },
+        // 流式版本：逐 token 回调，联网搜索时回调提示文字
+        sendMessageStream: async ({ message }: { message: string }, { onToken, onActivity }: ChatStreamHandlers) => {
+            try {
+                const response = await fetch(`${API_BASE_URL}/api/chat/stream`, {
+                    method: 'POST',
+                    headers: getAuthHeaders() as Record<string, string>,
+                    body: JSON.stringify({
+                        message,
+                        context: historyId ? summaryContext : analysis,
+                        history_id: historyId ? Number(historyId) : undefined
+                    })
+                });
+
+                if (response.status === 401) {
+                    handleUnauthorized();
+                }
+                if (!response.ok || !response.body) {
+                     throw new Error("Chat request failed");
+                }
+
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = "";
+                let text = "";
+
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\n\n');
+                    buffer = lines.pop() || "";
+
+                    for (const line of lines) {
+                        if (!line.startsWith('data: ')) continue;
+                        const data = JSON.parse(line.slice(6));
+                        if (data.stage === 'token') {
+                            text += data.content;
+                            onToken?.(text);
+                        } else if (data.stage === 'tool_call') {
+                            // 第二轮回答会重新开始
+                            text = "";
+                            onActivity?.(data.msg);
+                        } else if (data.stage === 'completed') {
+                            text = data.response;
+                            onToken?.(text);
+                        } else if (data.stage === 'error') {
+                            throw new Error(data.msg);
+                        }
+                    }
+                }
+                return { text };
+            } catch (e: any) {
+                console.error("Chat Error:", e);
+                return { text: "Sorry, I encountered an error connecting to the AI server." };
+            }
         }
     };
 };
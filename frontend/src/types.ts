@@ -81,8 +81,14 @@ export interface HistoryItem {
 }
 
 // Custom interface for our backend-powered chat, replacing Google's Chat type
+export interface ChatStreamHandlers {
+    onToken?: (text: string) => void;    // 当前已生成的完整回答
+    onActivity?: (msg: string) => void;  // 工具调用提示，如联网搜索
+}
+
 export interface ChatSession {
     sendMessage: (payload: { message: string }) => Promise<{ text: string }>;
+    sendMessageStream?: (payload: { message: string }, handlers: ChatStreamHandlers) => Promise<{ text: string }>;
 }
 
 export interface Podcaster {
@@ -0,0 +1,106 @@
+"""分析管道不应阻塞事件循环：管道卡在数据库操作上、或 ffmpeg 正在切片时 /api/health 仍应立即返回"""
+import json
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.chdir(tempfile.mkdtemp(prefix="podcast-test-"))  # backend 在当前目录下创建 data/、temp_files/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+
+import backend
+
+
+def test_health_responds_while_pipeline_blocks_on_db(monkeypatch):
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow_lookup(**kwargs):
+        entered.set()
+        release.wait(10)
+        return None, None
+
+    monkeypatch.setattr(backend, "lookup_analysis_cache", slow_lookup)
+    monkeypatch.setattr(backend, "get_real_audio_url", lambda url: None)
+
+    with TestClient(backend.app) as client:
+        backend.create_job("url", None, url="https://example.com/episode.mp3")
+        try:
+            assert entered.wait(10), "pipeline never reached the cache lookup"
+            started = time.perf_counter()
+            response = client.get("/api/health")
+            elapsed = time.perf_counter() - started
+        finally:
+            release.set()
+
+    assert response.status_code == 200
+    assert elapsed < 0.5
+
+
+# 假的 ffmpeg：按 -segment_list 约定慢慢写出分片，并输出 -progress 行，模拟一次耗时的切片
+FAKE_FFMPEG = """#!{python}
+import os, sys, time
+args = sys.argv[1:]
+segment_list = args[args.index("-segment_list") + 1]
+pattern = args[-1]
+open("ffmpeg_started", "w").close()
+for i in range({segments}):
+    time.sleep({interval})
+    with open(pattern % i, "w") as f:
+        f.write("fake")
+    with open(segment_list, "a") as f:
+        f.write("%s,%d.000000,%d.000000\\n" % (os.path.basename(pattern % i), i * 60, (i + 1) * 60))
+    print("out_time_us=%d" % ((i + 1) * 60000000), flush=True)
+    print("speed=30x", flush=True)
+    print("progress=continue", flush=True)
+print("progress=end", flush=True)
+open("ffmpeg_finished", "w").close()
+"""
+
+
+def test_health_responds_while_ffmpeg_slices(monkeypatch, tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    ffmpeg = bin_dir / "ffmpeg"
+    ffmpeg.write_text(FAKE_FFMPEG.format(python=sys.executable, segments=8, interval=0.5))
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(backend, "get_audio_duration_from_url", lambda url: 360)
+    monkeypatch.setattr(backend, "get_real_audio_url", lambda url: None)  # 之前的测试遗留的 URL 任务直接失败
+    monkeypatch.setattr(backend, "transcribe_chunk", lambda client, path: None)
+    monkeypatch.setattr(backend, "SILENCE_AWARE_SPLIT", False)
+
+    upload = tmp_path / "episode.mp3"
+    upload.write_bytes(os.urandom(4096))
+    started_marker = os.path.join(os.getcwd(), "ffmpeg_started")
+    finished_marker = os.path.join(os.getcwd(), "ffmpeg_finished")
+    for marker in (started_marker, finished_marker):
+        if os.path.exists(marker):
+            os.remove(marker)
+
+    latencies = []
+    with TestClient(backend.app) as client:
+        job_id = backend.create_job("file", None, file_path=str(upload))
+        try:
+            deadline = time.monotonic() + 10
+            while not os.path.exists(started_marker):
+                assert time.monotonic() < deadline, "pipeline never started ffmpeg"
+                time.sleep(0.05)
+            for _ in range(10):
+                started = time.perf_counter()
+                response = client.get("/api/health")
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200
+                time.sleep(0.1)
+            assert max(latencies) < 0.5, f"/api/health latencies during slicing: {latencies}"
+            assert not os.path.exists(finished_marker), "slicing finished before the latency samples were taken"
+            _, events = backend.load_job_events(job_id, 0)
+            assert any(json.loads(payload).get("chunk_state") == "sliced" for _, payload in events), "slicing loop never picked up a segment"
+        finally:
+            backend.cancel_job(job_id)